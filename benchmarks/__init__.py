@@ -0,0 +1,17 @@
+"""
+Benchmarks of the validation engines and query binding backends.
+
+The benchmarks validate large synthetic documents (see generators) against schemas that
+each stress one hot path of the validator (see schemas), and measure the time to compile
+the schema, the latency and throughput of validation (including the resolution of the
+messages), and the peak memory use of every engine and backend. Every case runs in a process
+of its own, so that its peak memory use is not affected by the other cases.
+
+Run them from the root of the repository, and compare them with a saved baseline:
+
+    python -m benchmarks.run --sizes 1000,10000 --save-baseline baseline.json
+    python -m benchmarks.run --sizes 1000,10000 --baseline baseline.json
+
+The second run flags every case that is slower or uses more memory than in the baseline (by
+more than the threshold), and exits with status 1 if there are any.
+"""
@@ -0,0 +1,183 @@
+"""
+Generators of large synthetic documents for the benchmarks.
+
+The documents are written incrementally (with lxml's xmlfile), one line or record at a time,
+so documents of any size can be generated with little memory. A fraction of the lines or records (error_rate) has a
+deliberate error, so that the benchmarks also measure the cost of failed assertions and
+their messages. The same arguments always give the same document.
+"""
+import random
+
+from lxml import etree
+
+UBL_NAMESPACE = "urn:oasis:names:specification:ubl:schema:xsd:Invoice-2"
+CAC_NAMESPACE = "urn:oasis:names:specification:ubl:schema:xsd:CommonAggregateComponents-2"
+CBC_NAMESPACE = "urn:oasis:names:specification:ubl:schema:xsd:CommonBasicComponents-2"
+NAMESPACES = {None: UBL_NAMESPACE, 'cac': CAC_NAMESPACE, 'cbc': CBC_NAMESPACE}
+
+# The tax categories of the invoice lines, and their percentages
+TAX_CATEGORIES = [("S", "21"), ("AA", "9"), ("Z", "0")]
+
+DEFAULT_ERROR_RATE = 0.05
+
+
+def cac(name):
+    return "{%s}%s" % (CAC_NAMESPACE, name)
+
+
+def cbc(name):
+    return "{%s}%s" % (CBC_NAMESPACE, name)
+
+
+def create_element(tag, text=None, attributes=None, children=()):
+    """
+    Returns an element as a (tag, text, attributes, children) tuple, for write_element()
+    """
+    return tag, text, attributes or {}, children
+
+
+def write_element(output, element):
+    """
+    Writes an element of create_element() to an xmlfile; unlike lxml elements written with
+    output.write(), these do not repeat the namespace declarations of the document element
+    """
+    tag, text, attributes, children = element
+    with output.element(tag, attributes):
+        if text is not None:
+            output.write(text)
+        for child in children:
+            write_element(output, child)
+
+
+def create_party(name, city, country):
+    return create_element(cac("Party"), children=[
+        create_element(cac("PartyName"), children=[create_element(cbc("Name"), name)]),
+        create_element(cac("PostalAddress"), children=[
+            create_element(cbc("CityName"), city),
+            create_element(cac("Country"), children=[create_element(cbc("IdentificationCode"), country)])
+        ])
+    ])
+
+
+def create_invoice_line(number, random_generator, error):
+    """
+    Returns a cac:InvoiceLine element (see create_element()); if error is True, one of its values is wrong
+    """
+    quantity = random_generator.randint(1, 20)
+    price = random_generator.randint(100, 10000) / 100
+    amount = "%.2f" % (quantity * price)
+    category, percent = TAX_CATEGORIES[number % len(TAX_CATEGORIES)]
+    name = "Item %d" % number
+    currency = "EUR"
+    if error:
+        kind = number % 4
+        if kind == 0:
+            amount = "%.2f" % (quantity * price + 1)
+        elif kind == 1:
+            category = "X"
+        elif kind == 2:
+            name = ""
+        else:
+            currency = "USD"
+    return create_element(cac("InvoiceLine"), children=[
+        create_element(cbc("ID"), str(number)),
+        create_element(cbc("InvoicedQuantity"), str(quantity), {'unitCode': "C62"}),
+        create_element(cbc("LineExtensionAmount"), amount, {'currencyID': currency}),
+        create_element(cac("OrderLineReference"), children=[create_element(cbc("LineID"), str(number))]),
+        create_element(cac("Item"), children=[
+            create_element(cbc("Name"), name),
+            create_element(cac("SellersItemIdentification"), children=[
+                create_element(cbc("ID"), "SKU-%d" % random_generator.randint(1, 1000))
+            ]),
+            create_element(cac("ClassifiedTaxCategory"), children=[
+                create_element(cbc("ID"), category),
+                create_element(cbc("Percent"), percent)
+            ])
+        ]),
+        create_element(cac("Price"), children=[create_element(cbc("PriceAmount"), "%.2f" % price,
+                                                              {'currencyID': "EUR"})])
+    ])
+
+
+def write_invoice(path, lines, error_rate=DEFAULT_ERROR_RATE, seed=0):
+    """
+    Writes a UBL-like invoice with the given number of invoice lines
+    :param path: The file to write
+    :param lines: The number of cac:InvoiceLine elements
+    :param error_rate: The fraction of the lines that has an error
+    :param seed: The seed of the random values
+    """
+    random_generator = random.Random(seed)
+    with etree.xmlfile(path, encoding='utf-8') as output:
+        output.write_declaration()
+        with output.element("{%s}Invoice" % UBL_NAMESPACE, nsmap=NAMESPACES):
+            write_element(output, create_element(cbc("ID"), "INV-%d" % seed))
+            write_element(output, create_element(cbc("IssueDate"), "2020-01-01"))
+            write_element(output, create_element(cbc("DocumentCurrencyCode"), "EUR"))
+            write_element(output, create_element(cac("AccountingSupplierParty"), children=[
+                create_party("Supplier", "Amsterdam", "NL")
+            ]))
+            write_element(output, create_element(cac("AccountingCustomerParty"), children=[
+                create_party("Customer", "Brussels", "BE")
+            ]))
+            write_element(output, create_element(cac("TaxTotal"), children=[
+                create_element(cac("TaxSubtotal"), children=[
+                    create_element(cac("TaxCategory"), children=[
+                        create_element(cbc("ID"), category),
+                        create_element(cbc("Percent"), percent)
+                    ])
+                ]) for category, percent in TAX_CATEGORIES
+            ]))
+            for number in range(1, lines + 1):
+                error = random_generator.random() < error_rate
+                write_element(output, create_invoice_line(number, random_generator, error))
+
+
+def create_record(number, records, random_generator, error):
+    """
+    Returns a record element (see create_element()); if error is True, one of its values is wrong
+    """
+    record_id = "r%d" % number
+    reference = "r%d" % random_generator.randint(1, records)
+    amount = "%.2f" % (random_generator.randint(1, 100000) / 100)
+    date = "2020-%02d-%02d" % (random_generator.randint(1, 12), random_generator.randint(1, 28))
+    if error:
+        kind = number % 4
+        if kind == 0:
+            reference = "missing%d" % number
+        elif kind == 1:
+            record_id = "r%d" % max(1, number - 1)
+        elif kind == 2:
+            amount = "-" + amount
+        else:
+            date = ""
+    return create_element("record", attributes={'id': record_id, 'type': "abc"[number % 3]}, children=[
+        create_element("name", "Record %d" % number),
+        create_element("amount", amount, {'currency': "EUR"}),
+        create_element("date", date),
+        create_element("ref", reference)
+    ])
+
+
+def write_records(path, records, error_rate=DEFAULT_ERROR_RATE, seed=0):
+    """
+    Writes a record-batch document: a root element with the given number of record elements,
+    that refer to each other by id
+    :param path: The file to write
+    :param records: The number of records
+    :param error_rate: The fraction of the records that has an error
+    :param seed: The seed of the random values
+    """
+    random_generator = random.Random(seed)
+    with etree.xmlfile(path, encoding='utf-8') as output:
+        output.write_declaration()
+        with output.element("records"):
+            for number in range(1, records + 1):
+                error = random_generator.random() < error_rate
+                write_element(output, create_record(number, records, random_generator, error))
+
+
+GENERATORS = {
+    'invoice': write_invoice,
+    'records': write_records,
+}
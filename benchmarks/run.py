@@ -0,0 +1,281 @@
+"""
+Runs the benchmarks, and compares the results with a saved baseline (see the description of
+the benchmarks package). Run with --help for the options.
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from lxml import etree
+
+from benchmarks.generators import DEFAULT_ERROR_RATE, GENERATORS
+from benchmarks.schemas import SCHEMAS
+from pyschematron.elements import Schema
+from pyschematron.validation import resolve_messages
+
+ENGINES = ['rules', 'document', 'xslt']
+BACKENDS = ['elementpath', 'lxml']
+DEFAULT_SIZES = [1000, 10000]
+DEFAULT_REPEAT = 3
+DEFAULT_THRESHOLD = 0.2
+
+# The metrics that are compared with the baseline (for all of them, higher is worse), with the
+# minimum difference that counts as a regression, so that the noise of tiny values is ignored
+COMPARED_METRICS = {
+    'compile_s': 0.01,
+    'latency_median_s': 0.01,
+    'peak_rss_mb': 5,
+}
+
+# The root directory of the repository, from which the cases are run in subprocesses
+ROOT_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def get_cases(benchmarks, sizes, engines, backends):
+    """
+    Returns the cases to run: every benchmark, for every size, engine and backend. The xslt
+    engine does not use the query binding backend, so it is only run with the first backend.
+    :return: a list of dicts with the benchmark, size, engine and backend of every case
+    """
+    cases = []
+    for benchmark in benchmarks:
+        for size in sizes:
+            for engine in engines:
+                for backend in backends[:1] if engine == 'xslt' else backends:
+                    cases.append({'benchmark': benchmark, 'size': size, 'engine': engine, 'backend': backend})
+    return cases
+
+
+def get_key(case):
+    return "%(benchmark)s/%(engine)s/%(backend)s/%(size)d" % case
+
+
+def get_document_file(data_directory, generator, size):
+    return os.path.join(data_directory, "%s_%d.xml" % (generator, size))
+
+
+def get_schema_file(data_directory, benchmark):
+    return os.path.join(data_directory, "%s.sch" % benchmark)
+
+
+def prepare_data(data_directory, cases, error_rate=DEFAULT_ERROR_RATE):
+    """
+    Writes the schemas and documents of the given cases to the data directory; documents that
+    already exist are kept, as the generators always write the same document for a size
+    :param error_rate: The fraction of the invoice lines and records that has an error
+    """
+    for case in cases:
+        schema_function, generator = SCHEMAS[case['benchmark']]
+        schema_file = get_schema_file(data_directory, case['benchmark'])
+        if not os.path.exists(schema_file):
+            with open(schema_file, 'w') as output:
+                output.write(schema_function())
+        document_file = get_document_file(data_directory, generator, case['size'])
+        if not os.path.exists(document_file):
+            GENERATORS[generator](document_file, case['size'], error_rate)
+
+
+def get_peak_rss_mb():
+    """
+    Returns the peak resident set size of this process in MB, or None if it cannot be
+    determined on this platform
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # In bytes on macOS, in kilobytes elsewhere
+    return peak_rss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+def run_case(case, data_directory, repeat=DEFAULT_REPEAT):
+    """
+    Runs a single case in this process: parses the document, compiles the schema, and validates
+    the document repeat times (the first of which includes the one-time costs of the engine)
+    :return: a dict with the metrics of the case
+    """
+    generator = SCHEMAS[case['benchmark']][1]
+    document_file = get_document_file(data_directory, generator, case['size'])
+    start = time.perf_counter()
+    xml_doc = etree.parse(document_file)
+    parse_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    schema = Schema(get_schema_file(data_directory, case['benchmark']), backend=case['backend'])
+    compiled_schema = schema.compile()
+    compile_s = time.perf_counter() - start
+
+    latencies = []
+    messages = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        report = schema.validate_document(xml_doc, compiled_schema=compiled_schema, engine=case['engine'])
+        messages = resolve_messages(report.get_failed_asserts(), xml_doc, schema.ns_prefixes)
+        latencies.append(time.perf_counter() - start)
+
+    latency_median_s = statistics.median(latencies)
+    return {
+        'parse_s': parse_s,
+        'compile_s': compile_s,
+        'first_s': latencies[0],
+        'latency_min_s': min(latencies),
+        'latency_median_s': latency_median_s,
+        'mb_per_s': os.path.getsize(document_file) / 1000000 / latency_median_s,
+        'nodes_per_s': sum(1 for _ in xml_doc.iter()) / latency_median_s,
+        'messages': len(messages),
+        'peak_rss_mb': get_peak_rss_mb(),
+    }
+
+
+def run_case_in_subprocess(case, data_directory, repeat):
+    """
+    Runs a single case in a new Python process, so that its peak memory use is its own
+    :return: a dict with the metrics of the case
+    """
+    environment = dict(os.environ)
+    environment['PYTHONPATH'] = os.pathsep.join(filter(None, [ROOT_DIRECTORY, environment.get('PYTHONPATH')]))
+    output = subprocess.run([sys.executable, "-m", "benchmarks.run", "--case", json.dumps(case),
+                             "--data-directory", data_directory, "--repeat", str(repeat)],
+                            cwd=ROOT_DIRECTORY, env=environment, stdout=subprocess.PIPE, check=True)
+    return json.loads(output.stdout.decode('utf-8').splitlines()[-1])
+
+
+def compare(results, baseline, threshold=DEFAULT_THRESHOLD):
+    """
+    Compares the results with those of a baseline
+    :param results: A dict of the metrics of every case, by the key of the case (see get_key())
+    :param baseline: The results of an earlier run, in the same form; cases that are not in it are skipped
+    :param threshold: The relative increase of a metric that is a regression
+    :return: a list of (key, metric, baseline value, value) tuples for the regressions
+    """
+    regressions = []
+    for key, metrics in results.items():
+        if key not in baseline:
+            continue
+        for metric, minimum_difference in COMPARED_METRICS.items():
+            old_value = baseline[key].get(metric)
+            value = metrics.get(metric)
+            if old_value is None or value is None:
+                continue
+            if value > old_value * (1 + threshold) and value - old_value >= minimum_difference:
+                regressions.append((key, metric, old_value, value))
+    return regressions
+
+
+def get_change(metrics, baseline_metrics):
+    if not baseline_metrics or not baseline_metrics.get('latency_median_s'):
+        return ""
+    return "%+.0f%%" % (100 * (metrics['latency_median_s'] / baseline_metrics['latency_median_s'] - 1))
+
+
+def write_table(results, baseline, output_stream):
+    """
+    Writes the results as a table, with the change of the median latency from the baseline
+    """
+    columns = ("case", "compile", "first", "median", "min", "MB/s", "nodes/s", "rss MB", "msgs", "vs base")
+    width = max([len(columns[0])] + [len(key) for key in results])
+    row_format = "%-" + str(width) + "s %8s %8s %8s %8s %7s %9s %7s %6s %8s\n"
+    output_stream.write(row_format % columns)
+    for key, metrics in results.items():
+        output_stream.write(row_format % (
+            key, "%.3f" % metrics['compile_s'], "%.3f" % metrics['first_s'], "%.3f" % metrics['latency_median_s'],
+            "%.3f" % metrics['latency_min_s'], "%.2f" % metrics['mb_per_s'], "%.0f" % metrics['nodes_per_s'],
+            "-" if metrics['peak_rss_mb'] is None else "%.0f" % metrics['peak_rss_mb'], metrics['messages'],
+            get_change(metrics, baseline.get(key))))
+
+
+def check_messages(results):
+    """
+    Returns the benchmarks and sizes for which the engines and backends do not report the same
+    number of messages, which means that they do not give the same results
+    """
+    counts = {}
+    for key, metrics in results.items():
+        benchmark, _, _, size = key.split("/")
+        counts.setdefault((benchmark, size), set()).add(metrics['messages'])
+    return ["%s/%s" % benchmark_size for benchmark_size, values in counts.items() if len(values) > 1]
+
+
+def main(benchmarks, sizes, engines, backends, repeat=DEFAULT_REPEAT, data_directory=None, baseline_file=None,
+         save_baseline_file=None, threshold=DEFAULT_THRESHOLD, output_stream=sys.stdout):
+    """
+    Runs the benchmarks, each case in a subprocess, and writes the results
+    :return: 1 if there are regressions compared with the baseline, 0 otherwise
+    """
+    cases = get_cases(benchmarks, sizes, engines, backends)
+    temporary_directory = None
+    if data_directory is None:
+        data_directory = temporary_directory = tempfile.mkdtemp(prefix="pyschematron-benchmarks-")
+    baseline = {}
+    if baseline_file is not None:
+        with open(baseline_file) as baseline_input:
+            baseline = json.load(baseline_input)['results']
+    try:
+        prepare_data(data_directory, cases)
+        results = {}
+        for case in cases:
+            results[get_key(case)] = run_case_in_subprocess(case, data_directory, repeat)
+    finally:
+        if temporary_directory is not None:
+            shutil.rmtree(temporary_directory)
+
+    write_table(results, baseline, output_stream)
+    for benchmark_size in check_messages(results):
+        output_stream.write("WARNING: the engines and backends report different numbers of messages for %s\n"
+                            % benchmark_size)
+    if save_baseline_file is not None:
+        with open(save_baseline_file, 'w') as baseline_output:
+            json.dump({'python': sys.version.split()[0], 'lxml': etree.__version__, 'repeat': repeat,
+                       'results': results}, baseline_output, indent=2, sort_keys=True)
+    regressions = compare(results, baseline, threshold)
+    for key, metric, old_value, value in regressions:
+        output_stream.write("REGRESSION: %s %s %.3f -> %.3f (%+.0f%%)\n"
+                            % (key, metric, old_value, value, 100 * (value / old_value - 1)))
+    return 1 if regressions else 0
+
+
+def get_list(text):
+    return [item.strip() for item in text.split(",") if item.strip()]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Runs the pyschematron benchmarks")
+    parser.add_argument('-n', '--sizes', default=",".join(map(str, DEFAULT_SIZES)),
+                        help='the sizes of the documents (invoice lines or records), comma-separated')
+    parser.add_argument('-B', '--benchmarks', default=",".join(SCHEMAS),
+                        help='the benchmarks to run, comma-separated (default: %(default)s)')
+    parser.add_argument('-e', '--engines', default=",".join(ENGINES), help='the engines to run, comma-separated')
+    parser.add_argument('-b', '--backends', default=",".join(BACKENDS), help='the query binding backends, comma-separated')
+    parser.add_argument('-r', '--repeat', type=int, default=DEFAULT_REPEAT, help='the number of validations per case')
+    parser.add_argument('-d', '--data-directory', help='keep the generated documents in this directory, instead of generating them for every run')
+    parser.add_argument('-c', '--baseline', help='compare the results with this baseline file, and exit with status 1 on regressions')
+    parser.add_argument('-s', '--save-baseline', help='save the results to this baseline file')
+    parser.add_argument('-t', '--threshold', type=float, default=DEFAULT_THRESHOLD, help='the relative increase of the compile time, latency or peak memory use that is a regression (default: %(default)s)')
+    parser.add_argument('--case', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case is not None:
+        # A single case, run by run_case_in_subprocess()
+        print(json.dumps(run_case(json.loads(args.case), args.data_directory, args.repeat)))
+        sys.exit(0)
+    for name in get_list(args.benchmarks):
+        if name not in SCHEMAS:
+            parser.error("unknown benchmark: %s (choose from %s)" % (name, ", ".join(SCHEMAS)))
+    for name in get_list(args.engines):
+        if name not in ENGINES:
+            parser.error("unknown engine: %s" % name)
+    for name in get_list(args.backends):
+        if name not in BACKENDS:
+            parser.error("unknown backend: %s" % name)
+    if args.data_directory is not None:
+        os.makedirs(args.data_directory, exist_ok=True)
+    sys.exit(main(get_list(args.benchmarks), [int(size) for size in get_list(args.sizes)], get_list(args.engines),
+                  get_list(args.backends), args.repeat, args.data_directory, args.baseline, args.save_baseline,
+                  args.threshold))
@@ -0,0 +1,132 @@
+"""
+The schemas of the benchmarks, each of which stresses one hot path of the validator.
+
+Every schema is a function that returns the text of the schema, given a size parameter (the
+number of lets, abstract pattern instances, etc.). All schemas use the xslt query binding,
+so that they can be run with every engine and backend.
+"""
+from benchmarks.generators import UBL_NAMESPACE, CAC_NAMESPACE, CBC_NAMESPACE
+
+SCHEMA_START = '<schema xmlns="http://purl.oclc.org/dsdl/schematron" queryBinding="xslt">'
+UBL_NAMESPACES = ('<ns prefix="ubl" uri="%s"/><ns prefix="cac" uri="%s"/><ns prefix="cbc" uri="%s"/>'
+                  % (UBL_NAMESPACE, CAC_NAMESPACE, CBC_NAMESPACE))
+
+
+def relative_contexts(count=1):
+    """
+    Rules with relative contexts on the invoice lines and their parts, that are matched
+    against every element of the document; count is the number of copies of the pattern
+    """
+    pattern = '''
+    <pattern id="lines_%(number)d">
+        <rule context="cac:InvoiceLine">
+            <assert test="cbc:ID and cbc:InvoicedQuantity and cac:Item">A line must have an ID, a quantity and an item</assert>
+            <assert test="round(cbc:LineExtensionAmount * 100) = round(cbc:InvoicedQuantity * cac:Price/cbc:PriceAmount * 100)">The line amount must be the quantity times the price</assert>
+        </rule>
+        <rule context="cac:InvoiceLine/cac:Item">
+            <assert test="string-length(cbc:Name) &gt; 0">An item must have a name</assert>
+        </rule>
+        <rule context="cac:ClassifiedTaxCategory">
+            <assert test="cbc:ID = 'S' or cbc:ID = 'AA' or cbc:ID = 'Z'">The tax category must be S, AA or Z</assert>
+        </rule>
+        <rule context="cbc:*[@currencyID]">
+            <assert test="@currencyID = 'EUR'">Amounts must be in euros</assert>
+        </rule>
+    </pattern>'''
+    return SCHEMA_START + UBL_NAMESPACES + "".join(pattern % {'number': number} for number in range(count)) + \
+        "</schema>"
+
+
+def joins(count=1):
+    """
+    Cross references and uniqueness checks with '//' paths and join predicates on the records,
+    which are evaluated through join indexes; count is the number of copies of the pattern
+    """
+    pattern = '''
+    <pattern id="references_%(number)d">
+        <rule context="record">
+            <assert test="count(//record[@id = current()/@id]) = 1">Record <value-of select="@id"/> is not unique</assert>
+            <assert test="//record[@id = current()/ref]">Record <value-of select="@id"/> refers to a missing record</assert>
+            <assert test="count(/records/record[ref = current()/@id]) &lt; 100">Record <value-of select="@id"/> is referred to too often</assert>
+        </rule>
+    </pattern>'''
+    return SCHEMA_START + "".join(pattern % {'number': number} for number in range(count)) + "</schema>"
+
+
+def lets(count=20):
+    """
+    Schema, pattern and rule lets on the invoice lines: count chained rule lets per line, on
+    top of lets that depend on the document and constant ones
+    """
+    rule_lets = ['<let name="value0" value="number(cbc:InvoicedQuantity)"/>']
+    for number in range(1, count):
+        rule_lets.append('<let name="value%d" value="$value%d + $rate * %d"/>' % (number, number - 1, number))
+    return SCHEMA_START + UBL_NAMESPACES + '''
+    <let name="currency" value="/ubl:Invoice/cbc:DocumentCurrencyCode"/>
+    <let name="rate" value="2"/>
+    <let name="line_count" value="count(/ubl:Invoice/cac:InvoiceLine)"/>
+    <pattern id="lets">
+        <let name="categories" value="/ubl:Invoice/cac:TaxTotal/cac:TaxSubtotal/cac:TaxCategory/cbc:ID"/>
+        <rule context="cac:InvoiceLine">
+            %s
+            <let name="price" value="number(cac:Price/cbc:PriceAmount)"/>
+            <assert test="$value%d &gt; $value0">The derived value must grow</assert>
+            <assert test="cbc:LineExtensionAmount/@currencyID = $currency">Line <value-of select="cbc:ID"/> is not in the document currency</assert>
+            <assert test="cac:Item/cac:ClassifiedTaxCategory/cbc:ID = $categories">The tax category of line <value-of select="cbc:ID"/> is not in the tax total</assert>
+            <assert test="cbc:ID &lt;= $line_count and $price &gt; 0">The line number and price must be valid</assert>
+        </rule>
+    </pattern>
+</schema>''' % ("\n            ".join(rule_lets), count - 1)
+
+
+def abstract_patterns(count=10):
+    """
+    An abstract pattern for the fields of the records, instantiated count times (cycling
+    through the fields of a record)
+    """
+    fields = ["name", "amount", "date", "ref"]
+    instances = []
+    for number in range(count):
+        field = fields[number % len(fields)]
+        instances.append('''
+    <pattern is-a="field" id="field_%d">
+        <param name="context" value="record"/>
+        <param name="field" value="%s"/>
+        <param name="minimum" value="%d"/>
+    </pattern>''' % (number, field, 1 + number // len(fields)))
+    return SCHEMA_START + '''
+    <pattern abstract="true" id="field">
+        <rule context="$context">
+            <assert test="$field">A record must have a $field</assert>
+            <assert test="string-length($field) &gt;= $minimum">The $field of record <value-of select="@id"/> is too short</assert>
+        </rule>
+    </pattern>''' + "".join(instances) + "</schema>"
+
+
+def messages(count=5):
+    """
+    Reports that fire for every record, with messages of count value-of and name elements
+    each, so that the cost of resolving messages dominates
+    """
+    parts = []
+    for number in range(count):
+        parts.append('<name/> <value-of select="@id"/> %d: <value-of select="amount"/> '
+                     '<value-of select="amount/@currency"/> on <value-of select="date"/>' % number)
+    return SCHEMA_START + '''
+    <pattern id="messages">
+        <rule context="record">
+            <report test="@type">%s</report>
+            <assert test="number(amount) &gt;= 0">Record <value-of select="@id"/> has a negative amount: <value-of select="amount"/></assert>
+        </rule>
+    </pattern>
+</schema>''' % "; ".join(parts)
+
+
+# The schemas by name, with the generator of the documents that they are run against
+SCHEMAS = {
+    'relative_contexts': (relative_contexts, 'invoice'),
+    'joins': (joins, 'records'),
+    'lets': (lets, 'invoice'),
+    'abstract_patterns': (abstract_patterns, 'records'),
+    'messages': (messages, 'records'),
+}
@@ -5,4 +5,6 @@
 #
 
 # Copyright (c) 2020 Ionite
-# See LICENSE for the license
\ No newline at end of file
+# See LICENSE for the license
+
+__version__ = '0.1'
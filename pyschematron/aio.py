@@ -0,0 +1,344 @@
+"""
+An asyncio interface for validation.
+
+Validating a large document can take seconds, during which an event loop that calls
+Schema.validate_document() directly cannot do anything else. An AsyncValidator parses and
+validates documents in an executor instead: a thread pool of its own, any other thread pool,
+or a ProcessPoolExecutor.
+
+- At most max_in_flight documents are parsed and validated at the same time. The other calls
+  wait for a free slot before anything is done with their documents, so a burst of requests
+  does not fill the memory with parsed documents.
+- When the task that awaits a validation is cancelled, the validation stops at the next
+  pattern or rule (see ValidationContext.check_cancelled()), and its slot is freed once it
+  has stopped. The xslt engine validates a document in a single transformation, so it can
+  only be stopped before it starts.
+- validate_many() is an async iterator of the results (batch.DocumentResult objects) of any
+  number of documents.
+
+In a process pool, every worker process reads and compiles the schema the first time it
+gets a document for it (see batch.get_worker_schema()). A report refers to the elements of
+its document, which cannot be passed between processes: for validate_document(), the worker
+passes the calls to its report back (see parallel.RecordingReport), and they are replayed on
+a report for the document as parsed in this process, in the same slot. A validation in a worker process is
+cancelled through an Event of a multiprocessing manager, that the worker polls at most every
+CANCELLATION_POLL_INTERVAL seconds.
+"""
+import asyncio
+import multiprocessing
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from lxml import etree
+
+from pyschematron.batch import get_schema_source, get_worker_schema, validate_file
+from pyschematron.parallel import RecordingReport, get_nodes, replay
+from pyschematron.validation import ValidationReport
+
+# The number of documents per CPU that are validated at the same time, if max_in_flight is not given
+DEFAULT_DOCUMENTS_PER_CPU = 2
+# The minimum time in seconds between two checks for cancellation in a worker process
+CANCELLATION_POLL_INTERVAL = 0.05
+
+# The compiled schemas of a worker process, by the result of batch.get_schema_source()
+_worker_schemas = {}
+
+
+def parse_document(source):
+    """
+    Returns the parsed document for the given source
+    :param source: An ElementTree (returned as it is), the content of a document (bytes), or a file name
+    :return: an ElementTree
+    :raises etree.XMLSyntaxError: if the document is not well-formed
+    """
+    if isinstance(source, etree._ElementTree):
+        return source
+    if isinstance(source, bytes):
+        return etree.fromstring(source).getroottree()
+    return etree.parse(source)
+
+
+def _validate(compiled_schema, source, engine, svrl, cancellation):
+    xml_doc = parse_document(source)
+    schema = compiled_schema.schema
+    if svrl:
+        return schema.validate_document_to_svrl(xml_doc, compiled_schema=compiled_schema, engine=engine,
+                                                cancellation=cancellation)
+    return schema.validate_document(xml_doc, compiled_schema=compiled_schema, engine=engine,
+                                    cancellation=cancellation)
+
+
+class PollingCancellation(object):
+    """
+    Checks a cancellation Event of a multiprocessing manager at most every interval seconds,
+    so that the validation does not wait for the manager at every rule. If the manager cannot
+    be reached any more, the validation is cancelled.
+    """
+
+    def __init__(self, event, interval=CANCELLATION_POLL_INTERVAL):
+        self.event = event
+        self.interval = interval
+        self.last_check = time.monotonic()
+        self.cancelled = False
+
+    def is_set(self):
+        now = time.monotonic()
+        if not self.cancelled and now - self.last_check >= self.interval:
+            self.last_check = now
+            try:
+                self.cancelled = self.event.is_set()
+            except (OSError, EOFError):
+                self.cancelled = True
+        return self.cancelled
+
+
+def _get_worker_schema(schema_source):
+    compiled_schema = _worker_schemas.get(schema_source)
+    if compiled_schema is None:
+        compiled_schema = _worker_schemas[schema_source] = get_worker_schema(None, *schema_source)
+    return compiled_schema
+
+
+def _validate_in_worker(schema_source, source, base_url, engine, svrl, event):
+    compiled_schema = _get_worker_schema(schema_source)
+    if isinstance(source, bytes):
+        xml_doc = etree.fromstring(source, base_url=base_url).getroottree()
+    else:
+        xml_doc = etree.parse(source)
+    schema = compiled_schema.schema
+    cancellation = PollingCancellation(event)
+    if svrl:
+        return schema.validate_document_to_svrl(xml_doc, compiled_schema=compiled_schema, engine=engine,
+                                                cancellation=cancellation)
+    node_positions = {node: position for position, node in enumerate(get_nodes(xml_doc))}
+    report = RecordingReport(compiled_schema, node_positions)
+    schema._run_engine(compiled_schema, xml_doc, report, engine, None, cancellation=cancellation)
+    return report.calls
+
+
+def _validate_file_in_worker(schema_source, path, engine, document, event):
+    return validate_file(_get_worker_schema(schema_source), path, engine, document, PollingCancellation(event))
+
+
+async def _iter_sources(sources):
+    """
+    Yields the sources of validate_many() as tuples of a name and the content (or None), from an
+    iterable or an async iterable
+    """
+    if hasattr(sources, '__aiter__'):
+        async for source in sources:
+            yield source if isinstance(source, tuple) else (source, None)
+    else:
+        for source in sources:
+            yield source if isinstance(source, tuple) else (source, None)
+
+
+class AsyncValidator(object):
+    """
+    Validates documents against a compiled schema in an executor, for use in asyncio code (see
+    the description of this module). Use it as an async context manager, or call close().
+    """
+
+    def __init__(self, schema, phase="#DEFAULT", compiled_schema=None, engine=None, executor=None,
+                 max_in_flight=None):
+        """
+        :param schema: The Schema to validate against
+        :param phase: The phase to validate (ignored if compiled_schema is given)
+        :param compiled_schema: The result of an earlier call to schema.compile()
+        :param engine: The name of the validation engine to use, see pyschematron.engines
+        :param executor: A concurrent.futures executor (a ThreadPoolExecutor or a ProcessPoolExecutor); if None,
+                         a thread pool of max_in_flight threads, that is shut down by close()
+        :param max_in_flight: The maximum number of documents that are parsed and validated at the same time,
+                              DEFAULT_DOCUMENTS_PER_CPU per CPU if None
+        """
+        self.compiled_schema = schema._get_compiled_schema(phase, compiled_schema)
+        self.engine = engine
+        if max_in_flight is None:
+            max_in_flight = DEFAULT_DOCUMENTS_PER_CPU * (os.cpu_count() or 1)
+        self.max_in_flight = max_in_flight
+        self.own_executor = executor is None
+        self.executor = executor if executor is not None else ThreadPoolExecutor(max_in_flight)
+        self.in_processes = isinstance(self.executor, ProcessPoolExecutor)
+        self.schema_source = get_schema_source(self.compiled_schema) if self.in_processes else None
+        self.manager = None
+        self.slots = asyncio.Semaphore(max_in_flight)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        """
+        Shuts down the executor (if it was created by this validator) and the multiprocessing manager
+        """
+        if self.own_executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+        if self.manager is not None:
+            self.manager.shutdown()
+            self.manager = None
+
+    def create_cancellation(self):
+        if not self.in_processes:
+            return threading.Event()
+        if self.manager is None:
+            self.manager = multiprocessing.Manager()
+        return self.manager.Event()
+
+    async def run(self, function, *args, then=None):
+        """
+        Runs function(*args, cancellation) in the executor, in a slot that the caller has acquired.
+        If then is given, then(result) is run afterwards in a thread of the event loop's default
+        executor, in the same slot; it cannot be interrupted. The slot is released when both have
+        returned. If the calling task is cancelled, the function is cancelled too.
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            cancellation = self.create_cancellation()
+            future = self.executor.submit(function, *args, cancellation)
+        except BaseException:
+            self.slots.release()
+            raise
+        # The last step, which has to stop before the slot is released
+        pending = future
+        try:
+            result = await asyncio.wrap_future(future)
+            if then is not None:
+                pending = loop.run_in_executor(None, then, result)
+                result = await asyncio.shield(pending)
+            return result
+        except asyncio.CancelledError:
+            future.cancel()
+            cancellation.set()
+            raise
+        finally:
+            if pending.done():
+                self.slots.release()
+            else:
+                pending.add_done_callback(lambda _: self.release_slot(loop))
+
+    def create_task(self, function, *args):
+        """
+        Returns a task that runs function(*args, cancellation) in a slot that the caller has acquired.
+        A task that is cancelled before it starts never gets to run(), so its slot is released here.
+        """
+        started = []
+
+        async def run_in_slot():
+            started.append(True)
+            return await self.run(function, *args)
+
+        task = asyncio.ensure_future(run_in_slot())
+        task.add_done_callback(lambda _: started or self.slots.release())
+        return task
+
+    def release_slot(self, loop):
+        # Called in the thread that ran the function, or in the event loop
+        try:
+            loop.call_soon_threadsafe(self.slots.release)
+        except RuntimeError:
+            # The event loop has been closed
+            pass
+
+    async def validate_document(self, source):
+        """
+        Parses and validates a document in the executor; the async counterpart of
+        Schema.validate_document()
+        :param source: An ElementTree, the content of a document (bytes), or a file name
+        :return: a ValidationReport
+        :raises etree.XMLSyntaxError: if the document is not well-formed
+        :raises SchematronError: if the document cannot be validated
+        """
+        await self.slots.acquire()
+        if not self.in_processes:
+            return await self.run(_validate, self.compiled_schema, source, self.engine, False)
+        # Replay the results on the document as parsed in this process, outside the event loop
+        return await self.run(_validate_in_worker, self.schema_source, *await self.get_worker_source(source),
+                              self.engine, False, then=lambda calls: self.replay(calls, source))
+
+    async def validate_document_to_svrl(self, source):
+        """
+        Parses and validates a document in the executor; the async counterpart of
+        Schema.validate_document_to_svrl()
+        :param source: An ElementTree, the content of a document (bytes), or a file name
+        :return: a SchematronOutput object
+        :raises etree.XMLSyntaxError: if the document is not well-formed
+        :raises SchematronError: if the document cannot be validated
+        """
+        await self.slots.acquire()
+        if not self.in_processes:
+            return await self.run(_validate, self.compiled_schema, source, self.engine, True)
+        return await self.run(_validate_in_worker, self.schema_source, *await self.get_worker_source(source),
+                              self.engine, True)
+
+    async def get_worker_source(self, source):
+        """
+        Returns the document and its base URL for a worker process: parsed documents are serialized
+        (outside the event loop)
+        """
+        if isinstance(source, etree._ElementTree):
+            loop = asyncio.get_running_loop()
+            try:
+                return await loop.run_in_executor(None, etree.tostring, source), source.docinfo.URL
+            except BaseException:
+                self.slots.release()
+                raise
+        if not isinstance(source, bytes):
+            source = os.fspath(source)
+        return source, None
+
+    def replay(self, calls, source):
+        xml_doc = parse_document(source)
+        report = ValidationReport()
+        replay(calls, self.compiled_schema, get_nodes(xml_doc), report)
+        return report
+
+    async def validate_many(self, sources, ordered=True):
+        """
+        Validates any number of documents; an async iterator of their results. Documents that cannot be
+        read or parsed result in a DocumentResult with an exception. If the iteration is stopped
+        early, the remaining validations are cancelled.
+        :param sources: An iterable or async iterable of file names, or tuples of a name and the content of
+                        the document (bytes)
+        :param ordered: If True, the results are returned in the order of the sources, otherwise as soon as
+                        they are done
+        :return: an async iterator of batch.DocumentResult objects
+        """
+        if self.in_processes:
+            function, arguments = _validate_file_in_worker, (self.schema_source,)
+        else:
+            function, arguments = validate_file, (self.compiled_schema,)
+        tasks = deque()
+        try:
+            async for name, document in _iter_sources(sources):
+                await self.slots.acquire()
+                tasks.append(self.create_task(function, *arguments, name, self.engine, document))
+                for task in get_done_tasks(tasks, ordered):
+                    yield task.result()
+            while tasks:
+                await asyncio.wait([tasks[0]] if ordered else tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in get_done_tasks(tasks, ordered):
+                    yield task.result()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+
+def get_done_tasks(tasks, ordered):
+    """
+    Removes the tasks that are done from the given deque, and returns them; if ordered is True,
+    only those before the first task that is not done yet
+    """
+    done = []
+    if ordered:
+        while tasks and tasks[0].done():
+            done.append(tasks.popleft())
+    else:
+        done = [task for task in tasks if task.done()]
+        for task in done:
+            tasks.remove(task)
+    return done
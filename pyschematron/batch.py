@@ -0,0 +1,185 @@
+"""
+Validation of many documents at once, in a pool of worker processes.
+
+The schema is compiled once, in the calling process. Where the 'fork' start method is
+available, the workers inherit the compiled schema from it; otherwise every worker reads and
+compiles the schema once, when it starts. The documents are parsed and validated in the
+workers, and only the results (DocumentResult objects, which hold plain values) are passed
+back.
+
+At most a few documents per worker are submitted ahead of the results that have been
+collected, so any number of documents can be validated with a fixed amount of memory.
+"""
+import multiprocessing
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+from lxml import etree
+
+from pyschematron.util import expand_paths
+from pyschematron.validation import resolve_messages
+
+# The number of documents per worker that are submitted to the pool before their results are collected
+PENDING_DOCUMENTS_PER_WORKER = 4
+
+# The compiled schema of a worker process, see _init_worker()
+_worker_compiled_schema = None
+
+
+class DocumentResult(object):
+    """
+    The result of the validation of a single document: its path, and lists of the errors and
+    warnings (validation.ValidationMessage objects). If the document could not be read or
+    parsed, 'exception' holds the error message, and the lists are empty.
+    """
+
+    def __init__(self, path, errors=(), warnings=(), exception=None):
+        self.path = path
+        self.errors = list(errors)
+        self.warnings = list(warnings)
+        self.exception = exception
+
+    def get_result_code(self):
+        """
+        Returns the result code of the validate command: -1 if there are errors (or the document
+        could not be read), 1 if there are only warnings, 0 otherwise
+        """
+        if self.exception is not None or self.errors:
+            return -1
+        if self.warnings:
+            return 1
+        return 0
+
+    def __repr__(self):
+        return "%s(%r, %d errors, %d warnings)" % (self.__class__.__name__, self.path, len(self.errors),
+                                                   len(self.warnings))
+
+
+def validate_file(compiled_schema, path, engine=None, document=None, cancellation=None):
+    """
+    Parses and validates a single document
+    :param path: The file name of the document
+    :param document: The content of the document (bytes), read from the file if not given
+    :param cancellation: Stops the validation when it is set, see Schema.validate_document()
+    :return: a DocumentResult
+    """
+    try:
+        if document is None:
+            xml_doc = etree.parse(path)
+        else:
+            xml_doc = etree.fromstring(document, base_url=path).getroottree()
+    except (etree.XMLSyntaxError, OSError) as error:
+        return DocumentResult(path, exception=str(error))
+    schema = compiled_schema.schema
+    report = schema.validate_document(xml_doc, compiled_schema=compiled_schema, engine=engine,
+                                      cancellation=cancellation)
+    errors, warnings = report.get_errors_and_warnings()
+    return DocumentResult(path, resolve_messages(errors, xml_doc, schema.ns_prefixes),
+                          resolve_messages(warnings, xml_doc, schema.ns_prefixes))
+
+
+def get_multiprocessing_context():
+    """
+    Returns the multiprocessing context for worker pools: 'fork' where it is available, so that
+    the workers inherit the compiled schema
+    """
+    if 'fork' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('fork')
+    return multiprocessing.get_context()
+
+
+def get_schema_arguments(compiled_schema, mp_context):
+    """
+    Returns the arguments for get_worker_schema() in a worker process that is started with the
+    given multiprocessing context: the compiled schema itself for forked processes (their
+    arguments are not pickled), and otherwise what is needed to read and compile it again
+    """
+    if mp_context.get_start_method() == 'fork':
+        return compiled_schema,
+    return (None,) + get_schema_source(compiled_schema)
+
+
+def get_schema_source(compiled_schema):
+    """
+    Returns what a worker process needs to read and compile the given compiled schema again: a
+    tuple of the path of the schema file (or None), the minimal xml of the schema if it was not
+    read from a file (or None), the backend and the phase. The tuple can be pickled.
+    """
+    schema = compiled_schema.schema
+    if schema.file_path is not None:
+        return os.path.abspath(schema.file_path), None, schema.backend, compiled_schema.phase
+    return None, etree.tostring(schema.to_minimal_xml()), schema.backend, compiled_schema.phase
+
+
+def get_worker_schema(compiled_schema, schema_file=None, schema_xml=None, backend=None, phase=None):
+    """
+    Returns the compiled schema for the result of get_schema_arguments()
+    """
+    if compiled_schema is None:
+        from pyschematron.elements import Schema
+        from pyschematron.schema_cache import load_schema
+
+        if schema_file is not None:
+            schema = load_schema(schema_file, backend=backend)
+        else:
+            schema = Schema(xml_element=etree.fromstring(schema_xml), backend=backend)
+        compiled_schema = schema.compile(phase)
+    return compiled_schema
+
+
+def _init_worker(*schema_arguments):
+    global _worker_compiled_schema
+    _worker_compiled_schema = get_worker_schema(*schema_arguments)
+
+
+def _validate_in_worker(path, engine):
+    return validate_file(_worker_compiled_schema, path, engine)
+
+
+def validate_many(compiled_schema, paths, workers=None, engine=None, ordered=True):
+    """
+    Validates the given documents in a pool of worker processes.
+    :param compiled_schema: The CompiledSchema to validate against
+    :param paths: An iterable of the file names of the documents
+    :param workers: The number of worker processes, the number of CPUs if None; with 1, the documents are
+                    validated in this process
+    :param engine: The name of the validation engine to use, see pyschematron.engines
+    :param ordered: If True, the results are returned in the order of the paths, otherwise in the order
+                    in which they are completed
+    :return: an iterator of DocumentResult objects
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers == 1:
+        for path in paths:
+            yield validate_file(compiled_schema, path, engine)
+        return
+
+    mp_context = get_multiprocessing_context()
+    executor = ProcessPoolExecutor(workers, mp_context=mp_context, initializer=_init_worker,
+                                   initargs=get_schema_arguments(compiled_schema, mp_context))
+    max_pending = workers * PENDING_DOCUMENTS_PER_WORKER
+    try:
+        if ordered:
+            pending = deque()
+            for path in paths:
+                pending.append(executor.submit(_validate_in_worker, path, engine))
+                if len(pending) >= max_pending:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        else:
+            pending = set()
+            for path in paths:
+                pending.add(executor.submit(_validate_in_worker, path, engine))
+                if len(pending) >= max_pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield future.result()
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,128 @@
+"""
+The client for the validation server (see pyschematron.server), used by
+pyschematron-validate --server <address>.
+
+This module only uses the standard library, so that the client starts quickly: the schema
+is read and compiled by the server. The address of the server is the path of its Unix
+socket (optionally prefixed with 'unix:'), or an http URL on the local host.
+"""
+import json
+import os
+import socket
+import sys
+from http.client import HTTPConnection
+from urllib.parse import urlencode, urlsplit
+
+from pyschematron.util import expand_paths
+
+# The header with the result code of a validation, see pyschematron.server
+RESULT_HEADER = "X-Validation-Result"
+
+
+class UnixHTTPConnection(HTTPConnection):
+    """
+    An HTTP connection over a Unix socket
+    """
+
+    def __init__(self, socket_path, timeout=None):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class ValidationClientError(Exception):
+    """
+    The server could not validate the document: the request was wrong, the document is not
+    well-formed or the schema could not be read
+    """
+    pass
+
+
+class ValidationClient(object):
+    """
+    Sends documents to the validation server; the connection is kept open for the next request
+    """
+
+    def __init__(self, address, timeout=None):
+        if address.startswith("http://"):
+            url = urlsplit(address)
+            self.connection = HTTPConnection(url.hostname, url.port or 80, timeout=timeout)
+        else:
+            if address.startswith("unix:"):
+                address = address[5:]
+            self.connection = UnixHTTPConnection(address, timeout=timeout)
+
+    def validate(self, schematron_file, document, file_name="-", base_url=None, phase="#DEFAULT", output_type="text",
+                 engine=None, verbosity=1):
+        """
+        Validates the given document
+        :param schematron_file: The path of the schema (relative paths are made absolute here)
+        :param document: The document (bytes)
+        :param file_name: The name of the document, for the text output
+        :param base_url: The base URL of the document
+        :param output_type: 'text', 'svrl' or 'json'
+        :return: a tuple of the result code and the output of the server
+        :raises ValidationClientError: if the server could not validate the document
+        """
+        arguments = {'schema': os.path.abspath(schematron_file), 'phase': phase, 'format': output_type,
+                     'file': file_name, 'verbosity': verbosity}
+        if base_url is not None:
+            arguments['base'] = base_url
+        if engine is not None:
+            arguments['engine'] = engine
+        self.connection.request("POST", "/validate?" + urlencode(arguments), document,
+                                {'Content-Type': "application/xml"})
+        response = self.connection.getresponse()
+        output = response.read().decode('utf-8')
+        if response.status != 200:
+            if output_type == 'json':
+                output = json.loads(output)['error']
+            raise ValidationClientError(output.strip())
+        return int(response.getheader(RESULT_HEADER, 0)), output
+
+    def get_status(self):
+        self.connection.request("GET", "/status")
+        return json.loads(self.connection.getresponse().read().decode('utf-8'))
+
+    def close(self):
+        self.connection.close()
+
+
+def main(server, schematron_file, xml_files, phase="#DEFAULT", output_type="text", output_stream=sys.stdout,
+         verbosity=1, engine=None, batch=False):
+    """
+    Validates the given files with the validation server at the given address; the output is
+    the same as that of pyschematron.commands.validate.main() (or main_many() if batch is True)
+    :return: -1 if any file has errors (or cannot be validated), 1 if any file has warnings, 0 otherwise
+    """
+    client = ValidationClient(server)
+    result = 0
+    file_count = 0
+    try:
+        for xml_file in expand_paths(xml_files):
+            file_count += 1
+            # Errors in a single file are reported like main_many() does, but not errors in the
+            # connection to the server
+            try:
+                with open(xml_file, 'rb') as document:
+                    document = document.read()
+                file_result, output = client.validate(schematron_file, document, xml_file, os.path.abspath(xml_file),
+                                                      phase, output_type, engine, verbosity)
+            except (FileNotFoundError, IsADirectoryError, PermissionError, ValidationClientError) as error:
+                if not batch:
+                    raise
+                file_result = -1
+                output = "Error: %s\nFile: %s\n" % (error, xml_file) if verbosity > 0 else ""
+            output_stream.write(output)
+            if file_result == -1 or result == 0:
+                result = file_result
+    finally:
+        client.close()
+    if batch and verbosity > 0:
+        output_stream.write("%d files validated\n" % file_count)
+    return result
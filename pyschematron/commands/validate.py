@@ -1,19 +1,30 @@
 import sys
 
 from lxml import etree
-from pyschematron.elements import Schema
+from pyschematron.elements import DEFAULT_BACKEND
+from pyschematron.schema_cache import load_schema
+from pyschematron.sharding import ShardedValidator
+from pyschematron.streaming import StreamingValidator
+from pyschematron.util import expand_paths
+from pyschematron.validation import resolve_messages
 
 
-def main(schematron_file, xml_file, phase="#DEFAULT", output_type="text", output_stream=sys.stdout, verbosity=1):
-    schema = Schema(verbosity=verbosity)
-    schema.read_from_file(schematron_file)
-    schema.process_abstract_patterns()
+def main(schematron_file, xml_file, phase="#DEFAULT", output_type="text", output_stream=sys.stdout, verbosity=1, engine=None,
+         backend=DEFAULT_BACKEND, explain=False, stream=False, workers=None, record_path=None):
+    schema = load_schema(schematron_file, verbosity, backend)
+    if explain:
+        for line in schema.compile(phase).explain():
+            sys.stderr.write("%s\n" % line)
+    if stream:
+        return validate_stream(schema, xml_file, phase, output_type, output_stream, verbosity, explain)
+    if record_path is not None:
+        return validate_sharded(schema, xml_file, record_path, phase, output_stream, verbosity, workers, explain)
 
     doc = etree.parse(xml_file)
     if output_type == 'text':
-        return validate_to_text(schema, doc, xml_file, phase, output_stream, verbosity)
+        return validate_to_text(schema, doc, xml_file, phase, output_stream, verbosity, engine, workers)
     elif output_type == 'svrl':
-        svrl = schema.validate_document_to_svrl(doc, phase)
+        svrl = schema.validate_document_to_svrl(doc, phase, engine=engine, workers=workers)
         output_stream.write(etree.tostring(svrl.to_xml(), pretty_print=True, xml_declaration=True, encoding='utf-8').decode('utf-8'))
         output_stream.write("\n")
         return 0
@@ -21,43 +32,157 @@ def main(schematron_file, xml_file, phase="#DEFAULT", output_type="text", output
         raise Exception("Unknown output type: %s" % output_type)
 
 
-def validate_to_text(schema, doc, xml_file, phase="#DEFAULT", output_stream=sys.stdout, verbosity=1):
-    report = schema.validate_document(doc, phase=phase)
-    # Split up the failed asserts by flag; assert with flag
-    # 'warning' are considered warnings, asserts with any
-    # other flag are considered errors
-    failed_asserts = report.get_failed_asserts_by_flag()
-    warnings = failed_asserts.pop('warning', [])
-    errors = []
-    for error_list in failed_asserts.values():
-        errors.extend(error_list)
+def main_many(schematron_file, xml_files, phase="#DEFAULT", output_stream=sys.stdout, verbosity=1, engine=None,
+              backend=DEFAULT_BACKEND, workers=None, ordered=True):
+    """
+    Validates any number of files, directories (all .xml files in them) and glob patterns, in a
+    pool of worker processes; the results are written per file, like main() does for one file
+    :return: -1 if any file has errors (or cannot be read), 1 if any file has warnings, 0 otherwise
+    """
+    schema = load_schema(schematron_file, verbosity, backend)
+    compiled_schema = schema.compile(phase)
 
+    result = 0
+    file_count = 0
+    for document_result in schema.validate_many(expand_paths(xml_files), workers, compiled_schema=compiled_schema,
+                                                engine=engine, ordered=ordered):
+        file_count += 1
+        if document_result.exception is not None:
+            if verbosity > 0:
+                output_stream.write("Error: %s\n" % document_result.exception)
+                output_stream.write("File: %s\n" % document_result.path)
+        else:
+            write_messages(document_result.errors, document_result.warnings, output_stream, verbosity)
+            write_summary(document_result.path, len(document_result.errors), len(document_result.warnings),
+                          output_stream, verbosity)
+        result_code = document_result.get_result_code()
+        if result_code == -1 or result == 0:
+            result = result_code
     if verbosity > 0:
-        for error, element in errors:
-            # output_stream.write("Error: %s\n" % error.text)
-            output_stream.write("Error: %s\n" % error.to_string(resolve=True, xml_doc=doc, current_element=element, namespaces=schema.ns_prefixes))
-            for d_id in error.diagnostic_ids:
-                if d_id in error.get_schema().diagnostics:
-                    output_stream.write("Proposal for solution: %s\n" % error.get_schema().diagnostics[d_id].text)
-        for warning, element in warnings:
-            # output_stream.write("Warning: %s\n" % warning.text)
-            output_stream.write("Warning: %s\n" % warning.to_string(resolve=True, xml_doc=doc, current_element=element, namespaces=schema.ns_prefixes))
-
-            for d_id in warning.diagnostic_ids:
-                if d_id in warning.rule.pattern.schema.diagnostics:
-                    output_stream.write("Proposal for solution: %s\n" % warning.rule.pattern.schema.diagnostics[d_id].text)
+        output_stream.write("%d files validated\n" % file_count)
+    return result
 
+
+def validate_to_text(schema, doc, xml_file, phase="#DEFAULT", output_stream=sys.stdout, verbosity=1, engine=None,
+                     workers=None):
+    report = schema.validate_document(doc, phase=phase, engine=engine, workers=workers)
+    error_count, warning_count = write_report(schema, report, doc, output_stream, verbosity)
+    return write_summary(xml_file, error_count, warning_count, output_stream, verbosity)
+
+
+def validate_stream(schema, xml_file, phase="#DEFAULT", output_type="text", output_stream=sys.stdout, verbosity=1,
+                    explain=False):
+    """
+    Validates the given file record by record (see pyschematron.streaming); only the rules
+    that do not need the full document are run, the others are listed on stderr
+    """
+    compiled_schema = schema.compile(phase)
+    validator = StreamingValidator(compiled_schema)
+    write_skipped_rules(compiled_schema, validator.skipped_rules, "streaming", verbosity, explain)
+
+    if output_type == 'text':
+        error_count = 0
+        warning_count = 0
+        for record, report in validator.iter_reports(xml_file):
+            record_errors, record_warnings = write_report(schema, report, record.xml_doc, output_stream, verbosity)
+            error_count += record_errors
+            warning_count += record_warnings
+        result = write_summary(xml_file, error_count, warning_count, output_stream, verbosity)
+    elif output_type == 'svrl':
+        svrl = validator.validate_to_svrl(xml_file)
+        output_stream.write(etree.tostring(svrl.to_xml(), pretty_print=True, xml_declaration=True, encoding='utf-8').decode('utf-8'))
+        output_stream.write("\n")
+        result = 0
+    else:
+        raise Exception("Unknown output type: %s" % output_type)
+    write_root_rules(validator.root_rules, "streaming", verbosity)
+    return result
+
+
+def validate_sharded(schema, xml_file, record_path=None, phase="#DEFAULT", output_stream=sys.stdout, verbosity=1,
+                     workers=None, explain=False):
+    """
+    Validates the given file in shards of records, in a pool of worker processes (see
+    pyschematron.sharding); like in streaming mode, only the rules that do not need the full
+    document are run for the records, the others are only run on the skeleton of the document,
+    and are listed on stderr
+    """
+    compiled_schema = schema.compile(phase)
+    validator = ShardedValidator(compiled_schema, record_path, workers)
+    write_skipped_rules(compiled_schema, validator.skipped_rules, "sharded", verbosity, explain)
+    error_count = 0
+    warning_count = 0
+    for errors, warnings in validator.iter_results(xml_file):
+        write_messages(errors, warnings, output_stream, verbosity)
+        error_count += len(errors)
+        warning_count += len(warnings)
+    return write_summary(xml_file, error_count, warning_count, output_stream, verbosity)
+
+
+def write_skipped_rules(compiled_schema, skipped_rules, mode, verbosity=1, explain=False):
+    """
+    Writes the rules that are not run in the given mode ('streaming' or 'sharded') to stderr,
+    or the full classification of the rules if explain is True
+    """
+    if explain:
+        for line in compiled_schema.describe_streaming():
+            sys.stderr.write("%s\n" % line)
+    elif skipped_rules and verbosity > 0:
+        # In sharded mode, the rules are still run on the skeleton
+        description = "Not validated for the records" if mode == "sharded" else "Not validated"
+        for rule in skipped_rules:
+            sys.stderr.write("%s in %s mode: rule %s (needs the full document: %s)\n" %
+                             (description, mode, rule.context_text, rule.full_document_reason))
+
+
+def write_root_rules(root_rules, mode, verbosity=1):
+    if verbosity > 0:
+        for rule in root_rules:
+            sys.stderr.write("Not validated in %s mode: rule %s for the root element\n" % (mode, rule.context_text))
+
+
+def write_report(schema, report, doc, output_stream=sys.stdout, verbosity=1):
+    """
+    Writes the errors and warnings in the given report
+    :return: a tuple of the numbers of errors and warnings
+    """
+    # Asserts with flag 'warning' are considered warnings, asserts
+    # with any other flag are considered errors
+    errors, warnings = report.get_errors_and_warnings()
+    if verbosity > 0:
+        write_messages(resolve_messages(errors, doc, schema.ns_prefixes),
+                       resolve_messages(warnings, doc, schema.ns_prefixes), output_stream, verbosity)
+    return len(errors), len(warnings)
+
+
+def write_messages(errors, warnings, output_stream=sys.stdout, verbosity=1):
+    if verbosity > 0:
+        for error in errors:
+            output_stream.write("Error: %s\n" % error.text)
+            for diagnostic in error.diagnostics:
+                output_stream.write("Proposal for solution: %s\n" % diagnostic)
+        for warning in warnings:
+            output_stream.write("Warning: %s\n" % warning.text)
+            for diagnostic in warning.diagnostics:
+                output_stream.write("Proposal for solution: %s\n" % diagnostic)
+
+
+def write_summary(xml_file, error_count, warning_count, output_stream=sys.stdout, verbosity=1):
+    """
+    Writes the number of errors and warnings
+    :return: the result code: -1 if there are errors, 1 if there are only warnings, 0 otherwise
+    """
     if verbosity > 0:
         output_stream.write("File: %s\n" % xml_file)
-    if len(errors) > 0:
+    if error_count > 0:
         if verbosity > 0:
-            output_stream.write("%d errors in document\n" % len(errors))
+            output_stream.write("%d errors in document\n" % error_count)
         return -1
-    if len(warnings) > 0:
+    if warning_count > 0:
         if verbosity > 0:
-            output_stream.write("%d warnings in document\n" % len(warnings))
+            output_stream.write("%d warnings in document\n" % warning_count)
         return 1
-    if len(errors) == 0 and len(warnings) == 0:
+    if error_count == 0 and warning_count == 0:
         if verbosity > 0:
             output_stream.write("All tests passed, no errors or warnings\n")
         return 0
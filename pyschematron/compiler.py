@@ -0,0 +1,586 @@
+"""
+Ahead-of-time compilation of a Schema.
+
+Compiling a schema resolves the phase, abstract patterns, abstract rules and namespaces
+once, and parses every expression in it (rule contexts, tests, lets and the queries in
+assertion messages). The result is an immutable CompiledSchema that can be used to
+validate any number of documents, also by several threads at the same time.
+"""
+from collections import OrderedDict
+
+from elementpath.xpath_nodes import is_element_node
+
+from pyschematron.exceptions import SchematronError, SchematronNotImplementedError
+from pyschematron.elementpath_extensions.context import get_key_value
+from pyschematron.query_bindings.analysis import uses_symbols, get_variable_references, is_context_free, \
+    is_document_independent, is_subtree_local, to_source, can_select_non_elements
+
+# The name of the variable that holds the context nodes of a rule, in bulk assertion tests
+BULK_NODES_VARIABLE = "pyschematron-context-nodes"
+
+
+class CompiledObject(object):
+    """
+    Base class for the objects that make up a compiled schema.
+    These objects cannot be modified once they have been created.
+    """
+    _frozen = False
+
+    def _freeze(self):
+        object.__setattr__(self, '_frozen', True)
+
+    def __setattr__(self, name, value):
+        if self._frozen:
+            raise SchematronError("Compiled schema objects are immutable")
+        super().__setattr__(name, value)
+
+    def __delattr__(self, name):
+        if self._frozen:
+            raise SchematronError("Compiled schema objects are immutable")
+        super().__delattr__(name)
+
+
+class CompiledVariable(CompiledObject):
+    """
+    A let statement: the variable name, its original value text, and its compiled expression.
+    'dependencies' holds the names of the variables in scope that the expression refers to.
+
+    If the value does not depend on the document (or on the context node), 'constant_key' is
+    a tuple that identifies the value within the schema: the name and value text of the let
+    statement and of everything it depends on. Such values are computed once per Schema.
+    Otherwise 'constant_key' is None.
+
+    For rule variables, 'context_dependent' is True if the value depends on the context node
+    of the rule (directly, or through another variable of the rule); the other rule variables
+    have the same value for all the context nodes.
+
+    'streamable' is True if the value can be computed without the full document (see
+    streaming.py): it depends on nothing but the subtree of the context node (for rule
+    variables that are evaluated per context node) or not on the document at all (for the
+    others), and the same goes for everything it refers to.
+    """
+
+    def __init__(self, name, value, expression, dependencies=(), constant_key=None, context_dependent=False,
+                 streamable=False):
+        self.name = name
+        self.value = value
+        self.expression = expression
+        self.dependencies = tuple(dependencies)
+        self.constant_key = constant_key
+        self.context_dependent = context_dependent
+        self.streamable = streamable
+        self._freeze()
+
+    def evaluate(self, xml_doc, context_item, variables, document_index=None):
+        return self.expression.evaluate(xml_doc, context_item, variables, document_index)
+
+
+class CompiledKey(CompiledObject):
+    """
+    A key declaration (xsl:key): the compiled pattern of the nodes it indexes, and the
+    compiled expression of the value they are indexed by
+    """
+
+    def __init__(self, name, match, use, query_binding):
+        self.name = name
+        self.match = match
+        self.use = use
+        self.query_binding = query_binding
+        self._freeze()
+
+    def build_index(self, xml_doc, document_index=None):
+        """
+        Returns the index of this key for the given document
+        :return: a dict of the values of the key to the lists of nodes that have them, in document order
+        """
+        index = {}
+        for node in self.query_binding.select_context_elements(xml_doc, self.match, {}, document_index):
+            result = self.use.evaluate(xml_doc, node, {}, document_index)
+            if not isinstance(result, list):
+                result = [result]
+            for value in set(get_key_value(item) for item in result):
+                index.setdefault(value, []).append(node)
+        return index
+
+
+class CompiledText(CompiledObject):
+    """
+    The message of an assertion or report.
+    Static parts are stored as strings, dynamic parts (<name>, <value-of>) as a tuple of the
+    original text element and the compiled query.
+    """
+
+    def __init__(self, parts):
+        self.parts = tuple(parts)
+        self.is_static = all(isinstance(part, str) for part in self.parts)
+        self._freeze()
+
+    def resolve(self, xml_doc, element, document_index=None):
+        """
+        Returns the message text, with the dynamic parts evaluated for the given element
+        """
+        result = []
+        for part in self.parts:
+            if isinstance(part, str):
+                result.append(part)
+            else:
+                text_element, expression = part
+                result.append(text_element.format_result(expression.evaluate(xml_doc, element, {}, document_index)))
+        return "".join(result)
+
+
+class CompiledTest(CompiledObject):
+    """
+    An assertion or report, with its test and message compiled.
+    'source' is the original Assertion or Report object from the schema.
+
+    If the test does not depend on the individual context node other than as the context
+    item, 'bulk_test' holds an expression that evaluates it for all the context nodes of
+    the rule at once: it returns the nodes for which an assertion fails, or a report is
+    triggered (the nodes are passed in the variable BULK_NODES_VARIABLE).
+    Otherwise 'bulk_test' is None.
+    """
+
+    def __init__(self, source, test, message, bulk_test=None):
+        self.source = source
+        self.test = test
+        self.message = message
+        self.bulk_test = bulk_test
+        self._freeze()
+
+    def evaluate(self, xml_doc, element, variables, document_index=None):
+        return self.test.evaluate(xml_doc, element, variables, document_index)
+
+
+class CompiledRule(CompiledObject):
+    """
+    A rule, with its context, variables, assertions and reports compiled.
+    The variables are split up in the ones that are evaluated once for the rule
+    ('rule_variables') and the ones that are evaluated for every context node
+    ('node_variables'), see CompiledVariable.context_dependent.
+
+    For streaming validation (see streaming.py), 'streamable_context' is True if the context
+    can be matched against the nodes of a single record of the document, and
+    'full_document_reason' describes why the rule cannot be validated record by record, or
+    is None if it can.
+    """
+
+    def __init__(self, source, context, variables, assertions, reports, streamable_context=False,
+                 full_document_reason="not classified"):
+        self.source = source
+        self.context = context
+        self.variables = tuple(variables)
+        self.rule_variables = tuple(variable for variable in self.variables if not variable.context_dependent)
+        self.node_variables = tuple(variable for variable in self.variables if variable.context_dependent)
+        self.assertions = tuple(assertions)
+        self.reports = tuple(reports)
+        self.streamable_context = streamable_context
+        self.full_document_reason = full_document_reason
+        self._freeze()
+
+    @property
+    def id(self):
+        return self.source.id
+
+    @property
+    def streamable(self):
+        return self.full_document_reason is None
+
+    @property
+    def context_text(self):
+        return self.source.context
+
+
+def get_node_key(node):
+    """
+    Returns the dispatch key of a document node: a tuple of its kind and expanded name.
+    The document node itself is represented by None.
+    """
+    if node is None:
+        return 'document', None
+    elif is_element_node(node):
+        return 'element', node.tag
+    return None, None
+
+
+def get_rule_keys(rule):
+    """
+    Returns the dispatch keys of the nodes that the given rule can match, based on the last
+    step of (every alternative of) its context, or None if that cannot be determined
+    """
+    if rule.context_text == '/':
+        return [('document', None)]
+    pattern = rule.context.get_match_pattern()
+    if pattern is None:
+        return None
+    keys = []
+    for alternative in pattern.alternatives:
+        name = alternative.last_step.name
+        if name is None:
+            return None
+        keys.append(('element', name))
+    return keys
+
+
+class RuleDispatchIndex(CompiledObject):
+    """
+    Indexes the rules of a pattern by the kind and expanded name of the nodes they can match.
+    Rules for which these are not known (wildcards, or contexts that are not patterns) are
+    candidates for every node. The candidates for a node are kept in the order of the rules
+    in the pattern, so that the first one that matches is still the one that fires.
+    """
+
+    def __init__(self, rules):
+        named = OrderedDict()
+        wildcard = []
+        for position, rule in enumerate(rules):
+            keys = get_rule_keys(rule)
+            if keys is None:
+                wildcard.append(position)
+            else:
+                for key in keys:
+                    named.setdefault(key, set()).add(position)
+        self.wildcard_rules = tuple(rules[position] for position in wildcard)
+        self.candidates = {key: tuple(rules[position] for position in sorted(positions.union(wildcard)))
+                           for key, positions in named.items()}
+        self._freeze()
+
+    def get_candidate_rules(self, node):
+        """
+        Returns the rules that could match the given node, in order
+        """
+        return self.candidates.get(get_node_key(node), self.wildcard_rules)
+
+
+class CompiledPattern(CompiledObject):
+    def __init__(self, source, variables, rules):
+        self.source = source
+        self.variables = tuple(variables)
+        self.rules = tuple(rules)
+        self.dispatch_index = RuleDispatchIndex(self.rules)
+        self._freeze()
+
+    @property
+    def id(self):
+        return self.source.id
+
+
+class CompiledSchema(CompiledObject):
+    """
+    The result of Schema.compile(): the active patterns of one phase, with all expressions parsed.
+
+    Use it with Schema.validate_document(xml_doc, compiled_schema=...) (or the shorthand methods
+    on this class) to validate documents without preparing the schema again.
+    """
+
+    def __init__(self, schema, phase, namespaces, variables, patterns, keys=(), phase_variables=()):
+        self.schema = schema
+        self.phase = phase
+        self.query_binding = schema.query_binding
+        self.namespaces = namespaces
+        # The let statements of the schema and of the phase, and both
+        self.schema_variables = tuple(variables)
+        self.phase_variables = tuple(phase_variables)
+        self.variables = self.schema_variables + self.phase_variables
+        self.patterns = tuple(patterns)
+        self.keys = OrderedDict((key.name, key) for key in keys)
+        self._freeze()
+
+    def validate_document(self, xml_doc, engine=None):
+        return self.schema.validate_document(xml_doc, compiled_schema=self, engine=engine)
+
+    def iter_expressions(self):
+        """
+        Yields a description of the place of every compiled expression in the schema, and the
+        expression itself
+        """
+        for variable in self.variables:
+            yield "let %s" % variable.name, variable.expression
+        for key in self.keys.values():
+            yield "key %s match" % key.name, key.match
+            yield "key %s use" % key.name, key.use
+        for pattern in self.patterns:
+            for variable in pattern.variables:
+                yield "pattern %s let %s" % (pattern.id, variable.name), variable.expression
+            for rule in pattern.rules:
+                prefix = "pattern %s rule %s" % (pattern.id, rule.context_text)
+                yield "%s context" % prefix, rule.context
+                for variable in rule.variables:
+                    yield "%s let %s" % (prefix, variable.name), variable.expression
+                tests = [("assert", test) for test in rule.assertions] + [("report", test) for test in rule.reports]
+                for kind, rule_test in tests:
+                    test_prefix = "%s %s %s" % (prefix, kind, rule_test.source.id or rule_test.source.test)
+                    yield test_prefix, rule_test.test
+                    if rule_test.bulk_test is not None:
+                        yield "%s (bulk)" % test_prefix, rule_test.bulk_test
+                    for part in rule_test.message.parts:
+                        if not isinstance(part, str):
+                            yield "%s message" % test_prefix, part[1]
+
+    def explain(self):
+        """
+        Returns a text that describes how the schema is evaluated: the optimizations that were
+        applied to its expressions, such as automatic join indexes
+        :return: a list of lines
+        """
+        result = []
+        for variable in self.variables:
+            if variable.constant_key is not None:
+                result.append("let %s: evaluated once per schema" % variable.name)
+        for pattern in self.patterns:
+            for variable in pattern.variables:
+                if variable.constant_key is not None:
+                    result.append("pattern %s let %s: evaluated once per schema" % (pattern.id, variable.name))
+        for place, expression in self.iter_expressions():
+            for description in expression.describe_rewrites():
+                result.append("%s: %s" % (place, description))
+        for pattern in self.patterns:
+            for rule in pattern.rules:
+                for rule_test in rule.assertions + rule.reports:
+                    if rule_test.bulk_test is not None:
+                        result.append("pattern %s rule %s: bulk evaluation of %s" %
+                                      (pattern.id, rule.context_text, rule_test.source.test))
+        return result
+
+    def describe_streaming(self):
+        """
+        Returns the classification of the rules for streaming validation: whether each rule can
+        be validated record by record, or needs the full document (and why)
+        :return: a list of lines
+        """
+        result = []
+        for pattern in self.patterns:
+            for rule in pattern.rules:
+                if rule.streamable:
+                    result.append("pattern %s rule %s: streamable" % (pattern.id, rule.context_text))
+                else:
+                    result.append("pattern %s rule %s: needs the full document (%s)" %
+                                  (pattern.id, rule.context_text, rule.full_document_reason))
+        return result
+
+    def validate_document_to_svrl(self, xml_doc, engine=None):
+        return self.schema.validate_document_to_svrl(xml_doc, compiled_schema=self, engine=engine)
+
+
+class SchemaCompiler(object):
+    """
+    Builds a CompiledSchema out of a Schema
+    """
+
+    def __init__(self, schema):
+        self.schema = schema
+        self.query_binding = schema.query_binding
+        # Use a copy, so later changes to the schema do not affect compiled expressions
+        self.namespaces = OrderedDict(schema.ns_prefixes)
+
+    def compile(self, phase="#DEFAULT"):
+        schema = self.schema
+        if not schema.abstract_patterns_processed:
+            schema.process_abstract_patterns()
+        if not schema.abstract_rules_processed:
+            schema.process_abstract_rules()
+
+        if phase == "#DEFAULT":
+            phase = schema.default_phase
+        patterns = schema.get_patterns_for_phase(phase)
+
+        scope = OrderedDict()
+        variables = self.compile_variables(schema.variables, scope)
+        phase_variables = []
+        if phase != "#ALL":
+            phase_variables = self.compile_variables(schema.get_phase(phase).variables, scope)
+
+        compiled_patterns = [self.compile_pattern(pattern, scope) for pattern in patterns]
+        keys = [self.compile_key(key) for key in schema.keys.values()]
+        compiled_schema = CompiledSchema(schema, phase, self.namespaces, variables, compiled_patterns, keys,
+                                         phase_variables)
+        for line in compiled_schema.explain():
+            schema.msg(3, line)
+        return compiled_schema
+
+    def compile_key(self, key):
+        # Like rule contexts, the match attribute of a key is a pattern
+        match = self.query_binding.compile_rule_context(key.match, self.namespaces, [])
+        use = self.query_binding.compile_key_use(key.use, self.namespaces)
+        return CompiledKey(key.name, match, use, self.query_binding)
+
+    def compile_variables(self, variables, scope, allow_redeclaration=False, rule_variables=False):
+        """
+        Compiles the given dict of let statements.
+        The variables are added to the scope (a dict of names and compiled variables), as each
+        variable can refer to the ones that were declared before it.
+        If rule_variables is True, the variables are classified by whether they depend on
+        the context node of the rule.
+        """
+        result = []
+        context_dependent_names = set()
+        for name, value in variables.items():
+            if name in scope and not allow_redeclaration:
+                raise SchematronError("Variable %s is declared multiple times within the same context" % name)
+            expression = self.query_binding.compile_let_statement(value, self.namespaces, scope)
+            references = get_variable_references(expression.root_token)
+            dependencies = [dependency for dependency in scope if dependency in references]
+            constant_key = None
+            if is_document_independent(expression.root_token) and len(dependencies) == len(references) and \
+                    all(scope[dependency].constant_key is not None for dependency in dependencies):
+                constant_key = (name, value) + tuple(scope[dependency].constant_key for dependency in dependencies)
+            root_token = expression.root_token
+            context_dependent = False
+            if rule_variables:
+                context_dependent = not is_context_free(root_token) or uses_symbols(root_token, ('current',)) or \
+                    bool(context_dependent_names.intersection(dependencies))
+                if context_dependent:
+                    context_dependent_names.add(name)
+            # Context dependent rule variables are evaluated for the context node, all the others
+            # for the document node
+            streamable = (is_subtree_local(root_token) if context_dependent else is_document_independent(root_token)) \
+                and len(dependencies) == len(references) and all(scope[dependency].streamable for dependency in dependencies)
+            variable = CompiledVariable(name, value, expression, dependencies, constant_key, context_dependent,
+                                        streamable)
+            result.append(variable)
+            scope[name] = variable
+        return result
+
+    def compile_pattern(self, pattern, scope):
+        scope = OrderedDict(scope)
+        variables = self.compile_variables(pattern.variables, scope)
+        rules = []
+        streamable_contexts = True
+        for rule in pattern.rules:
+            if not rule.abstract:
+                compiled_rule = self.compile_rule(rule, scope, streamable_contexts)
+                # A node that matches a rule cannot fire a later rule of the pattern, so the rules
+                # after one that cannot be matched within a record cannot be streamed either
+                streamable_contexts = compiled_rule.streamable_context
+                rules.append(compiled_rule)
+        return CompiledPattern(pattern, variables, rules)
+
+    def compile_rule(self, rule, scope, streamable_contexts=True):
+        context = self.query_binding.compile_rule_context(rule.context, self.namespaces, scope)
+        # The engines, reports and SVRL locations only handle elements and the document node
+        if rule.context != '/' and can_select_non_elements(context.root_token):
+            raise SchematronNotImplementedError("Rule contexts that select attributes, text or other nodes that are "
+                                                "not elements are not supported: %s" % rule.context)
+        context_reason = self.get_full_document_context_reason(rule.context, context, scope)
+        scope = OrderedDict(scope)
+        # Rule variables may overwrite earlier declarations
+        variables = self.compile_variables(rule.variables, scope, allow_redeclaration=True, rule_variables=True)
+        # Only the variables that are evaluated for every context node prevent bulk evaluation
+        rule_variable_names = set(variable.name for variable in variables if variable.context_dependent)
+        assertions = [self.compile_test(assertion, scope, rule_variable_names, True) for assertion in rule.assertions]
+        reports = [self.compile_test(report, scope, rule_variable_names, False) for report in rule.reports]
+
+        if not streamable_contexts:
+            full_document_reason = "an earlier rule of the pattern cannot be matched within a record"
+        elif context_reason is not None:
+            full_document_reason = context_reason
+        else:
+            full_document_reason = self.get_full_document_test_reason(assertions + reports, scope)
+        return CompiledRule(rule, context, variables, assertions, reports, streamable_contexts and context_reason is None,
+                            full_document_reason)
+
+    def get_full_document_context_reason(self, context_text, context, scope):
+        """
+        Returns why the given compiled rule context cannot be matched within a single record
+        of a document (see streaming.py), or None if it can.
+        It can if it is a pattern of which only the last step has predicates, and those only
+        depend on the subtree of the node and cannot be positional.
+        """
+        if context_text == '/':
+            return "the context is the document node"
+        pattern = context.get_match_pattern()
+        if pattern is None:
+            return "the context is not a pattern"
+        for alternative in pattern.alternatives:
+            if len(alternative.steps) == 1 and alternative.separators[0] == '/':
+                return "the context only matches the root element"
+            if any(step.predicates for step in alternative.steps[:-1]):
+                return "the context has predicates on the ancestors of the node"
+            for predicate in alternative.last_step.predicates:
+                if not is_subtree_local(predicate) or uses_symbols(predicate, ('position', 'last')) or \
+                        not is_boolean_predicate(predicate):
+                    return "the context predicate %s can be positional, or looks outside the subtree of the node" % \
+                           to_source(predicate)
+        return self.get_variables_reason(context.root_token, scope)
+
+    def get_full_document_test_reason(self, rule_tests, scope):
+        """
+        Returns why the given compiled assertions and reports cannot be evaluated with only the
+        subtree of the context node, or None if they can
+        """
+        for rule_test in rule_tests:
+            expressions = [rule_test.test] + [part[1] for part in rule_test.message.parts if not isinstance(part, str)]
+            for expression in expressions:
+                if not is_subtree_local(expression.root_token):
+                    return "%s looks outside the subtree of the context node" % expression.expression
+                reason = self.get_variables_reason(expression.root_token, scope)
+                if reason is not None:
+                    return reason
+        return None
+
+    @staticmethod
+    def get_variables_reason(token, scope):
+        for name in sorted(get_variable_references(token)):
+            if name not in scope or not scope[name].streamable:
+                return "variable %s needs the full document" % name
+        return None
+
+    def compile_test(self, rule_test, scope, rule_variable_names=(), is_assertion=True):
+        test = self.query_binding.compile_assertion(rule_test.test, self.namespaces, scope)
+        message = self.compile_text(rule_test)
+        bulk_test = None
+        if self.can_evaluate_in_bulk(test, message, rule_variable_names):
+            bulk_test = self.query_binding.compile_assertion_filter(rule_test.test, self.namespaces, scope,
+                                                                    BULK_NODES_VARIABLE, negate=is_assertion)
+        return CompiledTest(rule_test, test, message, bulk_test)
+
+    def can_evaluate_in_bulk(self, test, message, rule_variable_names):
+        """
+        Returns True if the given test can be evaluated for all context nodes at once:
+        it must not use current(), position() or last(), or refer to rule variables that
+        have a different value for every context node, and its message must not contain
+        queries.
+        """
+        if not message.is_static:
+            return False
+        if uses_symbols(test.root_token, ('current', 'position', 'last')):
+            return False
+        return not get_variable_references(test.root_token).intersection(rule_variable_names)
+
+    def compile_text(self, complex_text):
+        parts = []
+        for part in complex_text.parts:
+            if hasattr(part, 'get_query'):
+                expression = part.compile_query(self.query_binding, self.namespaces)
+                parts.append((part, expression))
+            else:
+                parts.append(part.to_string())
+        return CompiledText(parts)
+
+
+# The operators and functions that always return a boolean
+BOOLEAN_SYMBOLS = frozenset(['=', '!=', '<', '>', '<=', '>=', 'eq', 'ne', 'lt', 'gt', 'le', 'ge', 'is', '<<', '>>',
+                             'and', 'or', 'not', 'boolean', 'true', 'false', 'contains', 'starts-with', 'ends-with',
+                             'matches', 'exists', 'empty', 'some', 'every'])
+
+
+def is_boolean_predicate(token):
+    """
+    Returns True if the given predicate is a boolean or a node test, never a number (a number
+    would select the node by its position among its siblings)
+    """
+    if token.symbol in BOOLEAN_SYMBOLS or token.symbol in ('(name)', '@', '/', '//', '['):
+        return True
+    if token.symbol == ':':
+        return token[1].label != 'function'
+    return token.symbol == '*' and len(token) == 0
+
+
+def compile_schema(schema, phase="#DEFAULT"):
+    """
+    Compiles the given schema for the given phase
+    :param schema: The Schema to compile
+    :param phase: The phase to compile, #DEFAULT for the default phase of the schema, or #ALL
+    :return: a CompiledSchema
+    """
+    return SchemaCompiler(schema).compile(phase)
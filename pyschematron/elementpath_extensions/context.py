@@ -1,17 +1,232 @@
+from copy import copy
+
 from elementpath.xpath_context import XPathContext
+from elementpath.xpath_nodes import TypedElement, is_document_node, is_etree_element, is_element_node, \
+    is_attribute_node, is_text_node, etree_iter_strings
+
+from pyschematron.exceptions import SchematronQueryBindingError
+
+
+def get_key_value(item):
+    """
+    Returns the string value of a node or an atomic value, by which it is stored in and looked
+    up from the index of a key
+    """
+    if is_element_node(item):
+        return ''.join(etree_iter_strings(item))
+    elif is_attribute_node(item):
+        return str(item[1])
+    elif is_text_node(item):
+        return item[0]
+    elif isinstance(item, bool):
+        return 'true' if item else 'false'
+    elif isinstance(item, float) and item.is_integer():
+        return str(int(item))
+    return str(item)
+
+
+def select_key(self, context=None):
+    """
+    The select() method of the key() function token, which looks up the nodes in the DocumentIndex
+    of the dynamic context; shared by the XSLT parsers
+    """
+    if context is None:
+        self.missing_context()
+    document_index = getattr(context, 'document_index', None)
+    if document_index is None:
+        raise SchematronQueryBindingError("key() called in a context without a document index")
+    name = self.get_argument(context, required=True, cls=str)
+    values = [get_key_value(item) for item in self[1].select(copy(context))]
+    yield from document_index.get_key_nodes(name, values)
+
+
+class DocumentIndex(object):
+    """
+    Structural information about a single document: the parent of every node, its position
+    among its siblings, and its document order number.
+
+    elementpath rebuilds its parent map for every new dynamic context, so upward navigation
+    ('..', ancestor::, preceding-sibling::) costs a walk over the whole document for every
+    expression that is evaluated. A DocumentIndex is built once (on first use) for the whole
+    validation of a document, and shared by all the contexts that are created for it.
+
+    It also holds the hash indexes of the keys (xsl:key) of the schema, for the key() function;
+    keys maps the name of every key to its CompiledKey. The index of a key is built when it
+    is first used. The same goes for the automatic join indexes (see query_bindings.joins).
+    hoisted_values holds the memoized document constants (see query_bindings.hoisting).
+    """
+
+    def __init__(self, xml_document, keys=None):
+        self.xml_document = xml_document
+        self.keys = keys if keys is not None else {}
+        self._key_indexes = {}
+        self._join_indexes = {}
+        self.hoisted_values = {}
+        if is_document_node(xml_document):
+            self.root = xml_document.getroot()
+        else:
+            self.root = xml_document
+        self._parents = None
+        self._positions = None
+        self._order = None
+
+    def _build(self):
+        parents = {}
+        positions = {}
+        order = {}
+        for number, node in enumerate(self.root.iter()):
+            order[node] = number
+            for position, child in enumerate(node):
+                parents[child] = node
+                positions[child] = position
+        self._positions = positions
+        self._order = order
+        self._parents = parents
+
+    @property
+    def parent_map(self):
+        if self._parents is None:
+            self._build()
+        return self._parents
+
+    def get_parent(self, node):
+        """
+        Returns the parent of the given node, or None for the root element (and for nodes
+        that are not part of the document)
+        """
+        return self.parent_map.get(node)
+
+    def get_position(self, node):
+        """
+        Returns the (zero-based) index of the given node within the children of its parent
+        """
+        if self._positions is None:
+            self._build()
+        return self._positions.get(node, 0)
+
+    def get_order(self, node):
+        """
+        Returns the document order number of the given node, or None if it is not an
+        element (or comment, or processing instruction) of the document
+        """
+        if self._order is None:
+            self._build()
+        return self._order.get(node)
+
+    def get_key_nodes(self, name, values):
+        """
+        Returns the nodes that have one of the given values for the key with the given name,
+        in document order
+        :param name: The name of the key
+        :param values: The (string) values to look up
+        :return: a list of nodes
+        """
+        index = self._key_indexes.get(name)
+        if index is None:
+            if name not in self.keys:
+                raise SchematronQueryBindingError("Unknown key: %s" % name)
+            index = self.keys[name].build_index(self.xml_document, self)
+            self._key_indexes[name] = index
+
+        if len(values) == 1:
+            return list(index.get(values[0], ()))
+        result = set()
+        for value in values:
+            result.update(index.get(value, ()))
+        return sorted(result, key=self.get_order)
+
+    def get_join_index(self, join, context):
+        """
+        Returns the index of the given JoinIndex for this document, building it (in the given
+        dynamic context) on first use
+        """
+        if join.index_key not in self._join_indexes:
+            self._join_indexes[join.index_key] = join.build_index(context)
+        return self._join_indexes[join.index_key]
 
 
 class XPathContextXSLT(XPathContext):
     """
     This class extends the standard XPathContext with some additional functionality to support
     XSLT functions, such as current().
+
+    If a DocumentIndex is given, it is used for all parent lookups, sibling axes and document
+    order sorting, instead of rescanning the document.
     """
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, document_index=None, variables=None, **kwargs):
         super().__init__(*args, **kwargs)
+        # A copy that keeps the type of the mapping: a VariableScope evaluates its values on
+        # first use, turning it into a dict would evaluate all of them
+        self.variables = {} if variables is None else variables.copy()
         self.current_item = self.item
+        self.document_index = document_index
 
     def __copy__(self):
         result = super().__copy__()
         result.current_item = self.current_item
+        result.document_index = self.document_index
         return result
+
+    @property
+    def parent_map(self):
+        if self.document_index is None:
+            return super().parent_map
+        return self.document_index.parent_map
+
+    def get_parent(self, elem):
+        if self.document_index is None:
+            return super().get_parent(elem)
+        if isinstance(elem, TypedElement):
+            elem = elem[0]
+        if elem is self.root:
+            return None
+        return self.document_index.get_parent(elem)
+
+    def iter_siblings(self, axis=None):
+        if self.document_index is None:
+            yield from super().iter_siblings(axis)
+            return
+
+        if isinstance(self.item, TypedElement):
+            item = self.item[0]
+        elif not is_etree_element(self.item) or callable(self.item.tag):
+            return
+        else:
+            item = self.item
+
+        parent = self.get_parent(item)
+        if parent is None:
+            return
+
+        status = self.item, self.size, self.position, self.axis
+        self.axis = axis or 'following-sibling'
+
+        position = self.document_index.get_position(item)
+        if axis == 'preceding-sibling':
+            siblings = parent[:position]
+            self.size = self.position = len(siblings)
+            for self.item in siblings:
+                yield self.item
+                self.position -= 1
+        else:
+            siblings = parent[position + 1:]
+            self.size = len(siblings)
+            for self.position, self.item in enumerate(siblings, start=1):
+                yield self.item
+
+        self.item, self.size, self.position, self.axis = status
+
+    def iter_results(self, results):
+        if self.document_index is not None:
+            get_order = self.document_index.get_order
+            order = [(get_order(item), item) for item in results if is_etree_element(item)]
+            # Only sort directly if every result is a node of the indexed document
+            if len(order) == len(results) and all(number is not None for number, item in order):
+                status = self.item, self.size, self.position
+                self.size = len(order)
+                for self.position, (number, self.item) in enumerate(sorted(order, key=lambda x: x[0]), start=1):
+                    yield self.item
+                self.item, self.size, self.position = status
+                return
+        yield from super().iter_results(results)
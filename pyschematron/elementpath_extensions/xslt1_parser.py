@@ -1,9 +1,11 @@
 from elementpath.xpath1_parser import XPath1Parser, is_document_node
 
+from pyschematron.elementpath_extensions.context import select_key
+
 
 class XSLT1Parser(XPath1Parser):
     SYMBOLS = XPath1Parser.SYMBOLS | {
-        'current'
+        'current', 'key'
     }
 
 
@@ -29,4 +31,9 @@ def select(self, context=None):
         raise Exception("current() called in a context without an original context item")
 
 
+# Registered as a function only, so that 'key' can still be an element or attribute name
+function('key', nargs=2)
+register('key', select=select_key)
+
+
 XSLT1Parser.build()
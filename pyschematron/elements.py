@@ -2,7 +2,6 @@
 This module contains the schematron elements, as defined in the schematron definition files
 """
 import copy
-import os
 import re
 
 from collections import OrderedDict
@@ -12,9 +11,15 @@ from elementpath import xpath_context
 from elementpath import XPath2Parser
 
 from pyschematron.exceptions import *
-from pyschematron.util import WorkingDirectory, abstract_replace_vars
-from pyschematron.query_bindings import xslt, xslt2, xpath2
-from pyschematron.validation import ValidationContext, ValidationReport
+from pyschematron.util import INCLUDE_CACHE, abstract_replace_vars, resolve_href
+from pyschematron.query_bindings import xslt, xslt2, xpath2, xslt_lxml
+from pyschematron.batch import DocumentResult, validate_many
+from pyschematron.compiler import compile_schema
+from pyschematron.engines import get_engine
+from pyschematron.parallel import validate_patterns
+from pyschematron.sharding import DEFAULT_SHARD_SIZE, ShardedValidator
+from pyschematron.elementpath_extensions.context import DocumentIndex
+from pyschematron.validation import ValidationContext, ValidationReport, SVRLReport
 from pyschematron.xml import xml_util
 from pyschematron.xml.xsl_generator import E
 from pyschematron.svrl import *
@@ -26,6 +31,17 @@ QUERY_BINDINGS = {
     'xpath2': xpath2
 }
 
+# Alternative implementations of query bindings, selected with the 'backend' argument of Schema.
+# Query bindings that a backend does not implement use the default (elementpath) implementation.
+BACKENDS = {
+    'elementpath': QUERY_BINDINGS,
+    'lxml': {
+        'None': xslt_lxml,
+        'xslt': xslt_lxml
+    }
+}
+DEFAULT_BACKEND = 'elementpath'
+
 
 class SchemaObject(object):
     def __init__(self, parent):
@@ -116,12 +132,26 @@ class ComplexText(SchemaObject):
 
 
 class Schema(object):
-    def __init__(self, filename=None, xml_element=None, verbosity=0):
+    """
+    A Schematron schema.
+
+    Validating a document does not change the schema, or the CompiledSchema objects made from
+    it: all the state of a validation is kept in the ValidationContext and the report of the call
+    (see pyschematron.validation). A loaded or compiled schema can therefore be shared by any
+    number of threads that validate documents at the same time. The only things that are
+    added to during validation are the values of the constant variables (each is set once, and
+    all threads use the first value) and the expression and stylesheet caches, which are locked.
+    The messages printed at higher verbosity levels of concurrent validations may be interleaved.
+    """
+
+    def __init__(self, filename=None, xml_element=None, verbosity=0, backend=DEFAULT_BACKEND):
         """
         Initialize a Schematron Schema object
 
         :param filename: If specified, parse the schematron definition in the given file
         :param verbosity: The verbosity level
+        :param backend: The implementation of the query binding: 'elementpath' (all query bindings), or 'lxml'
+                        (native XPath 1.0, for the xslt query binding; other query bindings use elementpath)
         """
 
         #
@@ -136,12 +166,16 @@ class Schema(object):
         self.schema_version = None
         self.query_binding_name = None
         self.query_binding = None
+        if backend not in BACKENDS:
+            raise SchematronError("Unknown backend: %s (supported backends: %s)" % (backend, ", ".join(sorted(BACKENDS))))
+        self.backend = backend
 
         # Specification properties (elements)
         self.title = None
         self.ns_prefixes = OrderedDict()
         self.paragraphs = []
         self.variables = {}
+        self.keys = OrderedDict()
         self.phases = {}
         self.patterns = {}
         # Another paragraphs?
@@ -154,27 +188,58 @@ class Schema(object):
         self.parent = None
         self.file_path = None
         self.verbosity = verbosity
+        # The values of the let statements that do not depend on the document, by their
+        # CompiledVariable.constant_key
+        self.constant_variable_values = {}
         self.abstract_patterns_processed = False
         self.abstract_rules_processed = False
 
         self.elements_read = 0
         self.element_number_of_first_pattern = None
+        # The absolute paths of all the files that were included, see parse_include()
+        self.included_files = []
 
         if filename is not None:
             self.read_from_file(filename)
         elif xml_element is not None:
             self.from_xml(xml_element)
 
+    def __getstate__(self):
+        # The query binding is recreated from its name, see set_query_binding(), and the constant
+        # variable values are computed again (see pyschematron.schema_cache)
+        state = self.__dict__.copy()
+        state['query_binding'] = None
+        state['constant_variable_values'] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.query_binding_name is not None:
+            self.set_query_binding(self.query_binding_name)
+
+    def parse_include(self, element):
+        """
+        Parses the file of an <include> element, relative to the base URI of the element (the
+        file it is in), and adds it to the included files of this schema. The parsed documents
+        are shared between schemas, see pyschematron.util.IncludeCache
+        :param element: The <include> element
+        :return: an ElementTree
+        """
+        path = resolve_href(element.attrib['href'], element.base)
+        included_doc = INCLUDE_CACHE.parse(path)
+        if path not in self.included_files:
+            self.included_files.append(path)
+        return included_doc
+
     def set_query_binding(self, query_binding):
         if query_binding is None:
-            self.query_binding_name = 'xslt'
-            self.query_binding = QUERY_BINDINGS['xslt'].instantiate()
-        elif query_binding not in QUERY_BINDINGS:
+            query_binding = 'xslt'
+        if query_binding not in QUERY_BINDINGS:
             raise SchematronNotImplementedError(
                 "Query Binding '%s' is not supported by this implementation" % query_binding)
-        else:
-            self.query_binding_name = query_binding
-            self.query_binding = QUERY_BINDINGS[query_binding].instantiate()
+        self.query_binding_name = query_binding
+        query_binding_module = BACKENDS[self.backend].get(query_binding, QUERY_BINDINGS[query_binding])
+        self.query_binding = query_binding_module.instantiate()
 
     def msg(self, level, msg):
         if self.verbosity >= level:
@@ -202,11 +267,15 @@ class Schema(object):
         elif el_name == 'phase':
             phase = Phase(self, element)
             self.phases[phase.id] = phase
+        elif el_name == 'key':
+            # xsl:key, or sch:key
+            key = Key(self, element)
+            if key.name in self.keys:
+                raise SchematronError("Duplicate key name: %s" % key.name)
+            self.keys[key.name] = key
         elif el_name == 'include':
-            href = element.attrib['href']
-            included_doc = etree.parse(href)
-            with WorkingDirectory(os.path.dirname(os.path.abspath(href))):
-                self._parse_xml_child(included_doc.getroot())
+            included_doc = self.parse_include(element)
+            self._parse_xml_child(included_doc.getroot())
         elif el_name == 'p':
             self.paragraphs.append(ParagraphText(self, element))
         elif el_name == 'diagnostics':
@@ -247,9 +316,7 @@ class Schema(object):
         """
         self.file_path = file_path
         xml = etree.parse(file_path)
-        with WorkingDirectory(os.path.dirname(file_path)):
-            root = xml.getroot()
-            self.from_xml(root)
+        self.from_xml(xml.getroot())
 
         if process_abstract_patterns:
             self.process_abstract_patterns()
@@ -345,163 +412,153 @@ class Schema(object):
         xml_util.set_attr(root, 'queryBinding', self.query_binding_name)
         xml_util.set_variables(root, self.variables)
 
+        for key in self.keys.values():
+            root.append(key.to_minimal_xml())
         for phase in self.phases.values():
             root.append(phase.to_minimal_xml())
         for pattern in self.patterns.values():
             root.append(pattern.to_minimal_xml())
         return root
 
-    def validate_document(self, xml_doc, phase="#DEFAULT"):
+    def compile(self, phase="#DEFAULT"):
+        """
+        Prepares this schema for validation: resolves the phase, abstract patterns and rules,
+        and parses all the expressions in the schema.
+
+        The result can be passed to validate_document() and validate_document_to_svrl(), so that
+        this work is done only once for any number of documents.
+
+        :param phase: The phase to compile
+        :return: a CompiledSchema
+        """
+        return compile_schema(self, phase)
+
+    def _get_compiled_schema(self, phase, compiled_schema):
+        if compiled_schema is None:
+            return self.compile(phase)
+        if compiled_schema.schema is not self:
+            raise SchematronError("The compiled schema was not created from this schema")
+        return compiled_schema
+
+    def validate_document(self, xml_doc, phase="#DEFAULT", compiled_schema=None, engine=None, workers=None,
+                          cancellation=None):
         """
         Validates the given xml document against this schematron schema.
 
-        :return: a tuple ([errors], [warnings])
+        :param xml_doc: The document to validate
+        :param phase: The phase to validate (ignored if compiled_schema is given)
+        :param compiled_schema: The result of an earlier call to compile()
+        :param engine: The name of the validation engine to use ('rules', 'document' or 'xslt'), see pyschematron.engines
+        :param workers: If given, the patterns are evaluated in parallel in this number of worker processes
+                        (see pyschematron.parallel)
+        :param cancellation: An object with an is_set() method (such as a threading.Event), that stops the
+                             validation with a SchematronCancelledError between patterns or rules when it is set
+        :return: a ValidationReport
         """
+        compiled_schema = self._get_compiled_schema(phase, compiled_schema)
         report = ValidationReport()
+        self._run_engine(compiled_schema, xml_doc, report, engine, workers, cancellation=cancellation)
+        return report
 
-        if phase == "#DEFAULT":
-            phase = self.default_phase
-
-        patterns = self.get_patterns_for_phase(phase)
-
-        # Idea for performance improvement:
-        # - loop over the actual elements in the document
-        # - while this element is not 'known', process rules as already done,
-        #   but store a mapping of each element that is encountered in a rule context match to that rule
-        # - process assertions when the element is encountered, but stop the rule loop, and move on to the next element
-        # - if this element is already 'known', we can immediately process the assertions
-        # - if not, continue the processing of rules
-
-        schema_context = ValidationContext(self, xml_doc)
-        if phase != "#ALL":
-            schema_context.add_variables(self.phases[phase].variables)
-
-        for p in patterns:
-            self.msg(5, "Validating pattern: " + str(p.id))
-            # We track the fired rule for each element, since every document node should only have one rule
-            fired_rules = {}
-            # Variables themselves can be expressions,
-            # so we evaluate them here, and replace the originals
-            # with the result of the evaluation
-            pattern_context = schema_context.copy()
-            pattern_context.set_pattern(p)
-
-            for r in p.rules:
-                self.msg(5, "Validating rule with context: " + str(r.context))
-                if r.abstract:
-                    continue
-                rule_context = pattern_context.copy()
-
-                # TODO: should this be done for every matching element?
-                report.add_fired_rule(rule_context)
-                rule_context.set_rule(r)
-
-                # If the context is the literal '/', pass 'None' as the context item to elementpath
-                elements = rule_context.get_rule_context_elements()
-                self.msg(5, "Number of matching elements: %s" % len(elements))
-
-                for element in elements:
-                    rule_context.add_rule_variables(r, element)
-                    if element in fired_rules:
-                        # Already matched a rule, skip this one
-                        continue
-                    # Mark this element as having fired a rule (so it can be skipped later, if
-                    # it matches other rules as well)
-                    fired_rules[element] = r.context
-
-                    rule_context.validate_assertions(element, report)
+    @staticmethod
+    def _run_engine(compiled_schema, xml_doc, report, engine, workers, document_index=None, cancellation=None):
+        if document_index is None:
+            document_index = DocumentIndex(xml_doc, compiled_schema.keys)
+        if workers is not None:
+            validate_patterns(compiled_schema, xml_doc, report, workers, engine, document_index, cancellation)
+        else:
+            get_engine(engine).validate(compiled_schema, xml_doc, report, document_index, cancellation)
 
-        return report
+    def validate_many(self, paths, workers=None, phase="#DEFAULT", compiled_schema=None, engine=None, ordered=True):
+        """
+        Validates any number of xml files against this schematron schema, in a pool of worker
+        processes (see pyschematron.batch). The schema is compiled only once.
+
+        :param paths: An iterable of the file names of the documents to validate
+        :param workers: The number of worker processes, the number of CPUs if None; with 1, the documents are
+                        validated in this process
+        :param phase: The phase to validate (ignored if compiled_schema is given)
+        :param compiled_schema: The result of an earlier call to compile()
+        :param engine: The name of the validation engine to use ('rules', 'document' or 'xslt'), see pyschematron.engines
+        :param ordered: If True, the results are returned in the order of the paths, otherwise as soon as they are done
+        :return: an iterator of batch.DocumentResult objects
+        """
+        compiled_schema = self._get_compiled_schema(phase, compiled_schema)
+        return validate_many(compiled_schema, paths, workers, engine, ordered)
 
-    def validate_document_to_svrl(self, xml_doc, phase="#DEFAULT"):
+    def validate_sharded(self, path, record_path=None, workers=None, phase="#DEFAULT", compiled_schema=None,
+                         shard_size=DEFAULT_SHARD_SIZE):
+        """
+        Validates a single large xml file in shards of records, in a pool of worker processes (see
+        pyschematron.sharding). Only the rules that do not need the full document are run for the
+        records; all the rules are run on a skeleton of the document without the records.
+
+        :param path: The file name of the document to validate
+        :param record_path: The path of the records ('/root/record' or 'record'); every child element of the
+                            root element is a record if None
+        :param workers: The number of worker processes, the number of CPUs if None; with 1, the shards are
+                        validated in this process
+        :param phase: The phase to validate (ignored if compiled_schema is given)
+        :param compiled_schema: The result of an earlier call to compile()
+        :param shard_size: The (approximate) size of a shard in bytes
+        :return: a batch.DocumentResult
+        """
+        compiled_schema = self._get_compiled_schema(phase, compiled_schema)
+        errors = []
+        warnings = []
+        for shard_errors, shard_warnings in ShardedValidator(compiled_schema, record_path, workers,
+                                                             shard_size).iter_results(path):
+            errors.extend(shard_errors)
+            warnings.extend(shard_warnings)
+        return DocumentResult(path, errors, warnings)
+
+    def validate_document_to_svrl(self, xml_doc, phase="#DEFAULT", compiled_schema=None, engine=None, workers=None,
+                                  cancellation=None):
         """
         Validates the given xml document against this schematron schema.
 
-        :return: a tuple ([errors], [warnings])
+        :param xml_doc: The document to validate
+        :param phase: The phase to validate (ignored if compiled_schema is given)
+        :param compiled_schema: The result of an earlier call to compile()
+        :param engine: The name of the validation engine to use ('rules', 'document' or 'xslt'), see pyschematron.engines
+        :param workers: If given, the patterns are evaluated in parallel in this number of worker processes
+                        (see pyschematron.parallel)
+        :param cancellation: An object with an is_set() method (such as a threading.Event), that stops the
+                             validation with a SchematronCancelledError between patterns or rules when it is set
+        :return: a SchematronOutput object
         """
+        compiled_schema = self._get_compiled_schema(phase, compiled_schema)
+        document_index = DocumentIndex(xml_doc, compiled_schema.keys)
+        report = SVRLReport(compiled_schema, xml_doc, document_index)
+        self._run_engine(compiled_schema, xml_doc, report, engine, workers, document_index, cancellation)
+        return report.svrl
 
-        if phase == "#DEFAULT":
-            phase = self.default_phase
-
-        svrl = SchematronOutput(title=self.title, phase=phase, schema_version=self.schema_version, namespaces=self.ns_prefixes)
-
-        patterns = self.get_patterns_for_phase(phase)
-
-        # Idea for performance improvement:
-        # - loop over the actual elements in the document
-        # - while this element is not 'known', process rules as already done,
-        #   but store a mapping of each element that is encountered in a rule context match to that rule
-        # - process assertions when the element is encountered, but stop the rule loop, and move on to the next element
-        # - if this element is already 'known', we can immediately process the assertions
-        # - if not, continue the processing of rules
-
-        schema_context = ValidationContext(self, xml_doc)
-        if phase != "#ALL":
-            schema_context.add_variables(self.phases[phase].variables)
-
-        for p in patterns:
-            self.msg(5, "Validating pattern: " + str(p.id))
-            # We track the fired rule for each element, since every document node should only have one rule
-            fired_rules = {}
-            # Variables themselves can be expressions,
-            # so we evaluate them here, and replace the originals
-            # with the result of the evaluation
-            pattern_context = schema_context.copy()
-            pattern_context.set_pattern(p)
-
-            # SVRL has 'role' in (active-)pattern but schematron does not? TODO: check this
-            active_pattern = ActivePattern(id=p.id, name=p.id, role=None)
-
-            for r in p.rules:
-                self.msg(5, "Validating rule with context: " + str(r.context))
-                if r.abstract:
-                    continue
-                rule_context = pattern_context.copy()
-
-                # TODO: should this be done for every matching element?
-                fired_rule = FiredRule(id=r.id, context=r.context, role=r.role, flag=r.flag)
-                rule_context.set_rule(r)
-
-                # If the context is the literal '/', pass 'None' as the context item to elementpath
-                elements = rule_context.get_rule_context_elements()
-                self.msg(5, "Number of matching elements: %s" % len(elements))
-
-                for element in elements:
-                    rule_context.add_rule_variables(r, element)
-                    if element in fired_rules:
-                        # Already matched a rule, skip this one
-                        continue
-                    # Mark this element as having fired a rule (so it can be skipped later, if
-                    # it matches other rules as well)
-                    fired_rules[element] = r.context
-
-                    for assert_test in r.assertions:
-                        result = self.query_binding.evaluate_assertion(xml_doc, element, self.ns_prefixes, rule_context.variables,
-                                                                       assert_test.test)
-                        if not result:
-                            report = FailedAssert(id=assert_test.id,
-                                                  location=xml_doc.getelementpath(element),
-                                                  test=assert_test.test,
-                                                  role=assert_test.role,
-                                                  flag=assert_test.flag)
-                            report.text = Text(assert_test.to_string())
-                            fired_rule.add_report(report)
-                            # TODO: location, and diagnostic_references
-                    for report_test in r.reports:
-                        result = self.query_binding.evaluate_assertion(xml_doc, element, self.ns_prefixes, rule_context.variables,
-                                                                       report_test.test)
-                        if result:
-                            report = SuccessfulReport(id=report_test.id,
-                                                      location=xml_doc.getelementpath(element),
-                                                      test=report_test.test,
-                                                      role=report_test.role,
-                                                      flag=report_test.flag)
-                            report.text = Text(report_test.to_string(resolve=True, xml_doc=xml_doc, current_element=element, namespaces=self.ns_prefixes))
-                            fired_rule.add_report(report)
-
-                active_pattern.add_fired_rule(fired_rule)
-            svrl.add_active_pattern(active_pattern)
-        return svrl
+
+class Key(SchemaObject):
+    """
+    A key declaration (xsl:key or sch:key), which indexes the nodes that match the pattern
+    in 'match' by the value of the expression in 'use', for the key() function
+    """
+
+    def __init__(self, parent, xml_element=None):
+        super().__init__(parent)
+        self.name = None
+        self.match = None
+        self.use = None
+
+        if xml_element is not None:
+            self.from_xml(xml_element)
+
+    def from_xml(self, key_element):
+        for attribute in ('name', 'match', 'use'):
+            if attribute not in key_element.attrib:
+                raise SchematronError("key element without %s attribute" % attribute)
+        self.name = key_element.attrib['name']
+        self.match = key_element.attrib['match']
+        self.use = key_element.attrib['use']
+
+    def to_minimal_xml(self):
+        return E('xsl', 'key', {'name': self.name, 'match': self.match, 'use': self.use})
 
 
 class Phase(SchemaObject):
@@ -535,10 +592,8 @@ class Phase(SchemaObject):
             # as well (can just subclass ComplexText)
             self.active_patterns.append(element.attrib["pattern"])
         elif el_name == 'include':
-            href = element.attrib['href']
-            included_doc = etree.parse(href)
-            with WorkingDirectory(os.path.dirname(os.path.abspath(href))):
-                self._parse_xml_child(included_doc.getroot())
+            included_doc = self.get_schema().parse_include(element)
+            self._parse_xml_child(included_doc.getroot())
         else:
             raise SchematronError("Unknown element in phase: %s: %s" % (self.id, element.tag))
 
@@ -606,10 +661,8 @@ class Pattern(SchemaObject):
             p_value = element.attrib['value']
             self.params[p_name] = p_value
         elif el_name == 'include':
-            href = element.attrib['href']
-            included_doc = etree.parse(href)
-            with WorkingDirectory(os.path.dirname(os.path.abspath(href))):
-                self._parse_xml_child(included_doc.getroot())
+            included_doc = self.get_schema().parse_include(element)
+            self._parse_xml_child(included_doc.getroot())
         else:
             raise SchematronError("Unknown element in pattern: %s: %s" % (self.id, element.tag))
 
@@ -633,8 +686,7 @@ class Pattern(SchemaObject):
 
     def read_from_file(self, file_path):
         xml = etree.parse(file_path)
-        with WorkingDirectory(os.path.dirname(file_path)):
-            self.from_xml(xml.getroot())
+        self.from_xml(xml.getroot())
 
     def to_minimal_xml(self):
         element = xml_util.create('pattern')
@@ -681,12 +733,18 @@ class Rule(SchemaObject):
         new_rule = Rule(self.parent)
         new_rule.context = self.context
         new_rule.id = self.id
-        new_rule.assertions = self.assertions[:]
-        new_rule.reports = self.reports[:]
+        # The tests are copied too, as the parameters of abstract patterns are replaced in them
+        new_rule.assertions = [new_rule.copy_test(assertion) for assertion in self.assertions]
+        new_rule.reports = [new_rule.copy_test(report) for report in self.reports]
         new_rule.variables = copy.deepcopy(self.variables)
         new_rule.abstract = self.abstract
         return new_rule
 
+    def copy_test(self, test):
+        new_test = copy.copy(test)
+        new_test.parent = self
+        return new_test
+
     def _parse_xml_child(self, element, variables):
         el_name = etree.QName(element.tag).localname
         if el_name == 'p':
@@ -704,10 +762,8 @@ class Rule(SchemaObject):
         elif el_name == 'extends':
             self.extends.append(element.attrib['rule'])
         elif el_name == 'include':
-            href = element.attrib['href']
-            included_doc = etree.parse(href)
-            with WorkingDirectory(os.path.dirname(os.path.abspath(href))):
-                self._parse_xml_child(included_doc.getroot())
+            included_doc = self.get_schema().parse_include(element)
+            self._parse_xml_child(included_doc.getroot(), variables)
         else:
             raise SchematronError("Unknown element in rule with context %s: %s" % (self.context, element.tag))
 
@@ -943,16 +999,25 @@ class NameText(SchemaObject):
         super().__init__(parent)
         self.path = xml_element.attrib.get('path')
 
+    def get_query(self):
+        return "name(%s)" % (self.path or ".")
+
+    def compile_query(self, query_binding, namespaces):
+        return query_binding.compile_name_query(self.get_query(), namespaces, {})
+
+    def format_result(self, result):
+        # TODO: *should* we remove namespaces?
+        if result.find('}') >= 0:
+            result = result[result.find('}') + 1:]
+        if result.find(':') >= 0:
+            result = result[result.find(':') + 1:]
+        return result
+
     def to_string(self, resolve=False, xml_doc=None, current_element=None, namespaces=None):
         if resolve:
             qb = self.get_schema().query_binding
-            result = qb.evaluate_name_query(xml_doc, current_element, namespaces, {}, "name(%s)" % (self.path or "."))
-            # TODO: *should* we remove namespaces?
-            if result.find('}') >= 0:
-                result = result[result.find('}') + 1:]
-            if result.find(':') >= 0:
-                result = result[result.find(':') + 1:]
-            return result
+            result = qb.evaluate_name_query(xml_doc, current_element, namespaces, {}, self.get_query())
+            return self.format_result(result)
         else:
             path_attr = ""
             if self.path is not None:
@@ -973,16 +1038,25 @@ class ValueOfText(SchemaObject):
         super().__init__(parent)
         self.select = xml_element.attrib.get('select')
 
+    def get_query(self):
+        return "name(%s)" % (self.select or ".")
+
+    def compile_query(self, query_binding, namespaces):
+        return query_binding.compile_value_of_query(self.get_query(), namespaces, {})
+
+    def format_result(self, result):
+        # TODO: *should* we remove namespaces?
+        if result.find('}') >= 0:
+            result = result[result.find('}') + 1:]
+        if result.find(':') >= 0:
+            result = result[result.find(':') + 1:]
+        return result
+
     def to_string(self, resolve=False, xml_doc=None, current_element=None, namespaces=None):
         if resolve:
             qb = self.get_schema().query_binding
-            result = qb.evaluate_value_of_query(xml_doc, current_element, namespaces, {}, "name(%s)" % (self.select or "."))
-            # TODO: *should* we remove namespaces?
-            if result.find('}') >= 0:
-                result = result[result.find('}') + 1:]
-            if result.find(':') >= 0:
-                result = result[result.find(':') + 1:]
-            return result
+            result = qb.evaluate_value_of_query(xml_doc, current_element, namespaces, {}, self.get_query())
+            return self.format_result(result)
         else:
             select_attr = ""
             if self.select is not None:
@@ -0,0 +1,53 @@
+"""
+Validation engines.
+
+An engine runs the rules of a compiled schema against a document, and passes the results on
+to a report object (a ValidationReport or an SVRLReport). Every engine produces the same
+results; they differ in the order in which they visit the document and the rules.
+
+- rules: for every pattern and rule, select the context nodes and evaluate the assertions
+- document: walk the document once, and dispatch every node to the first matching rule of each pattern
+- xslt: run the schema as a compiled XSLT 1.0 stylesheet with libxslt (xslt query binding only)
+"""
+from pyschematron.exceptions import SchematronError
+
+DEFAULT_ENGINE = 'rules'
+
+
+class ValidationEngine(object):
+    def __init__(self):
+        raise SchematronError("ValidationEngine base class cannot be instantiated directly")
+
+    def get_name(self):
+        return self.name
+
+    def validate(self, compiled_schema, xml_doc, report, document_index=None, cancellation=None):
+        """
+        Validates the given document
+        :param compiled_schema: The CompiledSchema to validate against
+        :param xml_doc: The document to validate
+        :param report: The report object that the results are passed to
+        :param document_index: The DocumentIndex of the document, created if not given
+        :param cancellation: An object with an is_set() method (such as a threading.Event); once it is set, the
+                             validation stops with a SchematronCancelledError at the next pattern or rule
+        :return: None
+        """
+        raise SchematronError("validate() not implemented in engine %s" % self.get_name())
+
+
+def get_engine(name=None):
+    """
+    Returns an instance of the engine with the given name
+    """
+    from pyschematron.engines import rules, document, xslt
+
+    engines = {
+        'rules': rules,
+        'document': document,
+        'xslt': xslt
+    }
+    if name is None:
+        name = DEFAULT_ENGINE
+    if name not in engines:
+        raise SchematronError("Unknown validation engine: %s (supported engines: %s)" % (name, ", ".join(sorted(engines))))
+    return engines[name].instantiate()
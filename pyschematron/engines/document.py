@@ -0,0 +1,77 @@
+"""
+The single-pass validation engine.
+
+Instead of selecting the context nodes of every rule separately, this engine walks the
+document once, in document order. Every node is tested against the rules of each active
+pattern, in order, and assigned to the first matching rule; the remaining rules of that
+pattern are skipped for the node, just like in the rules engine. A node is only tested
+against the rules that the dispatch index of the pattern returns for its name (see
+compiler.RuleDispatchIndex).
+
+After the walk, the assertions of every rule are evaluated for the nodes assigned to it, so
+that the assertions that allow it can be evaluated for all of those nodes at once.
+
+Only the document node and element nodes are visited; the compiler rejects rule contexts
+that select other nodes.
+"""
+from elementpath.xpath_nodes import is_element_node
+
+from pyschematron.engines import ValidationEngine
+from pyschematron.validation import ValidationContext
+
+
+def instantiate():
+    return DocumentEngine()
+
+
+def iter_document_nodes(xml_doc):
+    """
+    Yields the nodes that rules can fire on, in document order. The document node itself
+    is represented by None.
+    """
+    yield None
+    for element in xml_doc.iter():
+        if is_element_node(element):
+            yield element
+
+
+class DocumentEngine(ValidationEngine):
+    def __init__(self):
+        self.name = 'document'
+
+    def validate(self, compiled_schema, xml_doc, report, document_index=None, cancellation=None):
+        context = ValidationContext(compiled_schema, xml_doc, document_index, cancellation)
+
+        # Set up the matchers for every pattern and rule, and report them in the same
+        # order as the rules engine does
+        dispatch = []
+        for p in compiled_schema.patterns:
+            context.set_pattern(p)
+            report.add_active_pattern(p)
+
+            pattern_rules = {}
+            for r in p.rules:
+                report.add_fired_rule(r)
+                context.set_rule(r)
+                pattern_rules[r] = (context.get_rule_context_matcher(), [])
+            dispatch.append((p.dispatch_index, pattern_rules))
+
+        for node in iter_document_nodes(xml_doc):
+            context.check_cancelled()
+            for dispatch_index, pattern_rules in dispatch:
+                for r in dispatch_index.get_candidate_rules(node):
+                    matches, nodes = pattern_rules[r]
+                    if matches(node):
+                        nodes.append(node)
+                        # Only the first matching rule of a pattern fires
+                        break
+
+        for p, (dispatch_index, pattern_rules) in zip(compiled_schema.patterns, dispatch):
+            context.set_pattern(p)
+            for r in p.rules:
+                matches, nodes = pattern_rules[r]
+                context.set_rule(r)
+                context.set_rule_nodes(nodes)
+                for node in nodes:
+                    context.add_rule_variables(r, node)
+                    context.validate_assertions(node, report)
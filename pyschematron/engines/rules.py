@@ -0,0 +1,52 @@
+"""
+The rule-by-rule validation engine.
+
+For every pattern, every rule selects its context nodes from the document, and the
+assertions are evaluated for the nodes that have not fired an earlier rule of the pattern.
+"""
+from pyschematron.engines import ValidationEngine
+from pyschematron.validation import ValidationContext
+
+
+def instantiate():
+    return RulesEngine()
+
+
+class RulesEngine(ValidationEngine):
+    def __init__(self):
+        self.name = 'rules'
+
+    def validate(self, compiled_schema, xml_doc, report, document_index=None, cancellation=None):
+        context = ValidationContext(compiled_schema, xml_doc, document_index, cancellation)
+
+        for p in compiled_schema.patterns:
+            context.msg(5, "Validating pattern: " + str(p.id))
+            # We track the fired rule for each element, since every document node should only have one rule
+            fired_rules = {}
+            context.set_pattern(p)
+            report.add_active_pattern(p)
+
+            for r in p.rules:
+                context.msg(5, "Validating rule with context: " + str(r.context_text))
+
+                report.add_fired_rule(r)
+                context.set_rule(r)
+
+                # If the context is the literal '/', pass 'None' as the context item to elementpath
+                elements = context.get_rule_context_elements()
+                context.msg(5, "Number of matching elements: %s" % len(elements))
+
+                nodes = []
+                for element in elements:
+                    if element in fired_rules:
+                        # Already matched a rule, skip this one
+                        continue
+                    # Mark this element as having fired a rule (so it can be skipped later, if
+                    # it matches other rules as well)
+                    fired_rules[element] = r
+                    nodes.append(element)
+
+                context.set_rule_nodes(nodes)
+                for element in nodes:
+                    context.add_rule_variables(r, element)
+                    context.validate_assertions(element, report)
@@ -0,0 +1,170 @@
+"""
+The XSLT validation engine.
+
+The schema is converted to an XSLT 1.0 stylesheet (see xml.xsl_generator), which is
+compiled once with libxslt (etree.XSLT) and cached for every schema and phase. Validating a
+document is a single transformation, so the whole traversal of the document and the
+evaluation of all rule contexts and assertions happen in C.
+
+The SVRL output of the stylesheet is parsed into an svrl.SchematronOutput, and its results
+are passed on to the report, so that this engine produces the same reports as the other
+ones. Like those, it only reports results for elements and the document node.
+Only the xslt query binding is supported; libxslt cannot evaluate XPath 2.0.
+"""
+import threading
+import weakref
+
+from lxml import etree
+
+from pyschematron.exceptions import SchematronError, SchematronNotImplementedError, SchematronCancelledError
+from pyschematron.engines import ValidationEngine
+from pyschematron.svrl import SchematronOutput, FailedAssert
+from pyschematron.xml.xsl_generator import schema_to_xsl, E
+
+ENGINE_NAMESPACE = "urn:pyschematron:xslt-engine"
+
+
+def instantiate():
+    return XSLTEngine()
+
+
+# The elements that the svrl locations of the transformation in this thread refer to
+_locations = threading.local()
+
+
+def _location(context, nodes):
+    element = nodes[0]
+    location = element.getroottree().getpath(element)
+    _locations.elements[location] = element
+    return location
+
+
+EXTENSIONS = {(ENGINE_NAMESPACE, 'location'): _location}
+
+# The compiled stylesheets, per schema and phase
+_stylesheets = weakref.WeakKeyDictionary()
+_stylesheets_lock = threading.Lock()
+
+
+def create_stylesheet(schema, phase):
+    """
+    Returns the stylesheet for the given schema and phase, as an etree.XSLT object.
+
+    The locations of the skeleton count the preceding siblings of every node that is reported,
+    which makes them quadratic in the number of siblings. They are replaced by an extension
+    function, that also remembers the element for every location.
+    """
+    # libxslt cannot evaluate document-uri()
+    xsl_root = schema_to_xsl(schema, phase, document_uri=False)
+    location_template = E('xsl', 'template', {'match': '*', 'mode': 'schematron-select-full-path', 'priority': '1'},
+                          nsmap={'pyschematron': ENGINE_NAMESPACE})
+    location_template.append(E('xsl', 'value-of', {'select': 'pyschematron:location(.)'}, nsmap={'pyschematron': ENGINE_NAMESPACE}))
+    xsl_root.append(location_template)
+    try:
+        return etree.XSLT(xsl_root, extensions=EXTENSIONS)
+    except etree.XSLTParseError as xpe:
+        raise SchematronError("Error compiling the schema to XSLT: %s" % str(xpe))
+
+
+def get_stylesheet(schema, phase):
+    """
+    Returns the compiled etree.XSLT object for the given schema and phase, generating and
+    compiling it on first use
+    :param schema: The Schema to convert
+    :param phase: The (resolved) name of the phase
+    :return: an etree.XSLT object
+    """
+    with _stylesheets_lock:
+        stylesheets = _stylesheets.setdefault(schema, {})
+        if phase not in stylesheets:
+            if schema.query_binding_name != 'xslt':
+                raise SchematronNotImplementedError("The xslt engine only supports the xslt query binding, not %s" %
+                                                    schema.query_binding_name)
+            stylesheets[phase] = create_stylesheet(schema, phase)
+        return stylesheets[phase]
+
+
+class XSLTEngine(ValidationEngine):
+    def __init__(self):
+        self.name = 'xslt'
+
+    def get_svrl(self, compiled_schema, xml_doc):
+        """
+        Runs the stylesheet of the given compiled schema on the given document
+        :param compiled_schema: The CompiledSchema to validate against
+        :param xml_doc: The document to validate
+        :return: a tuple of the SVRL output of the stylesheet, as an svrl.SchematronOutput, and a dict
+                 of the elements that its locations refer to
+        """
+        stylesheet = get_stylesheet(compiled_schema.schema, compiled_schema.phase)
+        _locations.elements = {}
+        try:
+            result = stylesheet(xml_doc)
+            return SchematronOutput(xml_element=result.getroot()), _locations.elements
+        except etree.XSLTApplyError as xae:
+            raise SchematronError("Error applying the XSLT stylesheet: %s" % str(xae))
+        finally:
+            _locations.elements = None
+
+    def validate(self, compiled_schema, xml_doc, report, document_index=None, cancellation=None):
+        # The transformation cannot be interrupted, so it can only be cancelled before it starts
+        if cancellation is not None and cancellation.is_set():
+            raise SchematronCancelledError("The validation was cancelled")
+        svrl, elements = self.get_svrl(compiled_schema, xml_doc)
+        if len(svrl.active_patterns) != len(compiled_schema.patterns):
+            raise SchematronError("The XSLT output does not match the patterns of the schema")
+
+        for pattern, active_pattern in zip(compiled_schema.patterns, svrl.active_patterns):
+            report.add_active_pattern(pattern)
+            for rule in pattern.rules:
+                report.add_fired_rule(rule)
+            for fired_rule in active_pattern.fired_rules:
+                rule = self.get_rule(pattern, fired_rule)
+                results = []
+                used = set()
+                for svrl_report in fired_rule.reports:
+                    index, rule_test = self.get_rule_test(rule, svrl_report, used)
+                    used.add(index)
+                    if rule.context_text == '/':
+                        # The document node
+                        results.append((index, rule_test, None))
+                    elif svrl_report.location in elements:
+                        results.append((index, rule_test, elements[svrl_report.location]))
+                    # else: the context is an attribute or another non-element node, which is
+                    # not validated by the other engines either
+                # Pass the results in the same order as ValidationContext.validate_assertions()
+                for index, rule_test, element in sorted(results, key=lambda result: result[0]):
+                    if index < len(rule.assertions):
+                        report.add_failed_assert(rule, rule_test, element)
+                    else:
+                        report.add_successful_report(rule, rule_test, element)
+
+    def get_rule(self, pattern, fired_rule):
+        """
+        Returns the compiled rule for an svrl:fired-rule. If several rules have the same
+        context, only the first one can ever fire.
+        """
+        for rule in pattern.rules:
+            if rule.context_text == fired_rule.context:
+                return rule
+        raise SchematronError("The XSLT output contains an unknown rule: %s" % fired_rule.context)
+
+    def get_rule_test(self, rule, svrl_report, used):
+        """
+        Returns the index of the assertion or report of the rule that an svrl:failed-assert or
+        svrl:successful-report refers to (assertions first, then reports), and its compiled test.
+        Indices in used have already been reported for the same context node.
+        """
+        if isinstance(svrl_report, FailedAssert):
+            rule_tests = rule.assertions
+            offset = 0
+        else:
+            rule_tests = rule.reports
+            offset = len(rule.assertions)
+        for index, rule_test in enumerate(rule_tests):
+            source = rule_test.source
+            if index + offset in used:
+                continue
+            if source.id == svrl_report.id and source.test.strip() == svrl_report.test:
+                return index + offset, rule_test
+        raise SchematronError("The XSLT output contains an unknown test: %s" % svrl_report.test)
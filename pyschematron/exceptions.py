@@ -12,3 +12,7 @@ class SchematronNotImplementedError(SchematronError):
 
 class SchematronQueryBindingError(SchematronError):
     pass
+
+
+class SchematronCancelledError(SchematronError):
+    pass
@@ -0,0 +1,178 @@
+"""
+Parallel evaluation of the patterns of a schema, for a single (large) document.
+
+The patterns of a schema are independent of each other: every pattern keeps track of its own
+fired rules. Schema.validate_document(..., workers=N) evaluates them in a pool of worker
+processes. Every worker parses the same serialized document once, when it starts, and then
+validates it against one pattern at a time with the normal engines.
+
+A worker passes the calls that the engine makes to its report back to the calling process,
+with the patterns, rules, tests and nodes replaced by their positions (see RecordingReport).
+The calling process replays them on its own report and document, one pattern at a time, in
+the order of the patterns in the schema; the result is the same report as that of a serial
+validation.
+
+The xslt engine runs the whole schema in one transformation, so it is not parallelized.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from lxml import etree
+
+from pyschematron.batch import get_multiprocessing_context, get_schema_arguments, get_worker_schema
+from pyschematron.compiler import CompiledSchema
+from pyschematron.elementpath_extensions.context import DocumentIndex
+from pyschematron.engines import get_engine
+from pyschematron.exceptions import SchematronCancelledError
+
+# The compiled schema, the document, its index and the positions of its nodes in a worker
+# process, see _init_worker()
+_worker_compiled_schema = None
+_worker_xml_doc = None
+_worker_document_index = None
+_worker_node_positions = None
+
+
+def get_nodes(xml_doc):
+    """
+    Returns the nodes of the given document in document order; a node is identified by its
+    position in this list in every process that has parsed the same document
+    """
+    return list(xml_doc.getroot().iter())
+
+
+class RecordingReport(object):
+    """
+    A report object that records the calls of a validation engine, with the objects of the
+    schema and the document replaced by their positions, so that they can be replayed in
+    another process with replay()
+    """
+
+    def __init__(self, compiled_schema, node_positions):
+        """
+        :param compiled_schema: The compiled schema that is validated against
+        :param node_positions: A dict of the nodes of the document to their positions in get_nodes()
+        """
+        self.calls = []
+        self.patterns = {}
+        self.rules = {}
+        self.tests = {}
+        for pattern_position, pattern in enumerate(compiled_schema.patterns):
+            self.patterns[pattern] = pattern_position
+            for rule_position, rule in enumerate(pattern.rules):
+                self.rules[rule] = (pattern_position, rule_position)
+                for kind in ('assertions', 'reports'):
+                    for test_position, rule_test in enumerate(getattr(rule, kind)):
+                        self.tests[rule_test] = (kind, test_position)
+        self.nodes = node_positions
+
+    def get_node_position(self, node):
+        # The document node is represented by None
+        return None if node is None else self.nodes[node]
+
+    def add_active_pattern(self, pattern):
+        self.calls.append(('add_active_pattern', self.patterns[pattern]))
+
+    def add_fired_rule(self, rule):
+        self.calls.append(('add_fired_rule', self.rules[rule]))
+
+    def add_bulk_test(self, rule, rule_test):
+        self.calls.append(('add_bulk_test', self.rules[rule], self.tests[rule_test]))
+
+    def add_failed_assert(self, rule, assertion, element):
+        self.calls.append(('add_failed_assert', self.rules[rule], self.tests[assertion],
+                           self.get_node_position(element)))
+
+    def add_successful_report(self, rule, report, element):
+        self.calls.append(('add_successful_report', self.rules[rule], self.tests[report],
+                           self.get_node_position(element)))
+
+
+def replay(calls, compiled_schema, nodes, report):
+    """
+    Passes the calls that were recorded by a RecordingReport on to the given report
+    :param calls: The recorded calls
+    :param compiled_schema: The compiled schema that the calls were recorded for
+    :param nodes: The result of get_nodes() for the document that the calls were recorded for
+    :param report: The report to pass the calls to
+    """
+    for call in calls:
+        method = getattr(report, call[0])
+        if call[0] == 'add_active_pattern':
+            method(compiled_schema.patterns[call[1]])
+            continue
+        pattern_position, rule_position = call[1]
+        rule = compiled_schema.patterns[pattern_position].rules[rule_position]
+        if call[0] == 'add_fired_rule':
+            method(rule)
+            continue
+        kind, test_position = call[2]
+        rule_test = getattr(rule, kind)[test_position]
+        if call[0] == 'add_bulk_test':
+            method(rule, rule_test)
+        else:
+            method(rule, rule_test, None if call[3] is None else nodes[call[3]])
+
+
+def get_pattern_schema(compiled_schema, pattern):
+    """
+    Returns a compiled schema with only the given pattern of the given compiled schema
+    """
+    return CompiledSchema(compiled_schema.schema, compiled_schema.phase, compiled_schema.namespaces,
+                          compiled_schema.schema_variables, [pattern], compiled_schema.keys.values(),
+                          compiled_schema.phase_variables)
+
+
+def _init_worker(schema_arguments, document, base_url):
+    global _worker_compiled_schema, _worker_xml_doc, _worker_document_index, _worker_node_positions
+    _worker_compiled_schema = get_worker_schema(*schema_arguments)
+    _worker_xml_doc = etree.fromstring(document, base_url=base_url).getroottree()
+    _worker_document_index = DocumentIndex(_worker_xml_doc, _worker_compiled_schema.keys)
+    _worker_node_positions = {node: position for position, node in enumerate(get_nodes(_worker_xml_doc))}
+
+
+def _validate_pattern_in_worker(pattern_position, engine):
+    compiled_schema = _worker_compiled_schema
+    report = RecordingReport(compiled_schema, _worker_node_positions)
+    pattern_schema = get_pattern_schema(compiled_schema, compiled_schema.patterns[pattern_position])
+    get_engine(engine).validate(pattern_schema, _worker_xml_doc, report, _worker_document_index)
+    return report.calls
+
+
+def validate_patterns(compiled_schema, xml_doc, report, workers=None, engine=None, document_index=None,
+                      cancellation=None):
+    """
+    Validates the given document, with the patterns of the compiled schema divided over a pool
+    of worker processes
+    :param compiled_schema: The CompiledSchema to validate against
+    :param xml_doc: The document to validate (an ElementTree)
+    :param report: The report object that the results are passed to
+    :param workers: The number of worker processes, the number of CPUs if None
+    :param engine: The name of the validation engine to use, see pyschematron.engines
+    :param document_index: The DocumentIndex of the document, for serial validation; created if not given
+    :param cancellation: An object with an is_set() method; once it is set, the validation stops with a
+                         SchematronCancelledError (in a pool, before the results of the next pattern are used)
+    :return: None
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = min(workers, len(compiled_schema.patterns))
+    if workers <= 1 or get_engine(engine).get_name() == 'xslt':
+        if document_index is None:
+            document_index = DocumentIndex(xml_doc, compiled_schema.keys)
+        get_engine(engine).validate(compiled_schema, xml_doc, report, document_index, cancellation)
+        return
+
+    document = etree.tostring(xml_doc)
+    mp_context = get_multiprocessing_context()
+    initargs = (get_schema_arguments(compiled_schema, mp_context), document, xml_doc.docinfo.URL)
+    with ProcessPoolExecutor(workers, mp_context=mp_context, initializer=_init_worker, initargs=initargs) as executor:
+        futures = [executor.submit(_validate_pattern_in_worker, position, engine)
+                   for position in range(len(compiled_schema.patterns))]
+        nodes = get_nodes(xml_doc)
+        for future in futures:
+            calls = future.result()
+            if cancellation is not None and cancellation.is_set():
+                executor.shutdown(cancel_futures=True)
+                raise SchematronCancelledError("The validation was cancelled")
+            replay(calls, compiled_schema, nodes, report)
@@ -1,7 +1,187 @@
+import threading
+from collections import OrderedDict
+
+from elementpath.xpath_nodes import is_element_node, is_document_node
+
 from pyschematron.exceptions import SchematronError, SchematronNotImplementedError
+from pyschematron.elementpath_extensions.context import XPathContextXSLT
+from pyschematron.query_bindings.patterns import compile_match_pattern
+from pyschematron.query_bindings.joins import rewrite_joins
+from pyschematron.query_bindings.hoisting import hoist_constants
+
+# The default maximum number of parsed expressions that a query binding keeps around
+DEFAULT_EXPRESSION_CACHE_SIZE = 1024
+
+
+class CompiledExpression(object):
+    """
+    A parsed query expression, which can be evaluated against any number of context items.
+
+    The token tree does not contain any variable values; those are passed to the dynamic
+    context on every evaluation, so the same compiled expression can be shared by every
+    context element (and every document) it is evaluated on.
+
+    'rewrites' lists the optimizations that were applied to the token tree (joins.JoinIndex
+    and hoisting.HoistedExpression objects), see describe_rewrites().
+    """
+
+    def __init__(self, expression, root_token, rewrites=()):
+        self.expression = expression
+        self.root_token = root_token
+        self.rewrites = tuple(rewrites)
+        self._match_pattern = None
+        self._match_pattern_compiled = False
+
+    def create_context(self, xml_document, context_item=None, variables=None, document_index=None):
+        if document_index is not None and document_index.xml_document is not xml_document:
+            # The index belongs to another document (or to the document of a subtree root)
+            document_index = None
+        return XPathContextXSLT(root=xml_document, item=context_item, variables=variables,
+                                document_index=document_index)
+
+    def evaluate(self, xml_document, context_item=None, variables=None, document_index=None):
+        """
+        Evaluate the expression
+        :param xml_document: The document (or element) that acts as the root of the evaluation
+        :param context_item: The context item, if None, the root is used
+        :param variables: dict of variable names and (evaluated) values
+        :param document_index: Optional DocumentIndex of xml_document, for fast upward navigation
+        :return: The raw result of the evaluation
+        """
+        context = self.create_context(xml_document, context_item, variables, document_index)
+        return self.root_token.evaluate(context)
+
+    def get_results(self, xml_document, context_item=None, variables=None, document_index=None):
+        """
+        Evaluate the expression, and return its results in the same format as elementpath.select()
+        """
+        context = self.create_context(xml_document, context_item, variables, document_index)
+        return self.root_token.get_results(context)
+
+    def get_match_pattern(self):
+        """
+        Returns the expression as an XSLT match pattern (see patterns.py), or None if it
+        is not a pattern that can be matched node by node
+        """
+        if not self._match_pattern_compiled:
+            self._match_pattern = compile_match_pattern(self.root_token)
+            self._match_pattern_compiled = True
+        return self._match_pattern
+
+    def describe_rewrites(self):
+        """
+        Returns a list of descriptions of the optimizations that were applied to this expression
+        """
+        return [rewrite.describe() for rewrite in self.rewrites]
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self.expression)
+
+
+class ExpressionCache(object):
+    """
+    A bounded, thread-safe LRU cache of compiled expressions.
+
+    Each query binding has one of these, so that every expression is only parsed once,
+    regardless of the number of elements it is evaluated on.
+    """
+
+    def __init__(self, max_size=DEFAULT_EXPRESSION_CACHE_SIZE):
+        if max_size < 1:
+            raise SchematronError("Expression cache size must be at least 1")
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(parser_class, expression, namespaces, variables):
+        """
+        Create the cache key for the given expression.
+        Only the *names* of the variables are part of the key, the values are not.
+        """
+        if namespaces:
+            namespaces = tuple(sorted(namespaces.items()))
+        else:
+            namespaces = ()
+        if variables:
+            variables = frozenset(variables)
+        else:
+            variables = frozenset()
+        return parser_class, expression, namespaces, variables
+
+    def get(self, key, create_function):
+        """
+        Return the entry for the given key, calling create_function() to create it if
+        it is not in the cache yet.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return entry
+            self.misses += 1
+            entry = create_function()
+            self._entries[key] = entry
+            if len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+            return entry
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def get_statistics(self):
+        """
+        Return the cache counters as a dict
+        """
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def document_order(xml_document, nodes):
+    """
+    Returns the given nodes without duplicates, with the element nodes in document order.
+    Other results (such as attribute values) are kept, in their original order, after the elements.
+    """
+    elements = set()
+    others = []
+    for node in nodes:
+        if is_element_node(node):
+            elements.add(node)
+        elif node not in others:
+            others.append(node)
+    if is_document_node(xml_document):
+        iterator = xml_document.getroot().iter()
+    else:
+        iterator = xml_document.iter()
+    return [element for element in iterator if element in elements] + others
 
 
 class QueryBinding(object):
+    """
+    Base class for the query bindings.
+
+    Derived classes implement the compile_*() methods, which turn the expressions found in a
+    schema into CompiledExpression objects; the evaluate_*() methods are convenience wrappers
+    that compile (or fetch from the cache) and evaluate in one go.
+    """
     #
     # Mandatory to implement in derived classes
     #
@@ -16,20 +196,65 @@ class QueryBinding(object):
         """
         return self.name
 
-    def get_context_elements(self, xml_document, rule_context, namespaces, variables):
+    def compile_rule_context(self, rule_context, namespaces, variables):
         """
-        Returns the elements that are specified by the context statement
-        :param xml_document: The document that is processed
+        Compiles the given rule context expression
         :param rule_context: The rule context expression
         :param namespaces: Namespaces to be used in the rule context expression
+        :param variables: Variables that are in scope for the expression (only the names are used)
+        :return: a CompiledExpression
+        """
+        raise SchematronNotImplementedError("%s not implemented in query binding %s" % ("context element selection", self.get_name()))
+
+    def select_context_elements(self, xml_document, context_expression, variables, document_index=None):
+        """
+        Returns the elements that are specified by the given compiled context expression
+        :param xml_document: The document that is processed
+        :param context_expression: The result of compile_rule_context()
         :param variables: Variables to be used in the rule context expression
-        :return:
+        :param document_index: Optional DocumentIndex of the document
+        :return: list of matching nodes
         """
         raise SchematronNotImplementedError("%s not implemented in query binding %s" % ("context element selection", self.get_name()))
 
-    def evaluate_assertion(self, xml_document, context_element, namespaces, parser_variables, assertion):
+    def create_context_matcher(self, xml_document, context_expression, variables, document_index=None):
+        """
+        Returns a function that takes a single document node, and returns True if
+        that node matches the given compiled context expression.
+
+        Rule contexts that are XSLT patterns are matched directly; for other expressions,
+        all matching nodes are selected once, and the function tests for membership.
+        :param xml_document: The document that is processed
+        :param context_expression: The result of compile_rule_context()
+        :param variables: Variables to be used in the rule context expression
+        :param document_index: Optional DocumentIndex of the document
+        :return: a function node -> bool
+        """
+        pattern = context_expression.get_match_pattern()
+        if pattern is not None:
+            return pattern.create_matcher(xml_document, variables, document_index)
+        nodes = set(node for node in self.select_context_elements(xml_document, context_expression, variables,
+                                                                  document_index)
+                    if is_element_node(node))
+        return nodes.__contains__
+
+    def compile_assertion(self, assertion, namespaces, variables):
         raise SchematronNotImplementedError("%s not implemented in query binding %s" % ("assertion evaluation", self.get_name()))
 
+    def compile_assertion_filter(self, assertion, namespaces, variables, nodes_variable, negate=False):
+        """
+        Compiles an expression that returns the nodes in the variable nodes_variable for which
+        the given assertion is true (or false, if negate is True).
+        This is used to evaluate an assertion for all the context nodes of a rule in one query.
+        :param assertion: The assertion expression
+        :param namespaces: Namespaces to be used in the expression
+        :param variables: Variables that are in scope for the expression (only the names are used)
+        :param nodes_variable: The name of the variable that will hold the context nodes
+        :param negate: If True, select the nodes for which the assertion is false
+        :return: a CompiledExpression, or None if the query binding does not support this
+        """
+        return None
+
     #
     # Optional to implement in derived classes
     #
@@ -39,11 +264,83 @@ class QueryBinding(object):
     def get_abstract_pattern_delimiter(self):
         raise SchematronNotImplementedError("%s not implemented in query binding %s" % ("name query interpretation", self.get_name()))
 
-    def evaluate_name_query(self, xml_document, context_element, namespaces, parser_variables, name_query):
+    def compile_name_query(self, name_query, namespaces, variables):
         raise SchematronNotImplementedError("%s not implemented in query binding %s" % ("name query interpretation", self.get_name()))
 
-    def evaluate_value_of_query(self, xml_document, context_element, namespaces, parser_variables, name_query):
+    def compile_value_of_query(self, name_query, namespaces, variables):
         raise SchematronNotImplementedError("%s not implemented in query binding %s" % ("value-of query interpretation", self.get_name()))
 
-    def interpret_let_statement(self, xml_document, value, namespaces, variables):
+    def compile_let_statement(self, value, namespaces, variables):
         raise SchematronNotImplementedError("%s not implemented in query binding %s" % ("let statement interpretation", self.get_name()))
+
+    def compile_key_use(self, use, namespaces):
+        """
+        Compiles the use expression of a key, which returns the values that a node is indexed by
+        :return: a CompiledExpression
+        """
+        return self.compile_assertion(use, namespaces, [])
+
+    #
+    # Evaluation of (uncompiled) expressions
+    #
+    def get_context_elements(self, xml_document, rule_context, namespaces, variables):
+        """
+        Returns the elements that are specified by the context statement
+        :param xml_document: The document that is processed
+        :param rule_context: The rule context expression
+        :param namespaces: Namespaces to be used in the rule context expression
+        :param variables: Variables to be used in the rule context expression
+        :return:
+        """
+        context_expression = self.compile_rule_context(rule_context, namespaces, variables)
+        return self.select_context_elements(xml_document, context_expression, variables)
+
+    def evaluate_assertion(self, xml_document, context_element, namespaces, parser_variables, assertion):
+        compiled = self.compile_assertion(assertion, namespaces, parser_variables)
+        return compiled.evaluate(xml_document, context_element, parser_variables)
+
+    def evaluate_name_query(self, xml_document, context_element, namespaces, parser_variables, name_query):
+        compiled = self.compile_name_query(name_query, namespaces, parser_variables)
+        return compiled.evaluate(xml_document, context_element, parser_variables)
+
+    def evaluate_value_of_query(self, xml_document, context_element, namespaces, parser_variables, name_query):
+        compiled = self.compile_value_of_query(name_query, namespaces, parser_variables)
+        return compiled.evaluate(xml_document, context_element, parser_variables)
+
+    def interpret_let_statement(self, xml_document, value, namespaces, variables, context_item=None):
+        compiled = self.compile_let_statement(value, namespaces, variables)
+        return compiled.evaluate(xml_document, context_item, variables)
+
+    #
+    # Expression caching, shared by all query bindings that have an 'expression_cache'
+    #
+    def compile_expression(self, parser_class, expression, namespaces, variables):
+        """
+        Parse the given expression with the given parser class, or return the result of
+        an earlier parse of the same expression.
+
+        :param parser_class: The elementpath parser class to use
+        :param expression: The expression text
+        :param namespaces: The namespace prefixes that can be used in the expression
+        :param variables: The variables that are in scope (only their names are used)
+        :return: a CompiledExpression
+        """
+        key = ExpressionCache.make_key(parser_class, expression, namespaces, variables)
+        return self.expression_cache.get(key, lambda: self.create_compiled_expression(parser_class, expression, namespaces))
+
+    def create_compiled_expression(self, parser_class, expression, namespaces):
+        """
+        Parses the given expression (without using the cache), replaces the join predicates
+        in it by index lookups (see joins.py) and memoizes its document constants (see hoisting.py)
+        :return: a CompiledExpression
+        """
+        root_token, joins = rewrite_joins(parser_class(namespaces).parse(expression))
+        root_token, hoisted = hoist_constants(root_token)
+        return CompiledExpression(expression, root_token, joins + hoisted)
+
+    def get_cache_statistics(self):
+        """
+        Returns the hit, miss and eviction counters of the expression cache of this query binding
+        :return: A dict with the cache counters
+        """
+        return self.expression_cache.get_statistics()
@@ -0,0 +1,174 @@
+"""
+Static analysis of parsed expressions.
+
+These functions inspect the token trees of compiled expressions, to find out what an
+expression depends on (variables, the current() node, the context position) without
+evaluating it.
+"""
+
+
+def iter_tokens(token):
+    """
+    Yields the given token and all of its descendants
+    """
+    yield token
+    for child in token:
+        yield from iter_tokens(child)
+
+
+def uses_symbols(token, symbols):
+    """
+    Returns True if the given token tree contains a token with one of the given symbols
+    (function names, such as 'current' or 'position', are symbols as well)
+    """
+    return any(t.symbol in symbols for t in iter_tokens(token))
+
+
+def get_variable_references(token):
+    """
+    Returns the set of the names of the variables that are referenced in the given token tree
+    """
+    return set(t[0].value for t in iter_tokens(token) if t.symbol == '$' and len(t) == 1)
+
+
+# The node tests that match nodes that are not elements
+NON_ELEMENT_KIND_TESTS = frozenset(['text', 'comment', 'processing-instruction', 'node', 'attribute',
+                                    'namespace-node', 'document-node', 'schema-attribute'])
+
+
+def can_select_non_elements(token):
+    """
+    Returns True if the nodes that the given path expression (a rule context) selects can be
+    attributes, text nodes or other nodes that are not elements, judging by the last step of
+    (every alternative of) the path. Function calls, such as key(), are assumed to return elements.
+    """
+    symbol = token.symbol
+    if symbol in ('|', 'union', 'intersect', 'except'):
+        return any(can_select_non_elements(child) for child in token)
+    if symbol in ('/', '//'):
+        return len(token) > 0 and can_select_non_elements(token[-1])
+    if symbol in ('[', '('):
+        return can_select_non_elements(token[0])
+    if symbol == '@' or (symbol in ('attribute', 'namespace') and token.label == 'axis'):
+        return True
+    if token.label == 'axis':
+        return can_select_non_elements(token[0])
+    return token.label == 'kind test' and symbol in NON_ELEMENT_KIND_TESTS
+
+
+# Functions that use the context item (or position) even when they are called with arguments
+CONTEXT_FUNCTIONS = frozenset(['position', 'last', 'lang'])
+# Functions that use the context item when they are called without arguments
+CONTEXT_ITEM_FUNCTIONS = frozenset(['name', 'local-name', 'namespace-uri', 'string', 'normalize-space', 'number',
+                                    'string-length', 'data', 'base-uri', 'document-uri', 'root', 'node-name',
+                                    'nilled', 'generate-id', 'path', 'has-children'])
+
+
+def is_context_free(token):
+    """
+    Returns True if the value of the given token tree does not depend on the context item,
+    position or size. It may still depend on variables, on current() and on the document.
+    This is a conservative test: it returns False for every construct it does not know.
+    """
+    symbol = token.symbol
+    if symbol in ('$', 'current'):
+        return True
+    if symbol in CONTEXT_FUNCTIONS:
+        return False
+    if symbol in ('/', '//'):
+        # Absolute paths start at the root, the other steps are relative to the first
+        return len(token) < 2 or is_context_free(token[0])
+    if symbol == '[':
+        return is_context_free(token[0])
+    if symbol in ('(name)', '.', '..', '@') or token.label == 'axis' or (symbol == '*' and len(token) == 0):
+        return False
+    if symbol == ':':
+        # A prefixed name test, or a prefixed function call
+        return token[1].label == 'function' and is_context_free(token[1])
+    if symbol in ('for', 'some', 'every'):
+        # These bind variables of their own
+        return False
+    if token.label == 'literal':
+        return True
+    if len(token) == 0:
+        return token.label in ('function', 'symbol') and symbol not in CONTEXT_ITEM_FUNCTIONS
+    return all(is_context_free(child) for child in token)
+
+
+# Functions that look up nodes in the document of the context item
+DOCUMENT_FUNCTIONS = frozenset(['current', 'key', 'id', 'idref', 'element-with-id'])
+
+
+def is_document_independent(token):
+    """
+    Returns True if the value of the given token tree depends neither on the context nor on
+    the document (it may still depend on variables)
+    """
+    if not is_context_free(token):
+        return False
+    return not any(t.symbol in DOCUMENT_FUNCTIONS or (t.symbol in ('/', '//') and len(t) < 2)
+                   for t in iter_tokens(token))
+
+
+def to_source(token):
+    """
+    Returns the expression text of the given token tree (for messages and explain output)
+    """
+    symbol = token.symbol
+    if token.label == 'function' or symbol in ('current', 'key'):
+        return "%s(%s)" % (symbol, ", ".join(to_source(child) for child in token))
+    if symbol in ('/', '//'):
+        if len(token) == 0:
+            return symbol
+        if len(token) == 1:
+            return symbol + to_source(token[0])
+        return to_source(token[0]) + symbol + to_source(token[1])
+    if symbol == '[':
+        return "%s[%s]" % (to_source(token[0]), to_source(token[1]))
+    if symbol == '(':
+        return "(%s)" % to_source(token[0])
+    if symbol == ':':
+        return "%s:%s" % (to_source(token[0]), to_source(token[1]))
+    if symbol in ('@', '$'):
+        return symbol + to_source(token[0])
+    if token.label == 'axis':
+        return "%s::%s" % (symbol, to_source(token[0]))
+    if symbol == '(string)':
+        return "'%s'" % token.value
+    if len(token) == 0:
+        return str(token.value)
+    if len(token) == 1:
+        return symbol + to_source(token[0])
+    return (" %s " % symbol).join(to_source(child) for child in token)
+
+
+# Axes that stay within the subtree of the node they start at
+SUBTREE_AXES = frozenset(['child', 'attribute', 'self', 'descendant', 'descendant-or-self'])
+# Functions that look outside the subtree of the context node: at the rest of the document (or
+# at other documents), or at its ancestors
+NON_SUBTREE_FUNCTIONS = frozenset(['key', 'id', 'idref', 'element-with-id', 'root', 'path', 'lang', 'base-uri',
+                                   'doc', 'doc-available', 'document', 'collection', 'unparsed-text'])
+
+
+def is_subtree_local(token):
+    """
+    Returns True if the value of the given token tree only depends on the context node, its
+    attributes and its descendants (and on variables, and on current()). The position of the
+    context node among its siblings is not considered; the tests of a rule are evaluated with
+    a context position of 1.
+    This is a conservative test: it returns False for every construct it does not know.
+    """
+    symbol = token.symbol
+    if symbol in ('$', 'current', '(name)', '.', '@') or (symbol == '*' and len(token) == 0):
+        return symbol != '@' or is_subtree_local(token[0])
+    if symbol in ('/', '//'):
+        # Absolute paths start at the root; the second step of a relative path starts at the
+        # nodes that the first step selects
+        return len(token) == 2 and is_subtree_local(token[0]) and is_subtree_local(token[1])
+    if symbol == '..' or symbol in NON_SUBTREE_FUNCTIONS:
+        return False
+    if token.label == 'axis':
+        return symbol in SUBTREE_AXES and is_subtree_local(token[0])
+    if token.label == 'literal':
+        return True
+    return all(is_subtree_local(child) for child in token)
@@ -0,0 +1,135 @@
+"""
+Hoisting of document constants.
+
+Assertions often repeat absolute lookups, such as
+
+    . = /ubl:Invoice/cbc:DocumentCurrencyCode
+
+which are evaluated again for every context node, although their value is the same for the
+whole document. When an expression is compiled, the largest subexpressions that
+
+- contain an absolute path (or a key() lookup),
+- do not depend on the context item, position or size, and
+- do not use current() or variables
+
+are replaced by a copy of their token that memoizes its value in the DocumentIndex of the
+document: it is evaluated once per document, and looked up for every evaluation after that.
+Variables are excluded because compiled expressions are shared between patterns and rules,
+in which the same name can have different values.
+
+Every hoisted subexpression is described by a HoistedExpression, which counts how often it
+was evaluated and how often its memoized value was used.
+"""
+from copy import copy
+
+from elementpath.xpath_nodes import is_document_node
+
+from pyschematron.query_bindings.analysis import iter_tokens, uses_symbols, is_context_free, to_source
+
+
+class HoistedExpression(object):
+    """
+    A subexpression whose value is computed once per document
+    """
+
+    def __init__(self, token):
+        self.token = token
+        # Approximate when documents are validated concurrently
+        self.evaluations = 0
+        self.hits = 0
+
+    def describe(self):
+        return "%s: evaluated once per document (%d evaluations, %d hits)" % (to_source(self.token),
+                                                                              self.evaluations, self.hits)
+
+    def get_statistics(self):
+        """
+        Return the counters as a dict
+        """
+        return {'evaluations': self.evaluations, 'hits': self.hits}
+
+    def get_value(self, context, kind, create_function):
+        """
+        Returns the memoized value of the given kind ('evaluate' or 'select') for the document of
+        the given context, calling create_function() to compute it if it is not known yet
+        """
+        document_index = getattr(context, 'document_index', None)
+        if document_index is None or not is_document_node(context.root):
+            return create_function()
+        values = document_index.hoisted_values
+        key = (self, kind)
+        # The counters are only statistics: the increments of concurrent validations may be lost
+        if key in values:
+            self.hits += 1
+            return values[key]
+        self.evaluations += 1
+        value = values[key] = create_function()
+        return value
+
+    def create_token(self):
+        """
+        Returns a copy of the original token, that memoizes its value
+        """
+        cls = type(self.token)
+        hoisted_cls = _hoisted_classes.get(cls)
+        if hoisted_cls is None:
+            hoisted_cls = _hoisted_classes[cls] = create_hoisted_class(cls)
+        token = copy(self.token)
+        token.__class__ = hoisted_cls
+        token.hoisted = self
+        return token
+
+
+_hoisted_classes = {}
+
+
+def create_hoisted_class(cls):
+    """
+    Returns a subclass of the given token class, that memoizes the results of evaluate() and
+    select() per document (see joins.create_indexed_class for why this is not a mixin)
+    """
+    def evaluate(self, context=None):
+        if context is None:
+            return cls.evaluate(self, context)
+        value = self.hoisted.get_value(context, 'evaluate', lambda: cls.evaluate(self, context))
+        # Callers may modify the lists they get
+        return list(value) if isinstance(value, list) else value
+
+    def select(self, context=None):
+        if context is None:
+            return cls.select(self, context)
+        return iter(self.hoisted.get_value(context, 'select', lambda: list(cls.select(self, context))))
+
+    return type("Hoisted%s" % cls.__name__, (cls,), {'evaluate': evaluate, 'select': select, 'hoisted': None})
+
+
+def is_lookup(token):
+    """
+    Returns True if the given token tree contains an absolute path or a key() call
+    """
+    return any((t.symbol in ('/', '//') and len(t) < 2) or t.symbol == 'key' for t in iter_tokens(token))
+
+
+def can_hoist(token):
+    return is_lookup(token) and is_context_free(token) and not uses_symbols(token, ('current', '$'))
+
+
+def _hoist(token, hoisted):
+    if can_hoist(token):
+        expression = HoistedExpression(token)
+        hoisted.append(expression)
+        return expression.create_token()
+    for index, child in enumerate(token):
+        token[index] = _hoist(child, hoisted)
+    return token
+
+
+def hoist_constants(root_token):
+    """
+    Replaces the largest document-constant subexpressions of the given token tree by tokens
+    that memoize their value
+    :param root_token: The root of a parsed expression
+    :return: a tuple of the new root token, and the list of HoistedExpression objects that were created
+    """
+    hoisted = []
+    return _hoist(root_token, hoisted), hoisted
@@ -0,0 +1,174 @@
+"""
+Automatic join indexes.
+
+Schemas often check references and uniqueness with expressions like
+
+    count(//cac:Item[cbc:ID = current()/cbc:ID]) = 1
+
+elementpath evaluates this by walking the whole document for every context node, which is
+quadratic in the size of the document. When an expression is compiled, every absolute path
+whose last step has a predicate of the form 'key = value' is recognized, where
+
+- the path without that predicate does not depend on the context, variables or current(),
+- 'key' depends only on the node that is filtered (such as cbc:ID), and
+- 'value' does not depend on the node that is filtered, but does use current() or
+  variables (it may also use absolute paths).
+
+Such a path is replaced by an indexed copy of its token. The first time it is evaluated for a
+document, it selects all the nodes of the path once, and builds a hash index of them by
+the string values of 'key' (stored in the DocumentIndex of the document). Every
+evaluation after that evaluates 'value' once and looks the nodes up in the index.
+
+The index is only used when the comparison is a string comparison (all the key and value
+items are nodes or strings); in every other case, and when there is no DocumentIndex, the
+original expression is evaluated.
+"""
+from copy import copy
+
+from elementpath.xpath_nodes import is_xpath_node, is_document_node
+
+from pyschematron.elementpath_extensions.context import get_key_value
+from pyschematron.query_bindings.analysis import uses_symbols, is_context_free, to_source
+
+
+class JoinIndex(object):
+    """
+    A recognized join: 'path' is the original path token, 'base' the same path without the
+    join predicate, and 'key' and 'value' are the two sides of the comparison.
+    Joins with the same base path and key (in different expressions of a schema) share
+    their index; 'index_key' identifies it.
+    """
+
+    def __init__(self, path, base, key, value):
+        self.path = path
+        self.base = base
+        self.key = key
+        self.value = value
+        self.index_key = (to_source(base), to_source(key))
+
+    def describe(self):
+        return "%s: index %s by %s, look up %s" % (to_source(self.path), to_source(self.base),
+                                                   to_source(self.key), to_source(self.value))
+
+    def build_index(self, context):
+        """
+        Selects the nodes of the base path, and indexes them by their key values
+        :return: a tuple of the list of nodes and a dict of key values to lists of positions in
+                 that list, or None if the key values cannot be compared as strings
+        """
+        base_context = context.copy()
+        base_context.item = base_context.root
+        nodes = list(self.base.select(base_context))
+        index = {}
+        for position, node in enumerate(nodes):
+            key_context = context.copy()
+            key_context.item = node
+            for item in self.key.select(key_context):
+                if not is_xpath_node(item) and not isinstance(item, str):
+                    return None
+                positions = index.setdefault(get_key_value(item), [])
+                if not positions or positions[-1] != position:
+                    positions.append(position)
+        return nodes, index
+
+    def lookup(self, context):
+        """
+        Returns the nodes that the original path would select in the given context, or None
+        if the index cannot be used
+        """
+        document_index = getattr(context, 'document_index', None)
+        if document_index is None or not is_document_node(context.root):
+            return None
+        values = list(self.value.select(context.copy()))
+        if not all(is_xpath_node(value) or isinstance(value, str) for value in values):
+            return None
+        join_index = document_index.get_join_index(self, context)
+        if join_index is None:
+            return None
+        nodes, index = join_index
+        if len(values) == 1:
+            positions = index.get(get_key_value(values[0]), ())
+        else:
+            positions = sorted(set(position for value in values for position in index.get(get_key_value(value), ())))
+        return [nodes[position] for position in positions]
+
+    def create_token(self):
+        """
+        Returns a copy of the original path token, that selects its nodes through this join index
+        """
+        cls = type(self.path)
+        indexed_cls = _indexed_classes.get(cls)
+        if indexed_cls is None:
+            indexed_cls = _indexed_classes[cls] = create_indexed_class(cls)
+        token = copy(self.path)
+        token.__class__ = indexed_cls
+        token.join = self
+        return token
+
+
+_indexed_classes = {}
+
+
+def create_indexed_class(cls):
+    """
+    Returns a subclass of the given path token class, that selects its nodes through the
+    join index of the token (and falls back to the original select if it cannot be used).
+    The tokens are converted to this class in place, so it cannot add a mixin to the bases.
+    """
+    def select(self, context=None):
+        nodes = self.join.lookup(context) if context is not None else None
+        if nodes is None:
+            return cls.select(self, context)
+        return iter(nodes)
+
+    return type("Indexed%s" % cls.__name__, (cls,), {'select': select, 'join': None})
+
+
+def find_join(token):
+    """
+    Returns a JoinIndex if the given token is an absolute path that ends with a join predicate,
+    None otherwise
+    """
+    if token.symbol not in ('/', '//') or len(token) == 0 or token[-1].symbol != '[':
+        return None
+    step = token[-1]
+    predicate = step[1]
+    if predicate.symbol != '=':
+        return None
+    if len(token) == 2 and not is_context_free(token[0]):
+        # Not an absolute path
+        return None
+    base = copy(token)
+    base._operands = list(token._operands)
+    base[-1] = step[0]
+    if uses_symbols(base, ('current', '$')):
+        return None
+
+    for key, value in ((predicate[0], predicate[1]), (predicate[1], predicate[0])):
+        if is_context_free(key) or uses_symbols(key, ('current', '$', 'position', 'last')):
+            continue
+        if is_context_free(value) and uses_symbols(value, ('current', '$')):
+            # (If the value does not use current() or variables, the whole path is a
+            # document constant, see hoisting.py)
+            return JoinIndex(token, base, key, value)
+    return None
+
+
+def _rewrite(token, joins):
+    for index, child in enumerate(token):
+        token[index] = _rewrite(child, joins)
+    join = find_join(token)
+    if join is None:
+        return token
+    joins.append(join)
+    return join.create_token()
+
+
+def rewrite_joins(root_token):
+    """
+    Replaces the paths with join predicates in the given token tree by indexed tokens
+    :param root_token: The root of a parsed expression
+    :return: a tuple of the new root token, and the list of JoinIndex objects that were created
+    """
+    joins = []
+    return _rewrite(root_token, joins), joins
@@ -0,0 +1,261 @@
+"""
+Matching of rule contexts as XSLT patterns.
+
+A rule context such as 'a/b[@x]//c' is not evaluated as an expression relative to every
+element of the document; instead, each node is tested against it once, from right to
+left: the node itself must match the last step, its parent (or one of its ancestors,
+for '//') the step before it, and so on.
+
+Only the patterns that consist of element steps on the child axis (names, prefixed
+names and wildcards, with any predicates) are supported; compile_match_pattern() returns
+None for everything else, and the query binding then falls back to expression evaluation.
+"""
+from decimal import Decimal
+
+from elementpath.xpath_nodes import is_element_node
+
+from pyschematron.elementpath_extensions.context import XPathContextXSLT
+from pyschematron.query_bindings.analysis import uses_symbols
+
+
+class UnsupportedPattern(Exception):
+    """Raised internally when a token tree cannot be turned into a match pattern"""
+    pass
+
+
+class StepPattern(object):
+    """
+    A single step of a location path pattern: an element name test and its predicates.
+    'name' is the expanded name ('{namespace}local' or 'local') of the elements that
+    match the step, or None if the step matches elements of any name.
+    """
+
+    def __init__(self, name, name_test, predicates):
+        self.name = name
+        self.name_test = name_test
+        self.predicates = tuple(predicates)
+        self.predicates_need_position = tuple(uses_symbols(predicate, ('position', 'last'))
+                                              for predicate in self.predicates)
+
+    def matches(self, node, matcher):
+        if not self.name_test(node):
+            return False
+        for index in range(len(self.predicates)):
+            if not self.matches_predicate(node, index, matcher):
+                return False
+        return True
+
+    def matches_predicate(self, node, index, matcher):
+        predicate = self.predicates[index]
+        if self.predicates_need_position[index]:
+            position, size = self.get_position(node, index, matcher)
+        else:
+            position, size = 1, 1
+        context = XPathContextXSLT(root=matcher.xml_document, item=node, position=position, size=size,
+                                   variables=matcher.variables, document_index=matcher.document_index)
+        result = predicate.evaluate(context)
+        if isinstance(result, (int, float, Decimal)) and not isinstance(result, bool):
+            if not self.predicates_need_position[index]:
+                position, size = self.get_position(node, index, matcher)
+            return position == result
+        return predicate.boolean_value(result)
+
+    def get_position(self, node, index, matcher):
+        """
+        Returns the position and size of the node within the sibling elements that
+        match the name test and the predicates before the given one
+        """
+        parent = matcher.get_parent(node)
+        if parent is None:
+            return 1, 1
+        position = 0
+        size = 0
+        for sibling in parent:
+            if not self.name_test(sibling):
+                continue
+            if any(not self.matches_predicate(sibling, i, matcher) for i in range(index)):
+                continue
+            size += 1
+            if sibling is node:
+                position = size
+        return position, size
+
+
+class LocationPathPattern(object):
+    """
+    A sequence of steps, stored from left to right, and the separators between them.
+    separators[i] is the separator before steps[i]: None for the first step of a relative
+    pattern, '/' (the parent of the node must be the document) or '//' for the first step
+    of an absolute pattern, and '/' or '//' between steps.
+    """
+
+    def __init__(self, steps, separators):
+        self.steps = tuple(steps)
+        self.separators = tuple(separators)
+
+    @property
+    def last_step(self):
+        return self.steps[-1]
+
+    def matches(self, node, matcher, index=None):
+        if index is None:
+            index = len(self.steps) - 1
+        if not self.steps[index].matches(node, matcher):
+            return False
+        parent = matcher.get_parent(node)
+        separator = self.separators[index]
+        if index == 0:
+            if separator == '/':
+                return parent is None
+            return True
+        if separator == '/':
+            return parent is not None and self.matches(parent, matcher, index - 1)
+        while parent is not None:
+            if self.matches(parent, matcher, index - 1):
+                return True
+            parent = matcher.get_parent(parent)
+        return False
+
+
+class MatchPattern(object):
+    """
+    A union of one or more location path patterns
+    """
+
+    def __init__(self, alternatives):
+        self.alternatives = tuple(alternatives)
+
+    def create_matcher(self, xml_document, variables=None, document_index=None):
+        """
+        Returns a function that tests whether a single node of the given document matches
+        this pattern
+        """
+        return PatternMatcher(self, xml_document, variables, document_index)
+
+    def select(self, xml_document, variables=None, document_index=None):
+        """
+        Returns all the elements in the given document that match this pattern, in
+        document order
+        """
+        matcher = self.create_matcher(xml_document, variables, document_index)
+        return [element for element in matcher.iter_elements() if matcher(element)]
+
+
+class PatternMatcher(object):
+    """
+    A MatchPattern bound to a document and the variables that are in scope
+    """
+
+    def __init__(self, pattern, xml_document, variables, document_index=None):
+        self.pattern = pattern
+        self.xml_document = xml_document
+        self.variables = variables
+        if hasattr(xml_document, 'getroot'):
+            self.root = xml_document.getroot()
+        else:
+            self.root = xml_document
+        if document_index is not None and document_index.xml_document is not xml_document:
+            document_index = None
+        self.document_index = document_index
+        self._parent_map = None
+
+    def iter_elements(self):
+        for element in self.root.iter():
+            if is_element_node(element):
+                yield element
+
+    def get_parent(self, element):
+        """
+        Returns the parent element of the given element, or None for the root element
+        """
+        if element is self.root:
+            return None
+        if hasattr(element, 'getparent'):
+            return element.getparent()
+        if self.document_index is not None:
+            return self.document_index.get_parent(element)
+        if self._parent_map is None:
+            self._parent_map = {child: parent for parent in self.root.iter() for child in parent}
+        return self._parent_map.get(element)
+
+    def __call__(self, node):
+        if not is_element_node(node):
+            return False
+        for alternative in self.pattern.alternatives:
+            if alternative.matches(node, self):
+                return True
+        return False
+
+
+def _compile_name_test(token):
+    """
+    Returns the expanded name and the name test function for the node test of a step
+    """
+    if token.symbol == 'child' and token.label == 'axis':
+        token = token[0]
+
+    if token.symbol == '(name)':
+        name = token.value
+        if name[0] != '{' and token.parser.default_namespace:
+            name = '{%s}%s' % (token.parser.default_namespace, name)
+        return name, lambda node: is_element_node(node) and node.tag == name
+    elif token.symbol == '*' and len(token) == 0:
+        return None, lambda node: is_element_node(node)
+    elif token.symbol == ':' and token[1].label not in ('function', 'constructor'):
+        if token[0].value == '*':
+            name = '*:%s' % token[1].value
+            return None, lambda node: is_element_node(node, name)
+        namespace = token.get_namespace(token[0].value)
+        if token[1].symbol == '*':
+            name = '{%s}*' % namespace
+            return None, lambda node: is_element_node(node, name)
+        name = '{%s}%s' % (namespace, token[1].value)
+        return name, lambda node: is_element_node(node) and node.tag == name
+    raise UnsupportedPattern(token.symbol)
+
+
+def _compile_step(token):
+    predicates = []
+    while token.symbol == '[':
+        predicates.insert(0, token[1])
+        token = token[0]
+    name, name_test = _compile_name_test(token)
+    return StepPattern(name, name_test, predicates)
+
+
+def _compile_path(token, steps, separators):
+    if token.symbol in ('/', '//') and len(token) == 2:
+        _compile_path(token[0], steps, separators)
+        steps.append(_compile_step(token[1]))
+        separators.append(token.symbol)
+    elif token.symbol in ('/', '//') and len(token) == 1:
+        steps.append(_compile_step(token[0]))
+        separators.append(token.symbol)
+    else:
+        steps.append(_compile_step(token))
+        separators.append(None)
+
+
+def _compile_alternatives(token, alternatives):
+    if token.symbol == '|':
+        _compile_alternatives(token[0], alternatives)
+        _compile_alternatives(token[1], alternatives)
+    else:
+        steps = []
+        separators = []
+        _compile_path(token, steps, separators)
+        alternatives.append(LocationPathPattern(steps, separators))
+
+
+def compile_match_pattern(root_token):
+    """
+    Turns the token tree of a rule context into a MatchPattern
+    :param root_token: The root of the parsed rule context expression
+    :return: a MatchPattern, or None if the expression is not a supported pattern
+    """
+    alternatives = []
+    try:
+        _compile_alternatives(root_token, alternatives)
+    except UnsupportedPattern:
+        return None
+    return MatchPattern(alternatives)
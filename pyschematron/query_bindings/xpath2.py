@@ -2,13 +2,10 @@
 The query binding implementation for XPath2
 """
 
-import elementpath
-
-from . import QueryBinding
+from . import QueryBinding, ExpressionCache, DEFAULT_EXPRESSION_CACHE_SIZE, document_order
 from pyschematron.exceptions import *
-from pyschematron.elementpath_extensions.context import XPathContextXSLT
 
-from elementpath import XPath2Parser, XPathContext, select, Selector
+from elementpath import XPath2Parser
 
 
 def instantiate():
@@ -16,33 +13,44 @@ def instantiate():
 
 
 class XPath2Binding(QueryBinding):
-    def __init__(self):
+    # The parser that all expressions are compiled with
+    parser_class = XPath2Parser
+
+    def __init__(self, cache_size=DEFAULT_EXPRESSION_CACHE_SIZE):
         self.name = "xpath2"
+        self.expression_cache = ExpressionCache(cache_size)
 
-    def get_context_elements(self, xml_document, rule_context, namespaces, variables):
-        result = select(xml_document, rule_context, namespaces=namespaces, variables=variables)
-        if rule_context.startswith('/'):
-            return result
+    def compile_rule_context(self, rule_context, namespaces, variables):
+        return self.compile_expression(self.parser_class, rule_context, namespaces, variables)
+
+    def select_context_elements(self, xml_document, context_expression, variables, document_index=None):
+        if context_expression.expression.startswith('/'):
+            return context_expression.get_results(xml_document, variables=variables, document_index=document_index)
+        pattern = context_expression.get_match_pattern()
+        if pattern is not None:
+            # Test every element once against the pattern
+            return pattern.select(xml_document, variables, document_index)
         else:
-            selector = Selector(rule_context, namespaces=namespaces, variables=variables)
+            # Not a pattern, evaluate the expression relative to every element
+            result = context_expression.get_results(xml_document, variables=variables, document_index=document_index)
             for el in xml_document.iter():
-                result.extend(selector.select(el))
-            return result
+                result.extend(context_expression.get_results(el, variables=variables))
+            return document_order(xml_document, result)
 
     def parse_expression(self, xml_document, expression, namespaces, variables, context_item=None):
-        parser = XPath2Parser(namespaces, variables)
-        root_node = parser.parse(expression)
-        context = XPathContextXSLT(root=xml_document, item=context_item)
-        result = root_node.evaluate(context)
-        return result
-
-    def evaluate_assertion(self, xml_document, context_element, namespaces, parser_variables, assertion):
-        parser = XPath2Parser(namespaces, parser_variables)
-        context = XPathContextXSLT(root=xml_document, item=context_element)
-        expr = "fn:boolean(%s)" % assertion
-        root_token = parser.parse(expr)
-        result = root_token.evaluate(context=context)
-        return result
+        compiled = self.compile_expression(self.parser_class, expression, namespaces, variables)
+        return compiled.evaluate(xml_document, context_item, variables)
+
+    def compile_assertion(self, assertion, namespaces, variables):
+        return self.compile_expression(self.parser_class, "fn:boolean(%s)" % assertion, namespaces, variables)
+
+    def compile_assertion_filter(self, assertion, namespaces, variables, nodes_variable, negate=False):
+        expression = "$%s[%s(%s)]" % (nodes_variable, "not" if negate else "boolean", assertion)
+        return self.compile_expression(self.parser_class, expression, namespaces, list(variables) + [nodes_variable])
+
+    def compile_key_use(self, use, namespaces):
+        # Not through compile_assertion(), which turns the values into a boolean
+        return self.compile_expression(self.parser_class, use, namespaces, [])
 
     def get_variable_delimiter(self):
         return "$"
@@ -50,21 +58,11 @@ class XPath2Binding(QueryBinding):
     def get_abstract_pattern_delimiter(self):
         return "$"
 
-    def evaluate_name_query(self, xml_document, context_element, namespaces, parser_variables, name_query):
-        parser = XPath2Parser(namespaces, parser_variables)
-        context = XPathContextXSLT(root=xml_document, item=context_element)
-        expr = "fn:node-name(%s)" % name_query
-        root_token = parser.parse(expr)
-        result = root_token.evaluate(context=context)
-        return result
-
-    def evaluate_value_of_query(self, xml_document, context_element, namespaces, parser_variables, name_query):
-        parser = XPath2Parser(namespaces, parser_variables)
-        context = XPathContextXSLT(root=xml_document, item=context_element)
-        expr = "fn:string(%s)" % name_query
-        root_token = parser.parse(expr)
-        result = root_token.evaluate(context=context)
-        return result
-
-    def interpret_let_statement(self, xml_document, value, namespaces, variables):
+    def compile_name_query(self, name_query, namespaces, variables):
+        return self.compile_expression(self.parser_class, "fn:node-name(%s)" % name_query, namespaces, variables)
+
+    def compile_value_of_query(self, name_query, namespaces, variables):
+        return self.compile_expression(self.parser_class, "fn:string(%s)" % name_query, namespaces, variables)
+
+    def compile_let_statement(self, value, namespaces, variables):
         raise SchematronQueryBindingError("let statement not allowed for Xpath2 query bindings")
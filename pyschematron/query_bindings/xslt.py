@@ -1,46 +1,45 @@
 
 from pyschematron.exceptions import *
 
-from elementpath import XPath1Parser, XPathContext, select, Selector
+from elementpath import XPath1Parser
 from elementpath.xpath_nodes import is_element_node
 from pyschematron.elementpath_extensions.xslt1_parser import XSLT1Parser
-from pyschematron.elementpath_extensions.context import XPathContextXSLT
+from pyschematron.query_bindings import QueryBinding, ExpressionCache, DEFAULT_EXPRESSION_CACHE_SIZE, document_order
 from lxml import etree
 
 def instantiate():
     return XSLTBinding()
 
-class XSLTBinding(object):
-    def __init__(self):
+class XSLTBinding(QueryBinding):
+    def __init__(self, cache_size=DEFAULT_EXPRESSION_CACHE_SIZE):
         self.name = 'xslt'
+        self.expression_cache = ExpressionCache(cache_size)
 
-    def get_name(self):
-        """
-        Return the query binding name
-        :return: the query binding name, as a string
-        """
-        return self.name
+    def compile_rule_context(self, rule_context, namespaces, variables):
+        return self.compile_expression(XSLT1Parser, rule_context, namespaces, variables)
 
-    def get_context_elements(self, xml_document, rule_context, namespaces, variables):
+    def select_context_elements(self, xml_document, context_expression, variables, document_index=None):
         """
         Returns the elements that are specified by the context statement
         :param xml_document: The document that is processed
-        :param rule_context: The rule context expression
-        :param namespaces: Namespaces to be used in the rule context expression
+        :param context_expression: The compiled rule context expression
         :param variables: Variables to be used in the rule context expression
+        :param document_index: Optional DocumentIndex of the document
         :return:
         """
-        #result = select(xml_document, rule_context, namespaces=namespaces, variables=variables, parser=XPath1Parser)
-        result = select(xml_document, rule_context, namespaces=namespaces, variables=variables, parser=XSLT1Parser)
-        if rule_context.startswith('/'):
-            return result
+        if context_expression.expression.startswith('/'):
+            return context_expression.get_results(xml_document, variables=variables, document_index=document_index)
+        pattern = context_expression.get_match_pattern()
+        if pattern is not None:
+            # Test every element once against the pattern
+            return pattern.select(xml_document, variables, document_index)
         else:
-            # THIS is the one were we need to use the special context parser
-            selector = Selector(rule_context, namespaces=namespaces, variables=variables, parser=XSLT1Parser)
+            # Not a pattern, evaluate the expression relative to every element
+            result = context_expression.get_results(xml_document, variables=variables, document_index=document_index)
             for el in xml_document.iter():
                 if is_element_node(el):
-                    result.extend(selector.select(el))
-            return result
+                    result.extend(context_expression.get_results(el, variables=variables))
+            return document_order(xml_document, result)
 
     def check_element_context(self, root_element, element, context, namespaces, variables):
         #result = element.xpath(context, namespaces=namespaces, _variables=variables)
@@ -55,22 +54,16 @@ class XSLTBinding(object):
         return xml_document.findall(context, namespaces=namespaces, **variables)
 
     def parse_expression(self, xml_document, expression, namespaces, variables, context_item=None):
-        parser = XSLT1Parser(namespaces, variables)
-        root_node = parser.parse(expression)
-        context = XPathContextXSLT(root=xml_document, item=context_item)
-        result = root_node.evaluate(context)
-        return result
+        compiled = self.compile_expression(XSLT1Parser, expression, namespaces, variables)
+        return compiled.evaluate(xml_document, context_item, variables)
 
-    def evaluate_assertion(self, xml_document, context_element, namespaces, parser_variables, assertion):
-        #parser = XPath1Parser(namespaces, parser_variables)
-        parser = XSLT1Parser(namespaces, parser_variables)
-        context = XPathContextXSLT(root=xml_document, item=context_element)
-        expr = assertion
+    def compile_assertion(self, assertion, namespaces, variables):
         # Should we check whether this is boolean?
-        root_token = parser.parse(expr)
-        result = root_token.evaluate(context=context)
-        return result
+        return self.compile_expression(XSLT1Parser, assertion, namespaces, variables)
 
+    def compile_assertion_filter(self, assertion, namespaces, variables, nodes_variable, negate=False):
+        expression = "$%s[%s(%s)]" % (nodes_variable, "not" if negate else "boolean", assertion)
+        return self.compile_expression(XSLT1Parser, expression, namespaces, list(variables) + [nodes_variable])
 
     def get_variable_delimiter(self):
         return "$"
@@ -78,23 +71,13 @@ class XSLTBinding(object):
     def get_abstract_pattern_delimiter(self):
         return "$"
 
-    def evaluate_name_query(self, xml_document, context_element, namespaces, parser_variables, name_query):
-        parser = XPath1Parser(namespaces, parser_variables)
-        context = XPathContextXSLT(root=xml_document, item=context_element)
-        expr = name_query
+    def compile_name_query(self, name_query, namespaces, variables):
         # Should we check whether this returns a node name?
-        root_token = parser.parse(expr)
-        result = root_token.evaluate(context=context)
-        return result
+        return self.compile_expression(XPath1Parser, name_query, namespaces, variables)
 
-    def evaluate_value_of_query(self, xml_document, context_element, namespaces, parser_variables, name_query):
-        parser = XPath1Parser(namespaces, parser_variables)
-        context = XPathContext(root=xml_document, item=context_element)
-        expr = name_query
+    def compile_value_of_query(self, name_query, namespaces, variables):
         # Should we check whether this returns a string?
-        root_token = parser.parse(expr)
-        result = root_token.evaluate(context=context)
-        return result
+        return self.compile_expression(XPath1Parser, name_query, namespaces, variables)
 
-    def interpret_let_statement(self, xml_document, value, namespaces, variables, context_item=None):
-        return self.parse_expression(xml_document, value, namespaces, variables, context_item)
\ No newline at end of file
+    def compile_let_statement(self, value, namespaces, variables):
+        return self.compile_expression(XSLT1Parser, value, namespaces, variables)
@@ -1,9 +1,10 @@
 """
-The query binding implementation for XPath2
+The query binding implementation for XSLT2: XPath2, with the current() and key() functions of XSLT
 """
 
+from . import DEFAULT_EXPRESSION_CACHE_SIZE
 from .xpath2 import XPath2Binding
-from elementpath import XPath2Parser, XPathContext, select, Selector
+from pyschematron.elementpath_extensions.xslt2_parser import XSLT2Parser
 
 
 def instantiate():
@@ -11,8 +12,11 @@ def instantiate():
 
 
 class XSLT2Binding(XPath2Binding):
-    def __init__(self):
+    parser_class = XSLT2Parser
+
+    def __init__(self, cache_size=DEFAULT_EXPRESSION_CACHE_SIZE):
+        super().__init__(cache_size)
         self.name = "xslt2"
 
-    def interpret_let_statement(self, xml_document, value, namespaces, variables, context_item=None):
-        return self.parse_expression(xml_document, value, namespaces, variables, context_item)
+    def compile_let_statement(self, value, namespaces, variables):
+        return self.compile_expression(self.parser_class, value, namespaces, variables)
@@ -0,0 +1,243 @@
+"""
+The query binding implementation for XSLT (XPath 1.0), using the native XPath engine of lxml
+(libxml2) instead of elementpath.
+
+Every expression is compiled into an etree.XPath object. XSLT's current() and key()
+functions are registered as extension functions, and the values of let statements are passed to the
+expressions as XPath variables. lxml only accepts elements in the node-sets that are passed as
+variables, so a let statement whose value contains attribute or text nodes is evaluated with
+elementpath instead, and so is every expression that refers to such a value.
+
+The expressions are also parsed with elementpath, so that the static analysis of the
+compiler (dispatch index, bulk assertions) works the same as with the default backend;
+they are only ever evaluated by lxml.
+"""
+import threading
+
+from lxml import etree
+from elementpath import XPath1Parser
+
+from pyschematron.exceptions import SchematronQueryBindingError
+from pyschematron.elementpath_extensions.context import get_key_value
+from pyschematron.elementpath_extensions.xslt1_parser import XSLT1Parser
+from pyschematron.query_bindings.analysis import get_variable_references, uses_symbols
+from pyschematron.query_bindings import QueryBinding, CompiledExpression, ExpressionCache, DEFAULT_EXPRESSION_CACHE_SIZE, \
+    document_order
+
+
+def instantiate():
+    return XSLTLxmlBinding()
+
+
+# The node that current() returns, for the expression that is being evaluated in this thread
+_current_item = threading.local()
+# The DocumentIndex that key() looks up nodes in, for the expression that is being evaluated in this thread
+_document_index = threading.local()
+
+
+def _current(context):
+    item = getattr(_current_item, 'item', None)
+    if item is None:
+        raise SchematronQueryBindingError("current() called in a context without an original context item")
+    return [item]
+
+
+def _key(context, name, value):
+    document_index = getattr(_document_index, 'index', None)
+    if document_index is None:
+        raise SchematronQueryBindingError("key() called in a context without a document index")
+    values = value if isinstance(value, list) else [value]
+    return document_index.get_key_nodes(get_key_value(name), [get_key_value(item) for item in values])
+
+
+EXTENSIONS = {(None, 'current'): _current, (None, 'key'): _key}
+
+
+class ElementpathValue(list):
+    """
+    The value of a let statement that contains nodes other than elements, as evaluated by
+    elementpath; lxml cannot accept it as a variable, so the expressions that refer to it are
+    evaluated by elementpath as well
+    """
+    pass
+
+
+def is_node_set(value):
+    """
+    Returns True if the value can be passed to lxml as a variable, False if it contains attribute,
+    text or other nodes that are not elements
+    """
+    return not isinstance(value, list) or all(isinstance(item, etree._Element) for item in value)
+
+
+class LxmlCompiledExpression(CompiledExpression):
+    """
+    A CompiledExpression that is evaluated by an etree.XPath object
+    """
+
+    def __init__(self, expression, root_token, xpath, is_let_statement=False):
+        super().__init__(expression, root_token)
+        self.xpath = xpath
+        self.is_let_statement = is_let_statement
+        # Only the variables that the expression refers to are passed on, so that the others
+        # are not evaluated (see variables.VariableScope)
+        self.variable_names = tuple(sorted(get_variable_references(root_token)))
+
+    def evaluate(self, xml_document, context_item=None, variables=None, document_index=None):
+        if variables and any(isinstance(variables[name], ElementpathValue) for name in self.variable_names
+                             if name in variables):
+            return self.evaluate_with_elementpath(xml_document, context_item, variables, document_index)
+        if context_item is None:
+            context_item = xml_document
+        elif not isinstance(context_item, etree._Element):
+            raise SchematronQueryBindingError("The lxml backend can only evaluate expressions on element nodes, not on %r" % context_item)
+
+        previous = getattr(_current_item, 'item', None), getattr(_document_index, 'index', None)
+        _current_item.item = context_item if context_item is not xml_document else None
+        if document_index is not None and document_index.xml_document is not xml_document:
+            document_index = None
+        _document_index.index = document_index
+        try:
+            if variables and self.variable_names:
+                result = self.xpath(context_item, **dict((name, variables[name]) for name in self.variable_names
+                                                         if name in variables))
+            else:
+                result = self.xpath(context_item)
+        except etree.XPathError as xpe:
+            raise SchematronQueryBindingError("Error evaluating '%s': %s" % (self.expression, str(xpe)))
+        finally:
+            _current_item.item, _document_index.index = previous
+
+        if self.is_let_statement and not is_node_set(result):
+            return self.evaluate_with_elementpath(xml_document, context_item, variables, document_index)
+        return result
+
+    def evaluate_with_elementpath(self, xml_document, context_item=None, variables=None, document_index=None):
+        result = super().evaluate(xml_document, context_item, variables, document_index)
+        if self.is_let_statement and isinstance(result, list):
+            return ElementpathValue(result)
+        return result
+
+    def get_results(self, xml_document, context_item=None, variables=None, document_index=None):
+        return self.evaluate(xml_document, context_item, variables, document_index)
+
+
+def split_union(expression):
+    """
+    Splits an expression on the '|' operators that are not inside predicates, parentheses
+    or string literals
+    """
+    parts = []
+    depth = 0
+    quote = None
+    start = 0
+    for index, char in enumerate(expression):
+        if quote is not None:
+            if char == quote:
+                quote = None
+        elif char in "'\"":
+            quote = char
+        elif char in '[(':
+            depth += 1
+        elif char in '])':
+            depth -= 1
+        elif char == '|' and depth == 0:
+            parts.append(expression[start:index].strip())
+            start = index + 1
+    parts.append(expression[start:].strip())
+    return parts
+
+
+class XSLTLxmlBinding(QueryBinding):
+    def __init__(self, cache_size=DEFAULT_EXPRESSION_CACHE_SIZE):
+        self.name = 'xslt'
+        self.expression_cache = ExpressionCache(cache_size)
+
+    def create_compiled_expression(self, parser_class, expression, namespaces):
+        root_token = parser_class(namespaces).parse(expression)
+        # lxml does not support a default namespace in XPath expressions
+        xpath_namespaces = dict((prefix, uri) for prefix, uri in (namespaces or {}).items() if prefix)
+        try:
+            xpath = etree.XPath(expression, namespaces=xpath_namespaces, extensions=EXTENSIONS, smart_strings=False)
+        except etree.XPathSyntaxError as xse:
+            raise SchematronQueryBindingError("Error compiling '%s': %s" % (expression, str(xse)))
+        return LxmlCompiledExpression(expression, root_token, xpath)
+
+    def compile_rule_context(self, rule_context, namespaces, variables):
+        result = self.compile_expression(XSLT1Parser, rule_context, namespaces, variables)
+        if not rule_context.startswith('/'):
+            pattern = result.get_match_pattern()
+            if pattern is not None and not uses_symbols(result.root_token, {'current'}):
+                # A pattern is matched by every node it selects from the document node
+                alternatives = ["%s" % alternative if alternative.startswith('/') else "//%s" % alternative
+                                for alternative in split_union(rule_context)]
+                selector = self.compile_expression(XSLT1Parser, " | ".join(alternatives), namespaces, variables)
+                return LxmlCompiledContext(result, selector)
+        return result
+
+    def select_context_elements(self, xml_document, context_expression, variables, document_index=None):
+        """
+        Returns the elements that are specified by the context statement
+        :param xml_document: The document that is processed
+        :param context_expression: The compiled rule context expression
+        :param variables: Variables to be used in the rule context expression
+        :param document_index: The DocumentIndex of the document, for key()
+        :return:
+        """
+        if isinstance(context_expression, LxmlCompiledContext):
+            return context_expression.selector.get_results(xml_document, variables=variables, document_index=document_index)
+        pattern = context_expression.get_match_pattern()
+        if pattern is not None and not context_expression.expression.startswith('/'):
+            # A pattern that uses current(), which refers to the node that is being matched;
+            # the predicates are evaluated with elementpath
+            return pattern.select(xml_document, variables, document_index)
+        result = context_expression.get_results(xml_document, variables=variables, document_index=document_index)
+        if not context_expression.expression.startswith('/'):
+            # Not a pattern, evaluate the expression relative to every element
+            result = list(result)
+            for el in xml_document.iter():
+                if isinstance(el.tag, str):
+                    result.extend(context_expression.get_results(xml_document, el, variables, document_index))
+        # Only element nodes can be the context of the assertions
+        return [node for node in document_order(xml_document, result) if isinstance(node, etree._Element)]
+
+    def create_context_matcher(self, xml_document, context_expression, variables, document_index=None):
+        if isinstance(context_expression, LxmlCompiledContext):
+            # Selecting all nodes natively is faster than matching them one by one
+            return set(context_expression.selector.get_results(xml_document, variables=variables,
+                                                               document_index=document_index)).__contains__
+        return super().create_context_matcher(xml_document, context_expression, variables, document_index)
+
+    def compile_assertion(self, assertion, namespaces, variables):
+        return self.compile_expression(XSLT1Parser, assertion, namespaces, variables)
+
+    def compile_assertion_filter(self, assertion, namespaces, variables, nodes_variable, negate=False):
+        expression = "$%s[%s(%s)]" % (nodes_variable, "not" if negate else "boolean", assertion)
+        return self.compile_expression(XSLT1Parser, expression, namespaces, list(variables) + [nodes_variable])
+
+    def get_variable_delimiter(self):
+        return "$"
+
+    def get_abstract_pattern_delimiter(self):
+        return "$"
+
+    def compile_name_query(self, name_query, namespaces, variables):
+        return self.compile_expression(XPath1Parser, name_query, namespaces, variables)
+
+    def compile_value_of_query(self, name_query, namespaces, variables):
+        return self.compile_expression(XPath1Parser, name_query, namespaces, variables)
+
+    def compile_let_statement(self, value, namespaces, variables):
+        compiled = self.compile_expression(XSLT1Parser, value, namespaces, variables)
+        return LxmlCompiledExpression(compiled.expression, compiled.root_token, compiled.xpath, is_let_statement=True)
+
+
+class LxmlCompiledContext(LxmlCompiledExpression):
+    """
+    A rule context that is a pattern, together with the expression that selects all the nodes
+    that match it
+    """
+
+    def __init__(self, context, selector):
+        super().__init__(context.expression, context.root_token, context.xpath)
+        self.selector = selector
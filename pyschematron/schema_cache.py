@@ -0,0 +1,127 @@
+"""
+A persistent cache of parsed schemas, to skip the parsing of the schema and its includes and
+the processing of the abstract patterns and rules in every new process.
+
+The cache is a directory (given by the caller, or in the environment variable
+PYSCHEMATRON_SCHEMA_CACHE) with a pickled Schema object for every schema file and backend.
+With the Schema, the content hashes of the schema file and of every file that it includes
+(directly or indirectly) are stored, and the version of pyschematron. If any of these
+differ when the schema is loaded, the schema is read from its file again, and the cache
+entry is replaced.
+
+The compiled schema is not cached: its expressions hold parsed XPath tokens that cannot be
+pickled, so the schema is compiled when it is loaded.
+
+Cache entries are unpickled, so the cache directory must not be writable by others.
+"""
+import gc
+import hashlib
+import os
+import pickle
+import tempfile
+
+from pyschematron import __version__
+from pyschematron.elements import Schema, DEFAULT_BACKEND
+
+# The environment variable with the default cache directory
+CACHE_DIRECTORY_VARIABLE = 'PYSCHEMATRON_SCHEMA_CACHE'
+
+# The format of the cache entries; changes in the schema classes between releases should
+# increase it
+CACHE_FORMAT = 1
+
+
+def get_file_hash(path):
+    """
+    Returns the SHA-256 hash of the content of the given file, or None if it cannot be read
+    """
+    try:
+        with open(path, 'rb') as input_file:
+            return hashlib.sha256(input_file.read()).hexdigest()
+    except OSError:
+        return None
+
+
+def get_cache_file(cache_directory, file_path, backend):
+    key = "%s\0%s" % (os.path.abspath(file_path), backend)
+    return os.path.join(cache_directory, "%s.pickle" % hashlib.sha256(key.encode('utf-8')).hexdigest())
+
+
+def read_cache_file(cache_file):
+    """
+    Returns the schema in the given cache file, or None if the file does not exist, is
+    corrupt, or was written for another version, or if the schema file or one of its
+    includes has changed
+    """
+    # The schema consists of many small objects; unpickling is about twice as fast without
+    # the garbage collector, which would scan them over and over while they are created
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        with open(cache_file, 'rb') as input_file:
+            entry = pickle.load(input_file)
+    except Exception:
+        # A missing or corrupt cache file is the same as a changed schema
+        return None
+    finally:
+        if gc_enabled:
+            gc.enable()
+    if not isinstance(entry, dict) or entry.get('format') != CACHE_FORMAT or entry.get('version') != __version__:
+        return None
+    for path, file_hash in entry['files']:
+        if get_file_hash(path) != file_hash:
+            return None
+    return entry['schema']
+
+
+def write_cache_file(cache_file, schema, files):
+    """
+    Writes the given schema to the given cache file, with the hashes of the given files; the
+    cache file is replaced at once, so that other processes do not read a partial file
+    """
+    entry = {
+        'format': CACHE_FORMAT,
+        'version': __version__,
+        'files': [(path, get_file_hash(path)) for path in files],
+        'schema': schema,
+    }
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        file_descriptor, temporary_file = tempfile.mkstemp(dir=os.path.dirname(cache_file), suffix=".tmp")
+        try:
+            with os.fdopen(file_descriptor, 'wb') as output_file:
+                pickle.dump(entry, output_file, pickle.HIGHEST_PROTOCOL)
+            os.replace(temporary_file, cache_file)
+        except BaseException:
+            os.unlink(temporary_file)
+            raise
+    except OSError:
+        # The cache is an optimization; validation works without it
+        pass
+
+
+def load_schema(file_path, verbosity=0, backend=DEFAULT_BACKEND, cache_directory=None):
+    """
+    Reads the given schema file, with its abstract patterns and rules processed, like
+    Schema(file_path) does; from the cache if it is up to date.
+    :param file_path: The .sch file to read
+    :param verbosity: The verbosity level of the schema
+    :param backend: The implementation of the query binding, see Schema
+    :param cache_directory: The cache directory; the environment variable PYSCHEMATRON_SCHEMA_CACHE if None.
+                            If neither is set, the schema is not cached.
+    :return: a Schema
+    """
+    if cache_directory is None:
+        cache_directory = os.environ.get(CACHE_DIRECTORY_VARIABLE)
+    if not cache_directory:
+        return Schema(file_path, verbosity=verbosity, backend=backend)
+
+    cache_file = get_cache_file(cache_directory, file_path, backend)
+    schema = read_cache_file(cache_file)
+    if schema is not None:
+        schema.file_path = file_path
+        schema.verbosity = verbosity
+        return schema
+    schema = Schema(file_path, verbosity=verbosity, backend=backend)
+    write_cache_file(cache_file, schema, [os.path.abspath(file_path)] + schema.included_files)
+    return schema
@@ -0,0 +1,284 @@
+"""
+A long-running validation server, that keeps compiled schemas in memory.
+
+Every run of pyschematron-validate starts Python, imports lxml and elementpath, and reads
+and compiles the schema before it validates a single document. The server (started with
+pyschematron-serve) does that once: it listens on a Unix socket and/or a TCP port on the
+local host, and keeps the compiled schemas in a cache (see SchemaCache), keyed by their path
+and the hashes of the content of the schema file and its includes, so a changed schema is
+read again. Schemas are read with pyschematron.schema_cache, so they are also taken from
+the persistent schema cache if PYSCHEMATRON_SCHEMA_CACHE is set.
+
+The protocol is HTTP:
+
+    POST /validate?schema=<path>[&phase=<phase>][&format=text|svrl|json][&engine=<engine>]
+                   [&file=<name>][&base=<url>][&verbosity=<n>]
+
+The request body is the document to validate. 'schema' is the path of the schema on the
+server, 'file' is the name of the document for the text output, and 'base' is its base URL
+(for relative references in it). The response is the text output of pyschematron-validate,
+the SVRL, or a JSON object with the errors and warnings; the result code of the validate
+command is in the X-Validation-Result header. Errors in the request (such as a document
+that is not well-formed, or a schema that cannot be read) result in status 400.
+
+    GET /status
+
+returns a JSON object with the schemas in the cache.
+
+pyschematron-validate --server <address> is a client for this server (see
+pyschematron.client).
+"""
+import json
+import os
+import socketserver
+import sys
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import StringIO
+from urllib.parse import urlsplit, parse_qs
+
+from lxml import etree
+
+from pyschematron.client import RESULT_HEADER
+from pyschematron.commands.validate import write_report, write_summary
+from pyschematron.elements import DEFAULT_BACKEND
+from pyschematron.exceptions import SchematronError
+from pyschematron.schema_cache import get_file_hash, load_schema
+from pyschematron.validation import resolve_messages
+
+# The number of compiled schemas that are kept in the cache
+DEFAULT_CACHE_SIZE = 32
+
+
+class CacheEntry(object):
+    """
+    A compiled schema in the SchemaCache. It can be used by several requests at the same time.
+    """
+
+    def __init__(self, path, phase, file_hashes, compiled_schema):
+        """
+        :param file_hashes: A list of tuples of the paths and content hashes of the schema file and its includes
+        """
+        self.path = path
+        self.phase = phase
+        self.file_hashes = file_hashes
+        self.compiled_schema = compiled_schema
+        self.hits = 0
+
+
+class SchemaCache(object):
+    """
+    Keeps compiled schemas in memory, keyed by their (absolute) path and phase. The content
+    of the schema file and its includes is hashed on every lookup; if any of them has changed,
+    the schema is read and compiled again. The least recently used schemas are removed when
+    there are more than max_size.
+    """
+
+    def __init__(self, backend=DEFAULT_BACKEND, max_size=DEFAULT_CACHE_SIZE):
+        self.backend = backend
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, path, phase="#DEFAULT"):
+        """
+        Returns the CacheEntry for the given schema file and phase, reading and compiling it if
+        it is not in the cache or has changed
+        :raises SchematronError: if the schema cannot be read
+        """
+        path = os.path.abspath(path)
+        if not os.path.isfile(path):
+            raise SchematronError("Cannot read schema %s" % path)
+        key = (path, phase)
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is not None and all(get_file_hash(file_path) == file_hash
+                                     for file_path, file_hash in entry.file_hashes):
+            with self.lock:
+                if key in self.entries:
+                    self.entries.move_to_end(key)
+                entry.hits += 1
+            return entry
+
+        # Compile outside of the lock, so that other schemas can be used in the meantime
+        file_hash = get_file_hash(path)
+        schema = load_schema(path, 0, self.backend)
+        file_hashes = [(path, file_hash)] + [(file_path, get_file_hash(file_path))
+                                             for file_path in schema.included_files]
+        entry = CacheEntry(path, phase, file_hashes, schema.compile(phase))
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        return entry
+
+    def get_status(self):
+        with self.lock:
+            return [{'schema': entry.path, 'phase': entry.phase, 'files': [file_path for file_path, _ in entry.file_hashes],
+                     'hits': entry.hits} for entry in self.entries.values()]
+
+
+def validate(entry, document, file_name, base_url=None, output_type='text', engine=None, verbosity=1):
+    """
+    Validates the given document against the compiled schema of the given cache entry
+    :param document: The document (bytes)
+    :param file_name: The name of the document, for the text output
+    :param base_url: The base URL of the document
+    :param output_type: 'text', 'svrl' or 'json'
+    :return: a tuple of the result code, the content type and the output
+    :raises etree.XMLSyntaxError: if the document is not well-formed
+    """
+    xml_doc = etree.fromstring(document, base_url=base_url).getroottree()
+    compiled_schema = entry.compiled_schema
+    schema = compiled_schema.schema
+    if output_type == 'text':
+        output_stream = StringIO()
+        report = schema.validate_document(xml_doc, compiled_schema=compiled_schema, engine=engine)
+        error_count, warning_count = write_report(schema, report, xml_doc, output_stream, verbosity)
+        result = write_summary(file_name, error_count, warning_count, output_stream, verbosity)
+        return result, "text/plain; charset=utf-8", output_stream.getvalue()
+    elif output_type == 'svrl':
+        svrl = schema.validate_document_to_svrl(xml_doc, compiled_schema=compiled_schema, engine=engine)
+        output = etree.tostring(svrl.to_xml(), pretty_print=True, xml_declaration=True, encoding='utf-8')
+        return 0, "application/xml", output.decode('utf-8') + "\n"
+    elif output_type == 'json':
+        report = schema.validate_document(xml_doc, compiled_schema=compiled_schema, engine=engine)
+        errors, warnings = report.get_errors_and_warnings()
+        errors = resolve_messages(errors, xml_doc, schema.ns_prefixes)
+        warnings = resolve_messages(warnings, xml_doc, schema.ns_prefixes)
+        result = -1 if errors else 1 if warnings else 0
+        output = json.dumps({'file': file_name, 'result': result,
+                             'errors': [vars(message) for message in errors],
+                             'warnings': [vars(message) for message in warnings]})
+        return result, "application/json", output + "\n"
+    raise SchematronError("Unknown output type: %s" % output_type)
+
+
+class ValidationRequestHandler(BaseHTTPRequestHandler):
+    """
+    Handles the requests of the validation server (see the description of this module); the
+    server has a 'cache' member with the SchemaCache
+    """
+    # Keep the connection open for the next document
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        if urlsplit(self.path).path != '/status':
+            self.send_output(404, "text/plain; charset=utf-8", "Not found: %s\n" % self.path)
+            return
+        self.send_output(200, "application/json", json.dumps({'schemas': self.server.cache.get_status()}) + "\n")
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        document = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if url.path != '/validate':
+            self.send_output(404, "text/plain; charset=utf-8", "Not found: %s\n" % self.path)
+            return
+        arguments = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        output_type = arguments.get('format', 'text')
+        try:
+            if 'schema' not in arguments:
+                raise SchematronError("No schema given")
+            entry = self.server.cache.get(arguments['schema'], arguments.get('phase', "#DEFAULT"))
+            result, content_type, output = validate(entry, document, arguments.get('file', "-"), arguments.get('base'),
+                                                    output_type, arguments.get('engine'),
+                                                    int(arguments.get('verbosity', 1)))
+        except (SchematronError, etree.XMLSyntaxError, ValueError) as error:
+            if output_type == 'json':
+                self.send_output(400, "application/json", json.dumps({'error': str(error)}) + "\n")
+            else:
+                self.send_output(400, "text/plain; charset=utf-8", "%s\n" % error)
+            return
+        self.send_output(200, content_type, output, result)
+
+    def send_output(self, status, content_type, output, result=None):
+        body = output.encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        if result is not None:
+            self.send_header(RESULT_HEADER, str(result))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # The address of a Unix socket client is an empty string
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return "unix"
+
+    def log_message(self, format, *args):
+        if self.server.verbosity > 1:
+            super().log_message(format, *args)
+
+
+class UnixHTTPServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+    block_on_close = False
+
+
+class ValidationServer(object):
+    """
+    Serves validation requests on a Unix socket and/or a TCP port on the local host, each in
+    its own thread
+    """
+
+    def __init__(self, socket_path=None, port=None, host="127.0.0.1", cache=None, verbosity=1):
+        """
+        :param socket_path: The path of the Unix socket
+        :param port: The TCP port (0 for any free port)
+        :param host: The address to listen on for TCP connections
+        :param cache: The SchemaCache, a new one (with the default backend) if None
+        """
+        if socket_path is None and port is None:
+            raise SchematronError("No socket path or port given")
+        self.cache = cache if cache is not None else SchemaCache()
+        self.socket_path = socket_path
+        self.servers = []
+        if socket_path is not None:
+            if os.path.exists(socket_path):
+                os.unlink(socket_path)
+            self.servers.append(UnixHTTPServer(socket_path, ValidationRequestHandler))
+        if port is not None:
+            self.servers.append(ThreadingHTTPServer((host, port), ValidationRequestHandler))
+        for server in self.servers:
+            server.cache = self.cache
+            server.verbosity = verbosity
+        self.threads = []
+
+    def get_port(self):
+        """
+        Returns the TCP port that the server listens on, or None
+        """
+        for server in self.servers:
+            if isinstance(server, ThreadingHTTPServer):
+                return server.server_address[1]
+        return None
+
+    def start(self):
+        """
+        Starts serving requests in background threads
+        """
+        for server in self.servers:
+            thread = threading.Thread(target=server.serve_forever, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def serve_forever(self):
+        self.start()
+        try:
+            for thread in self.threads:
+                thread.join()
+        except KeyboardInterrupt:
+            sys.stderr.write("Stopping\n")
+        finally:
+            self.shutdown()
+
+    def shutdown(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        if self.socket_path is not None and os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
@@ -0,0 +1,433 @@
+"""
+Sharded validation of one large document, divided over a pool of worker processes.
+
+Large batch files usually consist of a root element with a header and a long list of
+records (<Batch><Header/><Record/><Record/>...</Batch>). The sharded validator memory-maps
+the file and scans it for the byte offsets of the children of the root element, without
+parsing it into a tree. Consecutive records (the children of the root element that match the
+record path) are grouped into shards of about shard_size bytes. A worker process parses the
+bytes of a shard wrapped in a copy of the prolog and the start and end tags of the root
+element, so every worker only holds the records of one shard in memory.
+
+The records are validated like in streaming mode (see pyschematron.streaming): only the
+rules that can be validated without the rest of the document are run for them.
+
+The other children of the root element (such as the header) are collected in a skeleton
+document: the prolog, the root element and those children, without the records. It is
+validated once, after all the shards, with all the rules, so that the rules for the document,
+the root element and the other children are run as well. These rules only see the skeleton:
+tests and variables that look at the records (such as count(Record) for the root element)
+find none of them, and the rules that need the full document are never run for the records
+themselves (such as a comparison with preceding-sibling::Record).
+
+The locations of the failed asserts and successful reports, and their line numbers, are those
+in the original document: like getelementpath(), the location of a record only has its
+position if there are other children of the root element with the same name.
+
+The scanner handles comments, processing instructions, CDATA sections and a document type
+declaration, but not entities that expand to markup. The document must use an encoding that
+is compatible with ASCII, such as UTF-8 or ISO-8859-1.
+"""
+import mmap
+import os
+import re
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from lxml import etree
+
+from pyschematron.batch import get_multiprocessing_context, get_schema_arguments, get_worker_schema
+from pyschematron.elementpath_extensions.context import DocumentIndex
+from pyschematron.exceptions import SchematronError
+from pyschematron.streaming import StreamingRecord, StreamingValidator
+from pyschematron.validation import ValidationReport, create_message
+
+# The default size of a shard in bytes
+DEFAULT_SHARD_SIZE = 4 * 1024 * 1024
+
+# The number of shards per worker that are submitted to the pool before their results are collected
+PENDING_SHARDS_PER_WORKER = 2
+
+# The number of bytes that are copied at a time to count lines
+LINE_COUNT_CHUNK = 16 * 1024 * 1024
+
+# Attribute values may contain '>', but not '<'
+_ATTRIBUTES = rb'((?:[^\'">]|"[^"]*"|\'[^\']*\')*)'
+_SKIPPED = rb'<!--.*?-->|<!\[CDATA\[.*?\]\]>|<\?.*?\?>'
+TOKEN_PATTERN = re.compile(_SKIPPED + rb'|<!DOCTYPE(?:[^\[>]|\[.*?\])*>|<(/?)([^\s/>]+)' + _ATTRIBUTES + rb'>', re.S)
+
+# The record paths, see get_record_tags()
+RECORD_PATH_PATTERN = re.compile(r'^(?:/(\{[^}]*\}[^/]+|[^/{]+)/)?(\{[^}]*\}[^/]+|[^/{]+)$')
+
+# The worker of a worker process, see _init_worker()
+_worker = None
+
+
+class DocumentLayout(object):
+    """
+    The structure of a document in a buffer (such as a memory-mapped file): the prolog and
+    the start tag of the root element ('header'), and the offsets of the children of the root
+    element (see iter_children())
+    """
+
+    def __init__(self, buffer):
+        self.buffer = buffer
+        if buffer[:2] in (b'\xff\xfe', b'\xfe\xff'):
+            raise SchematronError("Documents in UTF-16 cannot be split into shards")
+        for match in TOKEN_PATTERN.finditer(buffer):
+            if match.group(2) is not None:
+                break
+        else:
+            raise SchematronError("The document has no root element")
+        self.root_name = match.group(2)
+        self.empty = match.group(3).endswith(b'/')
+        if self.empty:
+            self.header = buffer[:match.end() - 2] + b'>'
+        else:
+            self.header = buffer[:match.end()]
+        self.content_start = match.end()
+        self.footer = b'</' + self.root_name + b'>'
+        self.root = etree.fromstring(self.header + self.footer)
+        self._tags = {}
+        self._element_patterns = {}
+
+    def iter_children(self):
+        """
+        Yields a tuple of the name (as it is in the document), the start offset, the offset of
+        the end of the start tag and the end offset of every child element of the root element
+        """
+        if self.empty:
+            return
+        buffer = self.buffer
+        position = self.content_start
+        while True:
+            match = TOKEN_PATTERN.search(buffer, position)
+            if match is None:
+                raise SchematronError("The root element of the document is not closed")
+            position = match.end()
+            name = match.group(2)
+            if name is None:
+                continue
+            if match.group(1):
+                # The end tag of the root element
+                return
+            start = match.start()
+            if not match.group(3).endswith(b'/'):
+                position = self.find_end(name, position)
+            yield name, start, match.end(), position
+
+    def find_end(self, name, position):
+        """
+        Returns the offset of the end of the element with the given name, whose start tag ends
+        at the given position
+        """
+        pattern = self._element_patterns.get(name)
+        if pattern is None:
+            pattern = re.compile(_SKIPPED + rb'|<(/?)' + re.escape(name) + rb'(?=[\s/>])' + _ATTRIBUTES + rb'>', re.S)
+            self._element_patterns[name] = pattern
+        depth = 1
+        while depth:
+            match = pattern.search(self.buffer, position)
+            if match is None:
+                raise SchematronError("The element %s at offset %d is not closed" % (name.decode('utf-8', 'replace'),
+                                                                                    position))
+            position = match.end()
+            if match.group(1) is None:
+                continue
+            if match.group(1):
+                depth -= 1
+            elif not match.group(2).endswith(b'/'):
+                depth += 1
+        return position
+
+    def get_tag(self, name, start, tag_end):
+        """
+        Returns the tag of the child element of the root element with the given name and start
+        tag, in the form of lxml ('{namespace}name')
+        """
+        start_tag = self.buffer[start:tag_end]
+        if b'xmlns' in start_tag:
+            if not start_tag.endswith(b'/>'):
+                start_tag = start_tag[:-1] + b'/>'
+            return etree.fromstring(self.header + start_tag + self.footer)[0].tag
+        tag = self._tags.get(name)
+        if tag is None:
+            tag = etree.fromstring(self.header + b'<' + name + b'/>' + self.footer)[0].tag
+            self._tags[name] = tag
+        return tag
+
+
+class LineCounter(object):
+    """
+    Counts the lines of a buffer up to increasing offsets
+    """
+
+    def __init__(self, buffer):
+        self.buffer = buffer
+        self.offset = 0
+        self.line = 1
+
+    def get_line(self, offset):
+        """
+        Returns the line number at the given offset, which must not be lower than the one of the
+        previous call
+        """
+        while self.offset < offset:
+            end = min(offset, self.offset + LINE_COUNT_CHUNK)
+            self.line += self.buffer[self.offset:end].count(b'\n')
+            self.offset = end
+        return self.line
+
+
+def get_record_tags(record_path, namespaces):
+    """
+    Returns the tags of the root element and of the records for the given record path, of the form
+    '/root/record' or 'record'; None means any element. The names may use the namespace
+    prefixes of the schema, or be of the form '{namespace}name'.
+    """
+    if record_path is None:
+        return None, None
+    match = RECORD_PATH_PATTERN.match(record_path)
+    if match is None:
+        raise SchematronError("The record path must be of the form /root/record or record: %s" % record_path)
+    return get_tag(match.group(1) or '*', namespaces), get_tag(match.group(2), namespaces)
+
+
+def get_tag(name, namespaces):
+    if name == '*':
+        return None
+    if name.startswith('{') or ':' not in name:
+        return name
+    prefix, local_name = name.split(':', 1)
+    if prefix not in namespaces:
+        raise SchematronError("Unknown namespace prefix in the record path: %s" % prefix)
+    return "{%s}%s" % (namespaces[prefix], local_name)
+
+
+class ShardWorker(object):
+    """
+    Validates the shards of a document, in a worker process (or in the calling process)
+    """
+
+    def __init__(self, compiled_schema, path, header, footer):
+        self.compiled_schema = compiled_schema
+        self.validator = StreamingValidator(compiled_schema)
+        self.path = path
+        self.header = header
+        self.footer = footer
+        with open(path, 'rb') as xml_file:
+            self.buffer = mmap.mmap(xml_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def validate(self, ranges, numbers):
+        """
+        Validates a part of the document
+        :param ranges: A list of tuples of the start and end offsets of a part of the document, its line
+                       number, and the number of children of the root element in it
+        :param numbers: The numbers of the children of the root element in the ranges (see StreamingRecord),
+                        or None for the skeleton
+        :return: a tuple of the lists of errors and warnings (ValidationMessage objects)
+        """
+        xml_doc, children, line_offsets = self.parse(ranges)
+        if numbers is None:
+            return self.validate_skeleton(xml_doc, children, line_offsets)
+        records = [(StreamingRecord(child, number), line_offset)
+                   for child, number, line_offset in zip(children, numbers, line_offsets)]
+
+        document_index = DocumentIndex(xml_doc, self.compiled_schema.keys)
+        errors = []
+        warnings = []
+        for record, line_offset in records:
+            # A report per record, like StreamingValidator.iter_reports(), so that the results are in
+            # the order of the document
+            report = ValidationReport()
+            self.validator.start_report(report)
+            self.validator.validate_record(record, report, document_index)
+            record_errors, record_warnings = report.get_errors_and_warnings()
+            errors.extend(self.create_messages(record_errors, record, line_offset))
+            warnings.extend(self.create_messages(record_warnings, record, line_offset))
+        return errors, warnings
+
+    def validate_skeleton(self, xml_doc, children, line_offsets):
+        """
+        Validates the skeleton document with all the rules
+        """
+        schema = self.compiled_schema.schema
+        report = schema.validate_document(xml_doc, compiled_schema=self.compiled_schema)
+        errors, warnings = report.get_errors_and_warnings()
+        child_line_offsets = dict(zip(children, line_offsets))
+        return (self.create_skeleton_messages(errors, xml_doc, child_line_offsets),
+                self.create_skeleton_messages(warnings, xml_doc, child_line_offsets))
+
+    def create_skeleton_messages(self, failed_asserts, xml_doc, child_line_offsets):
+        # The other children of the root element are in the same order in the skeleton, so only
+        # the line numbers differ
+        namespaces = self.compiled_schema.schema.ns_prefixes
+        messages = []
+        for test, element in failed_asserts:
+            line = None
+            if element is not None:
+                child = element
+                while child.getparent() is not None and child not in child_line_offsets:
+                    child = child.getparent()
+                line = element.sourceline + child_line_offsets.get(child, 0)
+            messages.append(create_message(test, element, xml_doc, namespaces, line=line))
+        return messages
+
+    def parse(self, ranges):
+        """
+        Parses the given ranges of the document, wrapped in the prolog and the root element
+        :return: a tuple of the document, the child elements of the root element, and for every child, the
+                 difference between its line number in the original document and in the parsed one
+        """
+        parts = [self.header]
+        line = self.header.count(b'\n') + 1
+        line_offsets = []
+        for start, end, original_line, count in ranges:
+            line_offsets.extend([original_line - line] * count)
+            data = self.buffer[start:end]
+            parts.append(data)
+            line += data.count(b'\n')
+        parts.append(self.footer)
+        root = etree.fromstring(b''.join(parts), base_url=self.path)
+        del parts
+
+        children = [child for child in root if isinstance(child.tag, str)]
+        return root.getroottree(), children, line_offsets
+
+    def create_messages(self, failed_asserts, record, line_offset):
+        namespaces = self.compiled_schema.schema.ns_prefixes
+        return [create_message(test, element, record.xml_doc, namespaces, record.get_location(element),
+                               element.sourceline + line_offset) for test, element in failed_asserts]
+
+    def close(self):
+        self.buffer.close()
+
+
+def _init_worker(schema_arguments, path, header, footer):
+    global _worker
+    _worker = ShardWorker(get_worker_schema(*schema_arguments), path, header, footer)
+
+
+def _validate_in_worker(ranges, numbers):
+    return _worker.validate(ranges, numbers)
+
+
+class ShardedValidator(object):
+    """
+    Validates large documents in shards of records, in a pool of worker processes.
+
+    Like StreamingValidator, 'skipped_rules' lists the rules that need the full document; these are
+    only run on the skeleton. 'record_counts' is the number of children of the root element of every
+    name in the last document.
+    """
+
+    def __init__(self, compiled_schema, record_path=None, workers=None, shard_size=DEFAULT_SHARD_SIZE):
+        """
+        :param compiled_schema: The CompiledSchema to validate against
+        :param record_path: The path of the records: '/root/record' or 'record'; every child element of the
+                            root element is a record if None
+        :param workers: The number of worker processes, the number of CPUs if None; with 1, the shards are
+                        validated in this process
+        :param shard_size: The (approximate) size of a shard in bytes
+        """
+        self.compiled_schema = compiled_schema
+        self.root_tag, self.record_tag = get_record_tags(record_path, compiled_schema.namespaces)
+        self.workers = workers if workers is not None else (os.cpu_count() or 1)
+        self.shard_size = shard_size
+        self.streaming_validator = StreamingValidator(compiled_schema)
+        self.skipped_rules = self.streaming_validator.skipped_rules
+        self.record_counts = {}
+
+    def iter_shards(self, layout):
+        """
+        Yields the arguments for ShardWorker.validate() for every shard of the document with the
+        given layout, and for the skeleton last; counts the children of the root element by name
+        in record_counts
+        """
+        if self.root_tag is not None and layout.root.tag != self.root_tag:
+            raise SchematronError("The root element of the document is %s, not %s" % (layout.root.tag, self.root_tag))
+        lines = LineCounter(layout.buffer)
+        numbers = self.record_counts = {}
+        shard = None
+        skeleton_ranges = []
+        for name, start, tag_end, end in layout.iter_children():
+            tag = layout.get_tag(name, start, tag_end)
+            number = numbers[tag] = numbers.get(tag, 0) + 1
+            if self.record_tag is None or tag == self.record_tag:
+                if shard is not None and start - shard[0] >= self.shard_size:
+                    yield [(shard[0], shard[1], shard[2], len(shard[3]))], shard[3]
+                    shard = None
+                if shard is None:
+                    shard = [start, end, lines.get_line(start), [number]]
+                else:
+                    shard[1] = end
+                    shard[3].append(number)
+            else:
+                if shard is not None:
+                    yield [(shard[0], shard[1], shard[2], len(shard[3]))], shard[3]
+                    shard = None
+                skeleton_ranges.append((start, end, lines.get_line(start), 1))
+        if shard is not None:
+            yield [(shard[0], shard[1], shard[2], len(shard[3]))], shard[3]
+        yield skeleton_ranges, None
+
+    def iter_results(self, path):
+        """
+        Validates the given document, and yields a tuple of the lists of errors and warnings
+        (ValidationMessage objects) for every shard, in the order of the document, and for the
+        skeleton last
+        :param path: The file name of the document
+        """
+        if os.path.getsize(path) == 0:
+            raise SchematronError("The document has no root element")
+        with open(path, 'rb') as xml_file:
+            buffer = mmap.mmap(xml_file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            layout = DocumentLayout(buffer)
+            # All the children are scanned first, the locations depend on the number of records of a name
+            shards = list(self.iter_shards(layout))
+            if self.workers == 1:
+                worker = ShardWorker(self.compiled_schema, path, layout.header, layout.footer)
+                try:
+                    for ranges, numbers in shards:
+                        yield self.get_locations(worker.validate(ranges, numbers), numbers)
+                finally:
+                    worker.close()
+                return
+
+            mp_context = get_multiprocessing_context()
+            initargs = (get_schema_arguments(self.compiled_schema, mp_context), os.path.abspath(path), layout.header,
+                        layout.footer)
+            executor = ProcessPoolExecutor(self.workers, mp_context=mp_context, initializer=_init_worker,
+                                           initargs=initargs)
+            max_pending = self.workers * PENDING_SHARDS_PER_WORKER
+            try:
+                pending = deque()
+                for ranges, numbers in shards:
+                    pending.append((executor.submit(_validate_in_worker, ranges, numbers), numbers))
+                    if len(pending) >= max_pending:
+                        future, numbers = pending.popleft()
+                        yield self.get_locations(future.result(), numbers)
+                while pending:
+                    future, numbers = pending.popleft()
+                    yield self.get_locations(future.result(), numbers)
+            finally:
+                executor.shutdown(wait=True, cancel_futures=True)
+        finally:
+            buffer.close()
+
+    def get_locations(self, messages, numbers):
+        """
+        Removes the position from the locations in the records whose name is unique in the document,
+        like getelementpath() does (see StreamingRecord.get_location())
+        :param messages: The errors and warnings of a shard
+        :param numbers: The numbers of the records of the shard, None for the skeleton
+        """
+        if numbers is not None and 1 in numbers:
+            prefixes = ["%s[1]" % tag for tag, count in self.record_counts.items() if count == 1]
+            for message in messages[0] + messages[1]:
+                for prefix in prefixes:
+                    if message.location == prefix or message.location.startswith(prefix + "/"):
+                        message.location = prefix[:-3] + message.location[len(prefix):]
+                        break
+        return messages
@@ -0,0 +1,242 @@
+"""
+Streaming validation of large documents, record by record.
+
+Large batch files usually consist of a root element with a header and a long list of
+records. Instead of parsing the whole file into a tree, the streaming validator reads it
+with etree.iterparse(), and treats every child element of the root element (the header
+included) as a record: as soon as a record has been parsed completely, the rules are run
+for the nodes inside it, and the record is removed from the tree again. The memory that is
+used depends on the size of the largest record, not on the size of the file.
+
+Only the rules that can be validated without the rest of the document are run: the compiler
+classifies every rule (see compiler.CompiledRule.full_document_reason and
+CompiledSchema.describe_streaming()). A rule is streamable if its context is a pattern that
+can be matched by looking at the node and its ancestors, and its tests, messages and
+variables only look at the subtree of the context node. The root element and the document
+node are not part of any record, and are not validated.
+
+The locations of the nodes are reported relative to the full document. While a record is
+validated, it is not known yet whether a later record has the same name, so the location of
+the record always has its position; validate_to_svrl() removes it when the name is unique.
+"""
+from lxml import etree
+
+from elementpath.xpath_nodes import is_element_node
+
+from pyschematron.elementpath_extensions.context import DocumentIndex
+from pyschematron.validation import ValidationContext, ValidationReport, SVRLReport
+
+
+class StreamingRecord(object):
+    """
+    A record of a document that is being validated in streaming mode: a child element of the
+    root element. It is only available until the next record is read.
+    'number' is the position of the record among the records with the same name.
+    """
+
+    def __init__(self, element, number):
+        self.element = element
+        self.xml_doc = element.getroottree()
+        self.number = number
+
+    def get_location(self, element):
+        """
+        Returns the location of the given element of the record, in the same form as
+        getelementpath() of the full document, except that the position of the record is always
+        included, as later records with the same name have not been read yet
+        """
+        location = "%s[%d]" % (self.element.tag, self.number)
+        if element is self.element:
+            return location
+        return "%s/%s" % (location, etree.ElementTree(self.element).getelementpath(element))
+
+
+class StreamingSVRLReport(SVRLReport):
+    """
+    An SVRLReport for streaming validation, the results of each record are added while the
+    record is still available
+    """
+
+    def __init__(self, compiled_schema):
+        super().__init__(compiled_schema, None)
+        self.record = None
+        # The results in the first record of every name, by the name of the record
+        self.first_record_results = {}
+
+    def set_record(self, record, document_index=None):
+        self.record = record
+        self.xml_doc = record.xml_doc
+        self.document_index = document_index
+
+    def get_location(self, element):
+        return self.record.get_location(element)
+
+    def add_failed_assert(self, rule, assertion, element):
+        super().add_failed_assert(rule, assertion, element)
+        self.add_record_result(self.fired_rules[rule].reports[-1])
+
+    def add_successful_report(self, rule, report_test, element):
+        super().add_successful_report(rule, report_test, element)
+        self.add_record_result(self.fired_rules[rule].reports[-1])
+
+    def add_record_result(self, result):
+        if self.record.number == 1:
+            self.first_record_results.setdefault(self.record.element.tag, []).append(result)
+
+    def finish(self, record_counts):
+        """
+        Removes the position of the record from the locations of the results in records whose
+        name is unique, like getelementpath() does
+        :param record_counts: The number of records of every name in the document
+        """
+        for tag, results in self.first_record_results.items():
+            if record_counts.get(tag) == 1:
+                prefix = "%s[1]" % tag
+                for result in results:
+                    result.location = tag + result.location[len(prefix):]
+
+
+class StreamingValidator(object):
+    """
+    Validates documents record by record against the streamable rules of a compiled schema.
+
+    'skipped_rules' lists the rules that need the full document, and are not run.
+    'root_rules' lists the streamable rules that may fire on the root element of the last
+    document that was read; the root element is not validated. 'record_counts' is the number of
+    records of every name that have been read from that document.
+    """
+
+    def __init__(self, compiled_schema):
+        self.compiled_schema = compiled_schema
+        self.skipped_rules = []
+        self.root_rules = []
+        self.record_counts = {}
+        # For every pattern, the rules that can be matched within a record; a node that
+        # matches a rule that is not streamable itself does not fire the rules after it
+        self.pattern_rules = []
+        for pattern in compiled_schema.patterns:
+            self.pattern_rules.append((pattern, [rule for rule in pattern.rules if rule.streamable_context]))
+            self.skipped_rules.extend(rule for rule in pattern.rules if not rule.streamable)
+
+    def start_report(self, report):
+        """
+        Adds the patterns and the rules that are run to the given report
+        """
+        for pattern, rules in self.pattern_rules:
+            report.add_active_pattern(pattern)
+            for rule in rules:
+                if rule.streamable:
+                    report.add_fired_rule(rule)
+
+    def iter_records(self, source):
+        """
+        Reads the given document, and yields a StreamingRecord for every child element of the
+        root element. The record is removed from memory when the next one is read.
+        :param source: A filename, or a file-like object opened in binary mode
+        """
+        root = None
+        depth = 0
+        numbers = self.record_counts = {}
+        for event, element in etree.iterparse(source, events=('start', 'end')):
+            if event == 'start':
+                if depth == 0:
+                    root = element
+                    self.root_rules = self.get_root_rules(root)
+                depth += 1
+                continue
+            depth -= 1
+            if depth != 1:
+                continue
+            number = numbers.get(element.tag, 0) + 1
+            numbers[element.tag] = number
+            yield StreamingRecord(element, number)
+            # Free the record, and everything before it (such as comments); the record
+            # itself is removed with the next one, the parser may have added nodes after it
+            element.clear()
+            while element.getprevious() is not None:
+                del root[0]
+
+    def get_root_rules(self, root):
+        result = []
+        for pattern, rules in self.pattern_rules:
+            for rule in pattern.dispatch_index.get_candidate_rules(root):
+                if rule not in rules:
+                    break
+                match_pattern = rule.context.get_match_pattern()
+                if any(len(alternative.steps) == 1 and alternative.last_step.name_test(root)
+                       for alternative in match_pattern.alternatives):
+                    if rule.streamable:
+                        result.append(rule)
+                    if not any(alternative.last_step.predicates for alternative in match_pattern.alternatives):
+                        # The rule fires on the root element, the later rules cannot
+                        break
+        return result
+
+    def validate_record(self, record, report, document_index=None):
+        """
+        Runs the streamable rules for the nodes of the given record, and passes the results to
+        the given report (which must have been passed to start_report())
+        :param document_index: The DocumentIndex of the document of the record, if it is shared
+                               by several records; a new one is created if not given
+        """
+        xml_doc = record.xml_doc
+        if document_index is None:
+            document_index = DocumentIndex(xml_doc, self.compiled_schema.keys)
+        if isinstance(report, StreamingSVRLReport):
+            report.set_record(record, document_index)
+        context = ValidationContext(self.compiled_schema, xml_doc, document_index)
+        nodes = [node for node in record.element.iter() if is_element_node(node)]
+
+        for pattern, rules in self.pattern_rules:
+            if not rules:
+                continue
+            context.set_pattern(pattern)
+            matchers = {}
+            for rule in rules:
+                matchers[rule] = (rule.context.get_match_pattern().create_matcher(xml_doc, context.variables,
+                                                                                 document_index), [])
+            for node in nodes:
+                for rule in pattern.dispatch_index.get_candidate_rules(node):
+                    if rule not in matchers:
+                        # This rule and the ones after it cannot be matched within a record
+                        break
+                    matches, rule_nodes = matchers[rule]
+                    if matches(node):
+                        rule_nodes.append(node)
+                        # Only the first matching rule of a pattern fires
+                        break
+
+            for rule in rules:
+                matches, rule_nodes = matchers[rule]
+                if not rule.streamable or not rule_nodes:
+                    continue
+                context.set_rule(rule)
+                context.set_rule_nodes(rule_nodes)
+                for node in rule_nodes:
+                    context.add_rule_variables(rule, node)
+                    context.validate_assertions(node, report)
+
+    def iter_reports(self, source):
+        """
+        Validates the given document, and yields a tuple of the StreamingRecord and a
+        ValidationReport with its results for every record. Like the record, the elements
+        in the report are only available until the next record is read.
+        :param source: A filename, or a file-like object opened in binary mode
+        """
+        for record in self.iter_records(source):
+            report = ValidationReport()
+            self.start_report(report)
+            self.validate_record(record, report)
+            yield record, report
+
+    def validate_to_svrl(self, source):
+        """
+        Validates the given document, and returns the results as an SVRL SchematronOutput object
+        :param source: A filename, or a file-like object opened in binary mode
+        """
+        report = StreamingSVRLReport(self.compiled_schema)
+        self.start_report(report)
+        for record in self.iter_records(source):
+            self.validate_record(record, report)
+        report.finish(self.record_counts)
+        return report.svrl
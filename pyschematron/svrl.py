@@ -197,8 +197,8 @@ class Report(object):
 
         for child in element.getchildren():
             el_name = etree.QName(child.tag).localname
-            if el_name == 'diganostic-reference':
-                pass
+            if el_name == 'diagnostic-reference':
+                self.diagnostic_references.append(DiagnosticReference(xml_element=child))
             elif el_name == 'text':
                 self.text = Text(xml_element=child)
             else:
@@ -230,12 +230,16 @@ class SuccessfulReport(Report):
 class DiagnosticReference(object):
     def __init__(self, diagnostic=None, xml_element=None):
         self.diagnostic = diagnostic
+        self.text = None
 
         if xml_element is not None:
             self.from_xml(xml_element)
 
     def from_xml(self, element):
         self.diagnostic = element.attrib.get('diagnostic')
+        if element.text and element.text.strip():
+            # The text of the diagnostic can also be given directly
+            self.text = Text(element.text)
         for child in element.getchildren():
             el_name = etree.QName(child.tag).localname
             if el_name == 'text':
@@ -249,6 +253,7 @@ class DiagnosticReference(object):
 
         if self.text is not None:
             element.append(self.text.to_xml())
+        return element
 
 
 class Text(object):
@@ -1,16 +1,79 @@
+import glob
 import os
+import threading
+from urllib.parse import urljoin, urlsplit
+from urllib.request import url2pathname
 
+from lxml import etree
 
-class WorkingDirectory(object):
-    def __init__(self, new_directory):
-        self.new_directory = new_directory
-        self.original_directory = os.getcwd()
 
-    def __enter__(self):
-        os.chdir(self.new_directory)
+def resolve_href(href, base):
+    """
+    Resolves the href of an <include> element against the base URI of the element (see
+    lxml's _Element.base: the file it was read from, or its xml:base)
+    :param href: The (relative) reference
+    :param base: The base URI, or None to resolve against the current directory
+    :return: an absolute file path, or a URL if the base or the href is one
+    """
+    if urlsplit(href).scheme not in ('', 'file') and not os.path.isabs(href):
+        return href
+    if base is not None and urlsplit(base).scheme not in ('', 'file') and not os.path.isabs(base):
+        return urljoin(base, href)
+    if base is not None and base.startswith("file:"):
+        base = url2pathname(urlsplit(base).path)
+    if href.startswith("file:"):
+        href = url2pathname(urlsplit(href).path)
+    if base is None:
+        return os.path.abspath(href)
+    return os.path.abspath(os.path.join(os.path.dirname(base), href))
 
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        os.chdir(self.original_directory)
+
+class IncludeCache(object):
+    """
+    A cache of the parsed documents of <include> elements, shared by all schemas in the process
+    (see INCLUDE_CACHE), so that modules that are included by several schemas are parsed only
+    once. A document is parsed again if the size or modification time of its file has changed.
+    The documents are only read, so they can be used by several threads at once; a file is
+    parsed by one thread, while the others that need it wait for the result.
+    """
+
+    def __init__(self):
+        self.documents = {}
+        self.lock = threading.Lock()
+        # The locks of the files that are being parsed, by their path
+        self.file_locks = {}
+        self.parse_count = 0
+
+    def parse(self, path):
+        """
+        Returns the parsed document of the given file
+        :param path: An absolute file path (from resolve_href()), or a URL; URLs are not cached
+        :return: an ElementTree
+        """
+        if not os.path.isabs(path):
+            return etree.parse(path)
+        with self.lock:
+            file_lock = self.file_locks.setdefault(path, threading.Lock())
+        with file_lock:
+            stat = os.stat(path)
+            version = (stat.st_mtime_ns, stat.st_size)
+            with self.lock:
+                cached = self.documents.get(path)
+            if cached is not None and cached[0] == version:
+                return cached[1]
+            document = etree.parse(path)
+            with self.lock:
+                self.documents[path] = (version, document)
+                self.parse_count += 1
+            return document
+
+    def clear(self):
+        with self.lock:
+            self.documents.clear()
+
+
+# The IncludeCache that is used by all schemas
+INCLUDE_CACHE = IncludeCache()
 
 
 def abstract_replace_vars(query_binding, text, variables):
@@ -20,3 +83,24 @@ def abstract_replace_vars(query_binding, text, variables):
     for key in keys:
         s = s.replace("%s%s" % (query_binding.get_abstract_pattern_delimiter(), key), variables[key])
     return s
+
+
+def expand_paths(arguments, extension=".xml"):
+    """
+    Yields the files for the given command line arguments: files are passed on as they are,
+    directories are searched (recursively) for files with the given extension, and other
+    arguments are treated as glob patterns
+    """
+    for argument in arguments:
+        if os.path.isdir(argument):
+            for directory, subdirectories, file_names in os.walk(argument):
+                subdirectories.sort()
+                for file_name in sorted(file_names):
+                    if file_name.endswith(extension):
+                        yield os.path.join(directory, file_name)
+        elif glob.has_magic(argument):
+            for path in sorted(glob.glob(argument, recursive=True)):
+                if os.path.isfile(path):
+                    yield path
+        else:
+            yield argument
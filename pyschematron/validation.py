@@ -1,148 +1,311 @@
 from lxml import etree
 from collections import OrderedDict
+from functools import partial
 
-from pyschematron.exceptions import SchematronError
+from elementpath.xpath_nodes import is_element_node
+
+from pyschematron.exceptions import SchematronError, SchematronCancelledError
+from pyschematron.elementpath_extensions.context import DocumentIndex
+from pyschematron.compiler import BULK_NODES_VARIABLE
+from pyschematron.variables import VariableScope
+from pyschematron.svrl import SchematronOutput, ActivePattern, FiredRule, FailedAssert, SuccessfulReport, Text
+
+# Marks a constant variable that has not been evaluated yet (its value may be None)
+_MISSING = object()
 
 
 class ValidationContext(object):
     """
-    Holds all the relevant data for an assertion or report to be validated
+    Holds all the relevant data for an assertion or report to be validated.
+
+    The variables are kept in a chain of frames (see variables.VariableScope): the schema
+    frame, the phase frame, a frame for every pattern and rule, and a frame for the current
+    context node. set_pattern(), set_rule() and add_rule_variables() switch between them
+    without copying anything. The frames of the patterns and rules are kept, so that their
+    variables are evaluated at most once per document, even if a pattern or rule is set again.
     """
 
-    def __init__(self, schema, xml_doc):
+    def __init__(self, compiled_schema, xml_doc, document_index=None, cancellation=None):
         self.xml_doc = xml_doc
-        self.variables = {}
-        self.schema = schema
+        # Stops the validation when it is set, see check_cancelled()
+        self.cancellation = cancellation
+        if document_index is None:
+            document_index = DocumentIndex(xml_doc, compiled_schema.keys)
+        # Shared by every expression evaluated in this context
+        self.document_index = document_index
+        self.compiled_schema = compiled_schema
+        self.schema = compiled_schema.schema
+        self.query_binding = compiled_schema.query_binding
         self.pattern = None
         self.rule = None
+        # The variables of the current pattern (used for the rule contexts), the variables of the rule
+        # that are the same for every context node, and the variables for the current context node
+        # (see set_pattern(), set_rule() and add_rule_variables())
+        self.variables = None
+        self.rule_variables = None
+        self.node_variables = None
+        self.rule_nodes = None
+        self.bulk_results = {}
 
-        self.add_variables(schema.variables)
+        schema_frame = self.create_frame(None, compiled_schema.schema_variables)
+        self.global_variables = self.create_frame(schema_frame, compiled_schema.phase_variables)
+        self.variables = self.global_variables
+        self._pattern_frames = {}
+        self._rule_frames = {}
+
+    def create_frame(self, parent, variables):
+        """
+        Returns a new frame on top of the given one, with the given (compiled) schema, phase or
+        pattern variables. They are evaluated when they are first referenced.
+        Multiple declarations of the same variable are rejected when the schema is compiled.
+        """
+        frame = VariableScope(parent)
+        for variable in variables:
+            frame.add_let(variable.name, partial(self.evaluate_variable, variable, frame))
+        return frame
 
     def set_pattern(self, pattern):
         """
         Set the context pattern.
-        This also adds the pattern variables to the context
-        :param pattern: The pattern to set
+        This also makes the pattern variables available
+        :param pattern: The (compiled) pattern to set
         :return:
         """
+        self.check_cancelled()
         self.pattern = pattern
-        self.add_variables(pattern.variables)
+        self.rule = None
+        frame = self._pattern_frames.get(pattern)
+        if frame is None:
+            frame = self._pattern_frames[pattern] = self.create_frame(self.global_variables, pattern.variables)
+        self.variables = frame
 
     def set_rule(self, rule):
         """
-        Set the context rule.
-        This DOES NOT add the rule variables to the context.
-        That is done with a separate call to add_rule_variables(), as we need the document elements
-        that match the rule's context to correctly evaluate the variable's value (which are generally unknown
-        at the time this method is called, as the rule's context itself is necessary to determine those elements).
+        Set the context rule, which must be a rule of the context pattern.
+        This adds the rule variables that do not depend on the context node (they are evaluated
+        once for the rule, on first use). The other rule variables are added with a separate call
+        to add_rule_variables(), for every context node.
+        The rule variables are not visible to the rule context expression.
         :param rule:
         :return:
         """
+        self.check_cancelled()
         self.rule = rule
+        frame = self._rule_frames.get(rule)
+        if frame is None:
+            frame = self._rule_frames[rule] = self.add_rule_lets(self.variables, rule.rule_variables, None)
+        self.rule_variables = frame
+        self.node_variables = frame
+        self.rule_nodes = None
+        self.bulk_results = {}
+
+    def check_cancelled(self):
+        """
+        Stops the validation if the cancellation of this context (an object with an is_set()
+        method, such as a threading.Event) has been set; the engines call this through
+        set_pattern() and set_rule() (and the document engine for every node), so a validation
+        stops between patterns and rules
+        :raises SchematronCancelledError: if the validation has been cancelled
+        """
+        if self.cancellation is not None and self.cancellation.is_set():
+            raise SchematronCancelledError("The validation was cancelled")
+
+    def set_rule_nodes(self, nodes):
+        """
+        Set the nodes that the context rule fires on.
+        If this is set, the assertions that allow it are evaluated for all of these nodes at once,
+        the first time validate_assertions() is called.
+        :param nodes: list of nodes
+        """
+        self.rule_nodes = nodes
+
+    def get_bulk_result(self, rule_test, report):
+        """
+        Returns the set of nodes for which the given assertion fails, or the given report is
+        triggered, or None if the test has to be evaluated for each node separately
+        """
+        if rule_test.bulk_test is None or self.rule_nodes is None:
+            return None
+        if rule_test not in self.bulk_results:
+            if all(is_element_node(node) for node in self.rule_nodes):
+                variables = VariableScope(self.rule_variables)
+                variables[BULK_NODES_VARIABLE] = self.rule_nodes
+                self.msg(4, "Bulk evaluation of test: %s" % rule_test.source.test)
+                result = rule_test.bulk_test.get_results(self.xml_doc, None, variables, self.document_index)
+                self.bulk_results[rule_test] = set(result)
+                report.add_bulk_test(self.rule, rule_test)
+            else:
+                self.bulk_results[rule_test] = None
+        return self.bulk_results[rule_test]
 
     # Special case for adding variables: within rules,
     # we have to use the context of the rule
     def add_rule_variables(self, rule, element):
-        for name, value in rule.variables.items():
-            self.variables[name] = self.schema.query_binding.interpret_let_statement(self.xml_doc, value, self.schema.ns_prefixes, self.variables,
-                                                                                     context_item=element)
-
-    # General case for adding variables
-    def add_variables(self, variables, element=None):
-        for name, value in variables.items():
-            # Disallow multiple declarations of the same variables,
-            # except in the case of rules
-            if element is None and name in self.variables:
-                raise SchematronError("Variable %s is declared multiple times within the same context" % name)
-            self.variables[name] = self.schema.query_binding.interpret_let_statement(self.xml_doc, value, self.schema.ns_prefixes, self.variables)
-
-    def copy(self):
-        """
-        Creates a clone of this ValidationContext
-        :return:
         """
-        copy = ValidationContext(self.schema, self.xml_doc)
-        copy.__dict__.update(self.__dict__)
-        return copy
+        Replaces the frame of the previous context node by one with the rule variables that
+        depend on the context node, for the given node. They are only evaluated if the
+        assertions of the node refer to them.
+        """
+        self.node_variables = self.add_rule_lets(self.rule_variables, rule.node_variables, element)
+
+    def add_rule_lets(self, frame, variables, element):
+        """
+        Returns a new frame on top of the given one, with the given rule variables evaluated for
+        the given context node (None for the variables that do not depend on it).
+        Every variable gets a frame of its own, so that it can refer to an earlier variable of the
+        same name (rule variables may overwrite the variables of the pattern or schema).
+        """
+        for variable in variables:
+            frame = VariableScope(frame)
+            if element is None:
+                frame.add_let(variable.name, partial(self.evaluate_variable, variable, frame.parent))
+            else:
+                frame.add_let(variable.name, partial(variable.evaluate, self.xml_doc, element, frame.parent,
+                                                     self.document_index))
+        return frame
+
+    def evaluate_variable(self, variable, frame):
+        """
+        Evaluates a variable in the given frame, with the document node as the context item.
+        The values that do not depend on the document are computed once, and kept in the schema.
+        """
+        if variable.constant_key is None:
+            return variable.evaluate(self.xml_doc, None, frame, self.document_index)
+        values = self.schema.constant_variable_values
+        value = values.get(variable.constant_key, _MISSING)
+        if value is _MISSING:
+            self.msg(4, "Evaluating constant variable: %s" % variable.name)
+            # Another thread may have evaluated it in the meantime; every thread uses the first value
+            value = values.setdefault(variable.constant_key,
+                                      variable.evaluate(self.xml_doc, None, frame, self.document_index))
+        return value
 
     def msg(self, level, msg):
         if self.schema.verbosity >= level:
             print(msg)
 
+    def msg_variables(self, level):
+        """
+        Prints the variables of the current context node; the variables that have not been
+        evaluated are not evaluated for this
+        """
+        if self.schema.verbosity >= level:
+            for name in self.node_variables:
+                if self.node_variables.is_evaluated(name):
+                    self.msg(level, "  %s: %s" % (name, self.node_variables[name]))
+                else:
+                    self.msg(level, "  %s: (not evaluated)" % name)
+
     def get_rule_context_elements(self):
         """
         Returns all the elements in the xml doc that match the rule's context expression
         :return:
         """
-        if self.rule.context == '/':
+        if self.rule.context_text == '/':
             return [None]
         else:
-            return self.schema.query_binding.get_context_elements(self.xml_doc,
-                                                                  self.rule.context,
-                                                                  namespaces=self.schema.ns_prefixes,
-                                                                  variables=self.variables)
+            return self.query_binding.select_context_elements(self.xml_doc, self.rule.context, self.variables,
+                                                             self.document_index)
+
+    def get_rule_context_matcher(self):
+        """
+        Returns a function that tests whether a given node matches the rule's context expression.
+        The document node is represented by None.
+        :return:
+        """
+        if self.rule.context_text == '/':
+            return lambda node: node is None
+        else:
+            matcher = self.query_binding.create_context_matcher(self.xml_doc, self.rule.context, self.variables,
+                                                                 self.document_index)
+            return lambda node: node is not None and matcher(node)
 
     def validate_assertions(self, element, report):
         rule = self.rule
         for assert_test in rule.assertions:
-            self.msg(3, "Start assert test: %s" % assert_test.id)
-            self.msg(4, "Test context: %s" % str(rule.context))
-            self.msg(4, "Test expression: %s" % assert_test.test)
-            result = self.schema.query_binding.evaluate_assertion(self.xml_doc, element, self.schema.ns_prefixes, self.variables,
-                                                                  assert_test.test)
+            self.msg(3, "Start assert test: %s" % assert_test.source.id)
+            self.msg(4, "Test context: %s" % str(rule.context_text))
+            self.msg(4, "Test expression: %s" % assert_test.source.test)
+            failed = self.get_bulk_result(assert_test, report)
+            if failed is not None:
+                result = element not in failed
+            else:
+                result = assert_test.evaluate(self.xml_doc, element, self.node_variables, self.document_index)
             if not result:
                 self.msg(5, "Failed assertion")
                 self.msg(5, "Pattern: %s" % self.pattern.id)
                 self.msg(5, "Variables:")
-                for k, v in self.variables.items():
-                    self.msg(5, "  %s: %s" % (k, v))
+                self.msg_variables(5)
                 self.msg(5, "Context root: %s" % str(self.xml_doc.getroot()))
-                self.msg(5, "Context item: %s" % rule.context)
+                self.msg(5, "Context item: %s" % rule.context_text)
                 self.msg(5, "CONTEXT ELEMENT: " + etree.tostring(element, pretty_print=True).decode('utf-8'))
-                if assert_test.id:
-                    self.msg(5, "Id: " + assert_test.id)
-                self.msg(5, "Test: '%s'" % assert_test.test)
-                self.msg(5, "Initial text: '%s'" % assert_test.to_string())
+                if assert_test.source.id:
+                    self.msg(5, "Id: " + assert_test.source.id)
+                self.msg(5, "Test: '%s'" % assert_test.source.test)
+                self.msg(5, "Initial text: '%s'" % assert_test.source.to_string())
                 self.msg(5, "Result: %s" % str(result))
 
-                report.add_failed_assert(self, assert_test, element)
+                report.add_failed_assert(rule, assert_test, element)
         for report_test in rule.reports:
-            self.msg(3, "Start report test: %s" % report_test.id)
-            self.msg(4, "Test context: %s" % str(rule.context))
-            self.msg(4, "Test expression: %s" % report_test.test)
-            result = self.schema.query_binding.evaluate_assertion(self.xml_doc, element, self.schema.ns_prefixes, self.variables,
-                                                                  report_test.test)
+            self.msg(3, "Start report test: %s" % report_test.source.id)
+            self.msg(4, "Test context: %s" % str(rule.context_text))
+            self.msg(4, "Test expression: %s" % report_test.source.test)
+            triggered = self.get_bulk_result(report_test, report)
+            if triggered is not None:
+                result = element in triggered
+            else:
+                result = report_test.evaluate(self.xml_doc, element, self.node_variables, self.document_index)
             if result:
                 self.msg(5, "Succesful report")
                 self.msg(5, "Pattern: %s" % self.pattern.id)
                 self.msg(5, "Variables:")
-                for k, v in self.variables.items():
-                    self.msg(5, "  %s: %s" % (k, v))
+                self.msg_variables(5)
                 self.msg(5, "Context root: %s" % str(self.xml_doc.getroot()))
-                self.msg(5, "Context item: %s" % rule.context)
+                self.msg(5, "Context item: %s" % rule.context_text)
                 self.msg(5, "CONTEXT ELEMENT: " + etree.tostring(element, pretty_print=True).decode('utf-8'))
-                if report_test.id:
-                    self.msg(5, "Id: " + report_test.id)
-                self.msg(5, "Test: '%s'" % report_test.test)
+                if report_test.source.id:
+                    self.msg(5, "Id: " + report_test.source.id)
+                self.msg(5, "Test: '%s'" % report_test.source.test)
                 self.msg(5, "Result: %s" % str(result))
 
-                report.add_successful_report(self, report_test, element)
+                report.add_successful_report(rule, report_test, element)
 
 
 class ValidationReport(object):
+    """
+    The result of Schema.validate_document().
+    For every rule, it holds the failed asserts and successful reports, as a list of tuples
+    of the original Assertion or Report object and the context element.
+    bulk_tests lists the asserts and reports that were evaluated for all their context nodes at once.
+    """
+
     def __init__(self):
         self.fired_rules = OrderedDict()
+        self.bulk_tests = []
+        # The results of every rule as a set, so that duplicates are found in constant time
+        self._seen = {}
+
+    def add_active_pattern(self, pattern):
+        pass
+
+    def add_bulk_test(self, rule, rule_test):
+        self.bulk_tests.append(rule_test.source)
 
-    def add_fired_rule(self, rule_context):
-        self.fired_rules[rule_context] = []
+    def add_fired_rule(self, rule):
+        self.fired_rules[rule] = []
+        self._seen[rule] = set()
 
-    def add_failed_assert(self, rule_context, assertion, element):
-        if (assertion, element) not in self.fired_rules[rule_context]:
-            self.fired_rules[rule_context].append((assertion, element))
+    def add_failed_assert(self, rule, assertion, element):
+        self._add_result(rule, (assertion.source, element))
 
-    def add_successful_report(self, rule_context, report, element):
-        if (report, element) not in self.fired_rules[rule_context]:
-            self.fired_rules[rule_context].append((report, element))
+    def add_successful_report(self, rule, report, element):
+        self._add_result(rule, (report.source, element))
+
+    def _add_result(self, rule, result):
+        seen = self._seen[rule]
+        if result not in seen:
+            seen.add(result)
+            self.fired_rules[rule].append(result)
 
     def get_failed_asserts(self):
         """
@@ -166,6 +329,19 @@ class ValidationReport(object):
             result.extend([fa for fa, el in failed_asserts if fa.flag == flag])
         return result
 
+    def get_errors_and_warnings(self):
+        """
+        Splits the failed asserts and successful reports up in errors and warnings: the ones with
+        the flag 'warning' are warnings, all others are errors (grouped by their flags)
+        :return: a tuple of the lists of errors and warnings
+        """
+        failed_asserts = self.get_failed_asserts_by_flag()
+        warnings = failed_asserts.pop('warning', [])
+        errors = []
+        for error_list in failed_asserts.values():
+            errors.extend(error_list)
+        return errors, warnings
+
     def get_failed_asserts_by_flag(self, default_flag=None):
         """
         Returns a dict of failed asserts and succesful reports, keyed by their flags.
@@ -183,3 +359,108 @@ class ValidationReport(object):
                 else:
                     result[assert_flag] = [(failed_assert, element)]
         return result
+
+
+class ValidationMessage(object):
+    """
+    A failed assert or successful report, with its message resolved for the context element.
+    It only holds plain values, so that it can be passed between processes (see batch.py).
+    'line' is the line number of the context element in the document, if it is known.
+    """
+
+    def __init__(self, id, flag, test, location, text, diagnostics=(), line=None):
+        self.id = id
+        self.flag = flag
+        self.test = test
+        self.location = location
+        self.text = text
+        self.diagnostics = tuple(diagnostics)
+        self.line = line
+
+    def __repr__(self):
+        return "%s(%r, %r)" % (self.__class__.__name__, self.id, self.location)
+
+
+def resolve_messages(failed_asserts, xml_doc, namespaces=None):
+    """
+    Resolves the given failed asserts and successful reports
+    :param failed_asserts: A list of tuples of Assertion or Report objects and their context elements
+    :param xml_doc: The document that was validated
+    :param namespaces: The namespace prefixes of the schema, for the <name> elements in the messages
+    :return: a list of ValidationMessage objects
+    """
+    return [create_message(test, element, xml_doc, namespaces) for test, element in failed_asserts]
+
+
+def create_message(test, element, xml_doc, namespaces=None, location=None, line=None):
+    """
+    Resolves a single failed assert or successful report; the location and line number of the
+    element are taken from the document, unless they are given
+    :return: a ValidationMessage
+    """
+    diagnostics = test.get_schema().diagnostics
+    if location is None:
+        location = "/" if element is None else xml_doc.getelementpath(element)
+    if line is None and element is not None:
+        line = element.sourceline
+    return ValidationMessage(test.id, test.flag, test.test, location,
+                             test.to_string(resolve=True, xml_doc=xml_doc, current_element=element,
+                                            namespaces=namespaces),
+                             [diagnostics[d_id].text for d_id in test.diagnostic_ids if d_id in diagnostics],
+                             line)
+
+
+class SVRLReport(object):
+    """
+    Collects the validation results as an SVRL SchematronOutput object (available as the
+    'svrl' member)
+    """
+
+    def __init__(self, compiled_schema, xml_doc, document_index=None):
+        schema = compiled_schema.schema
+        self.xml_doc = xml_doc
+        self.document_index = document_index
+        self.svrl = SchematronOutput(title=schema.title, phase=compiled_schema.phase, schema_version=schema.schema_version,
+                                     namespaces=compiled_schema.namespaces)
+        self.fired_rules = {}
+        self.bulk_tests = []
+
+    def add_bulk_test(self, rule, rule_test):
+        self.bulk_tests.append(rule_test.source)
+
+    def get_location(self, element):
+        """
+        Returns the location of the given element, for the failed asserts and successful reports
+        """
+        return self.xml_doc.getelementpath(element)
+
+    def add_active_pattern(self, pattern):
+        # SVRL has 'role' in (active-)pattern but schematron does not? TODO: check this
+        self.svrl.add_active_pattern(ActivePattern(id=pattern.id, name=pattern.id, role=None))
+
+    def add_fired_rule(self, rule):
+        source = rule.source
+        fired_rule = FiredRule(id=source.id, context=source.context, role=source.role, flag=source.flag)
+        self.fired_rules[rule] = fired_rule
+        self.svrl.last_active_pattern.add_fired_rule(fired_rule)
+
+    def add_failed_assert(self, rule, assertion, element):
+        source = assertion.source
+        report = FailedAssert(id=source.id,
+                              location=self.get_location(element),
+                              test=source.test,
+                              role=source.role,
+                              flag=source.flag)
+        report.text = Text(source.to_string())
+        # TODO: location, and diagnostic_references
+        self.fired_rules[rule].add_report(report)
+
+    def add_successful_report(self, rule, report_test, element):
+        source = report_test.source
+        report = SuccessfulReport(id=source.id,
+                                  location=self.get_location(element),
+                                  test=source.test,
+                                  role=source.role,
+                                  flag=source.flag)
+        report.text = Text(report_test.message.resolve(self.xml_doc, element, self.document_index))
+        self.fired_rules[rule].add_report(report)
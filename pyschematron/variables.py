@@ -0,0 +1,121 @@
+"""
+The variables of a validation run.
+
+A VariableScope is a frame of variables: it maps variable names to values, like a dict, and
+is passed to the query bindings as such. Frames are chained (schema, phase, pattern, rule,
+context node, see validation.ValidationContext); a name is looked up in the frame itself and
+then in its parents, so adding or leaving a frame costs O(1) and nothing is copied.
+
+The let statements are not evaluated when they are added to a frame: each one is evaluated
+the first time an expression refers to it (evaluating the lets it depends on first, in the
+same way), and its value is kept for the rest of the validation of the document. Lets that
+are never referenced are never evaluated.
+
+copy() returns an empty frame on top of the original one, in which values can be set
+without changing the original (the elementpath contexts do this for 'for', 'some' and
+'every' expressions). Lets are always evaluated in the frame that they were added to, so
+they cannot see the variables of inner frames.
+"""
+from collections.abc import MutableMapping
+
+from pyschematron.exceptions import SchematronError
+
+# Marks a let that is being evaluated, to detect circular references
+_EVALUATING = object()
+
+
+class VariableScope(MutableMapping):
+    def __init__(self, parent=None):
+        self.parent = parent
+        self._values = {}
+        self._lets = {}
+
+    def add_let(self, name, evaluate_function):
+        """
+        Adds a variable whose value is computed by the given function on first use.
+        The function is called without arguments.
+        """
+        self._values.pop(name, None)
+        self._lets[name] = evaluate_function
+
+    def is_evaluated(self, name):
+        """
+        Returns True if the variable with the given name has a value already (in this scope or
+        one of its parents)
+        """
+        scope = self
+        while scope is not None:
+            if name in scope._values:
+                return True
+            if name in scope._lets:
+                return False
+            scope = scope.parent
+        return False
+
+    def _evaluate(self, name):
+        evaluate_function = self._lets[name]
+        if evaluate_function is _EVALUATING:
+            raise SchematronError("Circular reference to variable %s" % name)
+        self._lets[name] = _EVALUATING
+        try:
+            value = evaluate_function()
+        except BaseException:
+            self._lets[name] = evaluate_function
+            raise
+        del self._lets[name]
+        self._values[name] = value
+        return value
+
+    def __getitem__(self, name):
+        scope = self
+        while scope is not None:
+            if name in scope._values:
+                return scope._values[name]
+            if name in scope._lets:
+                return scope._evaluate(name)
+            scope = scope.parent
+        raise KeyError(name)
+
+    def __contains__(self, name):
+        scope = self
+        while scope is not None:
+            if name in scope._values or name in scope._lets:
+                return True
+            scope = scope.parent
+        return False
+
+    def __setitem__(self, name, value):
+        self._lets.pop(name, None)
+        self._values[name] = value
+
+    def __delitem__(self, name):
+        if name in self._values:
+            del self._values[name]
+        elif name in self._lets:
+            del self._lets[name]
+        else:
+            raise KeyError(name)
+
+    def __iter__(self):
+        scopes = []
+        scope = self
+        while scope is not None:
+            scopes.append(scope)
+            scope = scope.parent
+        names = {}
+        for scope in reversed(scopes):
+            names.update(dict.fromkeys(scope._values))
+            names.update(dict.fromkeys(scope._lets))
+        return iter(names)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def copy(self):
+        if not self._values and not self._lets:
+            # Nothing to hide, keep the chain short
+            return VariableScope(self.parent)
+        return VariableScope(self)
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, list(self))
@@ -47,7 +47,37 @@ def create_xsl_variable(name):
     return element
 
 
-def schema_to_xsl(schema, phase_name="#DEFAULT"):
+def add_pattern_params(template, pattern):
+    """
+    Declares the variables of the pattern as parameters of one of its templates
+    """
+    for name in pattern.variables:
+        template.append(E('xsl', 'param', {'name': name}))
+
+
+def add_pattern_with_params(apply_templates, pattern, renamed=()):
+    """
+    Passes the variables of the pattern on to the templates that are applied; renamed are those
+    that a rule variable of the template redefines (see get_pattern_variable_alias())
+    """
+    for name in pattern.variables:
+        value = get_pattern_variable_alias(name) if name in renamed else name
+        apply_templates.append(E('xsl', 'with-param', {'name': name, 'select': '$%s' % value}))
+    return apply_templates
+
+
+def get_pattern_variable_alias(name):
+    return "pyschematron-pattern-%s" % name
+
+
+def schema_to_xsl(schema, phase_name="#DEFAULT", document_uri=True):
+    """
+    Converts the schema to an XSLT stylesheet, in the form of the skeleton implementation
+    :param phase_name: The phase whose patterns are included
+    :param document_uri: Whether the SVRL output contains the document uri; document-uri() is an
+                         XPath 2.0 function, so stylesheets that are run with libxslt leave it out
+    :return: the root element of the stylesheet
+    """
     if phase_name == "#DEFAULT":
         phase_name = schema.default_phase
 
@@ -79,7 +109,8 @@ def schema_to_xsl(schema, phase_name="#DEFAULT"):
     else:
         apply_templates_select += "*|comment()|processing-instruction()"
 
-    root = E("xsl", "stylesheet")
+    # The namespaces of the schema are used in the rule contexts and tests
+    root = E("xsl", "stylesheet", nsmap=schema.ns_prefixes)
     if schema.query_binding_name == 'xslt':
         root.attrib['version'] = '1.0'
         predefined_elements = get_predefined_elements_xslt1()
@@ -94,8 +125,9 @@ def schema_to_xsl(schema, phase_name="#DEFAULT"):
     root.append(create_xsl_param('fileNameParameter'))
     root.append(create_xsl_param('fileDirParameter'))
 
-    root.append(E('xsl', 'variable', {'name': 'document-uri'},
-                  child=E('xsl', 'value-of', {'select': 'document-uri(/)'})))
+    if document_uri:
+        root.append(E('xsl', 'variable', {'name': 'document-uri'},
+                      child=E('xsl', 'value-of', {'select': 'document-uri(/)'})))
 
     root.append(C('PHASES'))
     # TODO: Phases set at xsl generation time?
@@ -105,6 +137,8 @@ def schema_to_xsl(schema, phase_name="#DEFAULT"):
 
     root.append(C('XSD TYPES FOR XSLT2'))
     root.append(C('KEYS AND FUNCTIONS'))
+    for key in schema.keys.values():
+        root.append(E('xsl', 'key', {'name': key.name, 'match': key.match, 'use': key.use}))
     root.append(C('DEFAULT RULES'))
 
     # root.append(get_predefined_elements())
@@ -132,13 +166,24 @@ def schema_to_xsl(schema, phase_name="#DEFAULT"):
     mode_count = schema.element_number_of_first_pattern
     for pattern in patterns:
         pattern_element = E('svrl', 'active-pattern')
-        pattern_element.append(E('xsl', 'attribute', {'name': 'document'}, child=E('xsl', 'value-of', {'select': 'document-uri(/)'})))
+        if document_uri:
+            pattern_element.append(E('xsl', 'attribute', {'name': 'document'}, child=E('xsl', 'value-of', {'select': 'document-uri(/)'})))
         if pattern.id:
             pattern_element.append(E('xsl', 'attribute', {'name': 'id'}, text=pattern.id))
             pattern_element.append(E('xsl', 'attribute', {'name': 'name'}, text=pattern.id))
         pattern_element.append(E('xsl', 'apply-templates'))
         schematron_output.append(pattern_element)
-        schematron_output.append(E('xsl', 'apply-templates', {'select': '/', 'mode': "M%d" % mode_count}))
+        apply_templates = E('xsl', 'apply-templates', {'select': '/', 'mode': "M%d" % mode_count})
+        if pattern.variables:
+            # The variables of a pattern are evaluated for the document node, and passed on to the
+            # templates of the pattern as parameters: other patterns may use the same names
+            pattern_scope = E('xsl', 'for-each', {'select': '/'})
+            for name, value in pattern.variables.items():
+                pattern_scope.append(E('xsl', 'variable', {'name': name, 'select': value}))
+            pattern_scope.append(add_pattern_with_params(apply_templates, pattern))
+            schematron_output.append(pattern_scope)
+        else:
+            schematron_output.append(apply_templates)
         mode_count += 1
     schema_setup.append(schematron_output)
     root.append(schema_setup)
@@ -160,6 +205,12 @@ def schema_to_xsl(schema, phase_name="#DEFAULT"):
                 continue
             root.append(C('RULE %s' % rule.id))
             rule_element = E('xsl', 'template', {'match': rule.context, 'priority': '%d' % priority, 'mode': 'M%d' % mode_count})
+            add_pattern_params(rule_element, pattern)
+            # A rule variable may redefine a pattern variable; the value of the pattern is kept
+            # under another name, to pass it on to the descendants
+            renamed = [name for name in rule.variables if name in pattern.variables]
+            for name in renamed:
+                rule_element.append(E('xsl', 'variable', {'name': get_pattern_variable_alias(name), 'select': '$%s' % name}))
             rule_element.append(E('svrl', 'fired-rule', {'context': rule.context}))
             for name, value in rule.variables.items():
                 rule_element.append(E('xsl', 'variable', {'name': name, 'select': value}))
@@ -209,15 +260,19 @@ def schema_to_xsl(schema, phase_name="#DEFAULT"):
 
             # depends on qbinding maybe?
             # rule_element.append(E('xsl', 'apply-templates', {'select': '*|comment()|processing-instruction()', 'mode': "M%d" % mode_count}))
-            rule_element.append(E('xsl', 'apply-templates', {'select': apply_templates_select, 'mode': "M%d" % mode_count}))
+            rule_element.append(add_pattern_with_params(
+                E('xsl', 'apply-templates', {'select': apply_templates_select, 'mode': "M%d" % mode_count}), pattern, renamed))
             root.append(rule_element)
             priority -= 1
         root.append(E('xsl', 'template', {'match': 'text()', 'priority': '-1', 'mode': "M%d" % mode_count}))
         # depends on qbinding maybe?
         # root.append(E('xsl', 'template', {'match': '@*|node()', 'priority': '-2', 'mode': "M%d" % mode_count},
         #              child=E('xsl', 'apply-templates', {'select': '*|comment()|processing-instruction()', 'mode': 'M%d' % mode_count})))
-        root.append(E('xsl', 'template', {'match': '@*|node()', 'priority': '-2', 'mode': "M%d" % mode_count},
-                      child=E('xsl', 'apply-templates', {'select': apply_templates_select, 'mode': 'M%d' % mode_count})))
+        default_template = E('xsl', 'template', {'match': '@*|node()', 'priority': '-2', 'mode': "M%d" % mode_count})
+        add_pattern_params(default_template, pattern)
+        default_template.append(add_pattern_with_params(
+            E('xsl', 'apply-templates', {'select': apply_templates_select, 'mode': 'M%d' % mode_count}), pattern))
+        root.append(default_template)
         mode_count += 1
 
     return root
@@ -0,0 +1,213 @@
+import asyncio
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from concurrent.futures import ProcessPoolExecutor
+from unittest import mock
+
+from lxml import etree
+
+from pyschematron import aio
+from pyschematron.aio import AsyncValidator
+from pyschematron.elements import Schema
+from pyschematron.exceptions import SchematronCancelledError
+
+from test_util import get_file
+
+XML_FILES = ["basic1_ok.xml", "basic1_error_1.xml", "basic1_error_2.xml", "basic1_warning_3.xml"]
+
+
+def get_failed_asserts(report, xml_doc):
+    return [(test.id, test.test, xml_doc.getelementpath(element)) for test, element in report.get_failed_asserts()]
+
+
+def create_slow_schema(pattern_count=100):
+    patterns = "".join('<pattern><rule context="item"><assert test="@v != %d">Value %d</assert></rule></pattern>'
+                       % (number, number) for number in range(pattern_count))
+    return Schema(xml_element=etree.XML('<schema xmlns="http://purl.oclc.org/dsdl/schematron">%s</schema>' % patterns))
+
+
+SLOW_DOCUMENT = ("<items>" + '<item v="1"/>' * 1000 + "</items>").encode('utf-8')
+
+
+class TestCancellation(unittest.TestCase):
+    def test_cancelled(self):
+        schema = Schema(get_file("schematron", "basic.sch"))
+        xml_doc = etree.parse(get_file("xml", "basic1_error_1.xml"))
+        cancellation = threading.Event()
+        cancellation.set()
+        for engine in ('rules', 'document'):
+            self.assertRaises(SchematronCancelledError, schema.validate_document, xml_doc, engine=engine,
+                              cancellation=cancellation)
+            self.assertRaises(SchematronCancelledError, schema.validate_document_to_svrl, xml_doc, engine=engine,
+                              cancellation=cancellation)
+        schema = Schema(get_file("schematron", "keys.sch"))
+        self.assertRaises(SchematronCancelledError, schema.validate_document, etree.parse(get_file("xml", "keys.xml")),
+                          engine='xslt', cancellation=cancellation)
+
+
+class TestAsyncValidator(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.schema = Schema(get_file("schematron", "basic.sch"))
+
+    def read(self, xml_file):
+        with open(xml_file, 'rb') as document:
+            return document.read()
+
+    async def check_same_results(self, validator):
+        for name in XML_FILES:
+            xml_file = get_file("xml", name)
+            xml_doc = etree.parse(xml_file)
+            expected = get_failed_asserts(self.schema.validate_document(xml_doc), xml_doc)
+            for source in (xml_file, self.read(xml_file), xml_doc):
+                report = await validator.validate_document(source)
+                failed_asserts = report.get_failed_asserts()
+                result_doc = failed_asserts[0][1].getroottree() if failed_asserts else xml_doc
+                self.assertEqual(expected, get_failed_asserts(report, result_doc))
+            expected = etree.tostring(self.schema.validate_document_to_svrl(xml_doc).to_xml())
+            svrl = await validator.validate_document_to_svrl(xml_file)
+            self.assertEqual(expected, etree.tostring(svrl.to_xml()))
+
+    async def test_threads(self):
+        async with AsyncValidator(self.schema) as validator:
+            await self.check_same_results(validator)
+
+    async def test_processes(self):
+        with ProcessPoolExecutor(2) as executor:
+            async with AsyncValidator(self.schema, executor=executor) as validator:
+                await self.check_same_results(validator)
+
+    async def test_errors(self):
+        async with AsyncValidator(self.schema) as validator:
+            with self.assertRaises(etree.XMLSyntaxError):
+                await validator.validate_document(b"<not well-formed")
+            # The slot is free again
+            await asyncio.wait_for(asyncio.gather(*[validator.slots.acquire()
+                                                    for _ in range(validator.max_in_flight)]), 5)
+
+    async def test_max_in_flight(self):
+        running = []
+        maximum = []
+        lock = threading.Lock()
+        validate = aio._validate
+
+        def slow_validate(*args):
+            with lock:
+                running.append(None)
+                maximum.append(len(running))
+            time.sleep(0.01)
+            with lock:
+                running.pop()
+            return validate(*args)
+
+        xml_file = get_file("xml", "basic1_error_1.xml")
+        with mock.patch.object(aio, '_validate', side_effect=slow_validate):
+            async with AsyncValidator(self.schema, max_in_flight=2) as validator:
+                reports = await asyncio.gather(*[validator.validate_document(xml_file) for _ in range(10)])
+        self.assertEqual(10, len(reports))
+        self.assertEqual(2, max(maximum))
+
+    async def test_replay_in_slot(self):
+        # The results of a worker process are replayed before the slot is released
+        locked = []
+        replay = AsyncValidator.replay
+
+        def check_replay(validator, calls, source):
+            locked.append(validator.slots.locked())
+            return replay(validator, calls, source)
+
+        xml_file = get_file("xml", "basic1_error_1.xml")
+        with ProcessPoolExecutor(1) as executor, mock.patch.object(AsyncValidator, 'replay', check_replay):
+            async with AsyncValidator(self.schema, executor=executor, max_in_flight=1) as validator:
+                report = await validator.validate_document(xml_file)
+                self.assertFalse(validator.slots.locked())
+        self.assertEqual(["1"], [test.id for test, element in report.get_failed_asserts()])
+        self.assertEqual([True], locked)
+
+    async def check_cancel(self, executor=None):
+        async with AsyncValidator(create_slow_schema(), executor=executor, max_in_flight=1) as validator:
+            task = asyncio.ensure_future(validator.validate_document(SLOW_DOCUMENT))
+            await asyncio.sleep(0.2)
+            task.cancel()
+            start = time.monotonic()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            # The slot is released when the validation has stopped
+            await asyncio.wait_for(validator.slots.acquire(), 5)
+            self.assertLess(time.monotonic() - start, 1)
+
+    async def test_cancel(self):
+        await self.check_cancel()
+
+    async def test_cancel_in_process(self):
+        with ProcessPoolExecutor(1) as executor:
+            await self.check_cancel(executor)
+
+
+class TestAsyncValidateMany(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.malformed_file = os.path.join(self.directory, "malformed.xml")
+        with open(self.malformed_file, 'w') as output:
+            output.write("<not well-formed")
+        self.schema = Schema(get_file("schematron", "basic.sch"))
+        self.paths = [get_file("xml", name) for name in XML_FILES] + [self.malformed_file]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def get_expected(self):
+        return [(result.path, result.get_result_code(), [message.location for message in result.errors])
+                for result in self.schema.validate_many(self.paths, workers=1)]
+
+    async def get_results(self, validator, sources, ordered=True):
+        return [(result.path, result.get_result_code(), [message.location for message in result.errors])
+                async for result in validator.validate_many(sources, ordered)]
+
+    async def check_same_results(self, validator):
+        expected = self.get_expected()
+        self.assertEqual(expected, await self.get_results(validator, self.paths))
+        self.assertEqual(sorted(expected), sorted(await self.get_results(validator, self.paths, ordered=False)))
+
+        # Contents, from an async iterable
+        async def iter_contents():
+            for path in self.paths:
+                with open(path, 'rb') as document:
+                    yield path, document.read()
+
+        self.assertEqual(expected, await self.get_results(validator, iter_contents()))
+
+    async def test_threads(self):
+        async with AsyncValidator(self.schema, max_in_flight=2) as validator:
+            await self.check_same_results(validator)
+
+    async def test_processes(self):
+        with ProcessPoolExecutor(2) as executor:
+            async with AsyncValidator(self.schema, executor=executor, max_in_flight=2) as validator:
+                await self.check_same_results(validator)
+
+    async def test_break(self):
+        async with AsyncValidator(self.schema, max_in_flight=2) as validator:
+            for _ in range(2):
+                results = validator.validate_many(self.paths * 5)
+                async for result in results:
+                    break
+                await results.aclose()
+            # The slots of the validations that were cancelled before they started are released too
+            self.assertEqual(self.get_expected(), await asyncio.wait_for(self.get_results(validator, self.paths), 5))
+
+    async def test_stop_early(self):
+        async with AsyncValidator(create_slow_schema(), max_in_flight=2) as validator:
+            results = validator.validate_many(("document%d.xml" % number, SLOW_DOCUMENT) for number in range(20))
+            first = asyncio.ensure_future(results.__anext__())
+            await asyncio.sleep(0.2)
+            # The validations that are running are cancelled with the iteration
+            first.cancel()
+            start = time.monotonic()
+            with self.assertRaises(asyncio.CancelledError):
+                await first
+            await asyncio.wait_for(asyncio.gather(*[validator.slots.acquire() for _ in range(2)]), 5)
+            self.assertLess(time.monotonic() - start, 1)
@@ -1,10 +1,24 @@
 import unittest
 
+from test_aio import *
+from test_batch import *
+from test_benchmarks import *
 from test_commands import *
+from test_compiler import *
+from test_engines import *
+from test_includes import *
+from test_parallel import *
 from test_parsing import *
+from test_query_bindings import *
+from test_schema_cache import *
 from test_schematron_parser import *
+from test_server import *
+from test_sharding import *
+from test_streaming import *
 from test_svrl import *
+from test_threading import *
 from test_validation import *
+from test_variables import *
 
 if __name__ == '__main__':
     unittest.main()
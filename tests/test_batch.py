@@ -0,0 +1,66 @@
+import os
+import unittest
+from io import StringIO
+
+from lxml import etree
+
+from pyschematron.batch import expand_paths
+from pyschematron.commands import validate
+from pyschematron.elements import Schema
+
+from test_util import get_file
+
+
+class TestValidateMany(unittest.TestCase):
+    def setUp(self):
+        self.schema = Schema(get_file("schematron", "basic.sch"))
+        self.paths = [get_file("xml", name) for name in ("basic1_ok.xml", "basic1_error_1.xml", "basic1_error_2.xml",
+                                                         "basic1_warning_3.xml", "basic1_warning_4.xml")]
+
+    def get_expected(self, path):
+        report = self.schema.validate_document(etree.parse(path))
+        errors, warnings = report.get_errors_and_warnings()
+        return path, [test.id for test, element in errors], [test.id for test, element in warnings]
+
+    def test_ordered(self):
+        expected = [self.get_expected(path) for path in self.paths]
+        for workers in (1, 2):
+            results = list(self.schema.validate_many(iter(self.paths * 3), workers=workers))
+            self.assertEqual(expected * 3, [(result.path, [error.id for error in result.errors],
+                                             [warning.id for warning in result.warnings]) for result in results])
+            self.assertEqual([0, -1, -1, 1, 1] * 3, [result.get_result_code() for result in results])
+
+    def test_unordered(self):
+        results = list(self.schema.validate_many(self.paths, workers=2, ordered=False))
+        self.assertEqual(sorted(self.paths), sorted(result.path for result in results))
+
+    def test_messages(self):
+        result = next(self.schema.validate_many([get_file("xml", "basic1_error_1.xml")], workers=1))
+        error = result.errors[0]
+        self.assertEqual(("1", "Data", "Document data must have a name"), (error.id, error.location, error.text))
+
+    def test_unreadable_documents(self):
+        results = list(self.schema.validate_many([get_file("xml", "does_not_exist.xml"), self.paths[0]], workers=2))
+        self.assertIsNotNone(results[0].exception)
+        self.assertEqual([-1, 0], [result.get_result_code() for result in results])
+
+    def test_expand_paths(self):
+        directory = get_file("xml", "diagnostics")
+        files = sorted(os.path.join(directory, name) for name in os.listdir(directory) if name.endswith(".xml"))
+        self.assertEqual(files, list(expand_paths([directory])))
+        self.assertEqual(files, list(expand_paths([os.path.join(directory, "*.xml")])))
+        self.assertEqual(["missing.xml"], list(expand_paths(["missing.xml"])))
+
+    def test_command(self):
+        output_stream = StringIO()
+        result = validate.main_many(get_file("schematron", "basic.sch"), [get_file("xml", "basic1_*.xml")],
+                                    output_stream=output_stream, workers=2)
+        self.assertEqual(-1, result)
+        self.assertTrue(output_stream.getvalue().endswith("5 files validated\n"))
+        result = validate.main_many(get_file("schematron", "basic.sch"), self.paths[3:], output_stream=StringIO(),
+                                    workers=2)
+        self.assertEqual(1, result)
+
+
+if __name__ == '__main__':
+    unittest.main()
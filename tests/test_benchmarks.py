@@ -0,0 +1,103 @@
+import os
+import shutil
+import tempfile
+import unittest
+from io import StringIO
+
+from lxml import etree
+
+from benchmarks import run
+from benchmarks.generators import CAC_NAMESPACE, write_invoice, write_records
+from benchmarks.schemas import SCHEMAS
+
+
+class TestGenerators(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def read(self, path):
+        with open(path, 'rb') as document:
+            return document.read()
+
+    def test_invoice(self):
+        path = os.path.join(self.directory, "invoice.xml")
+        write_invoice(path, 50)
+        xml_doc = etree.parse(path)
+        self.assertEqual(50, len(xml_doc.getroot().findall("{%s}InvoiceLine" % CAC_NAMESPACE)))
+        # The namespaces are only declared on the document element
+        self.assertEqual(3, self.read(path).count(b"xmlns"))
+
+        # The same arguments give the same document
+        other_path = os.path.join(self.directory, "other.xml")
+        write_invoice(other_path, 50)
+        self.assertEqual(self.read(path), self.read(other_path))
+        write_invoice(other_path, 50, seed=1)
+        self.assertNotEqual(self.read(path), self.read(other_path))
+
+    def test_records(self):
+        path = os.path.join(self.directory, "records.xml")
+        write_records(path, 100, error_rate=0)
+        records = etree.parse(path).getroot()
+        self.assertEqual(100, len(records))
+        self.assertEqual(100, len(set(record.get("id") for record in records)))
+
+        write_records(path, 100, error_rate=1)
+        self.assertLess(len(set(record.get("id") for record in etree.parse(path).getroot())), 100)
+
+
+class TestBenchmarkCases(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_cases(self):
+        cases = run.get_cases(["joins"], [10], run.ENGINES, run.BACKENDS)
+        self.assertEqual(["joins/rules/elementpath/10", "joins/rules/lxml/10", "joins/document/elementpath/10",
+                          "joins/document/lxml/10", "joins/xslt/elementpath/10"], [run.get_key(case) for case in cases])
+
+    def test_same_results(self):
+        # Every engine and backend gives the same messages for every benchmark
+        cases = run.get_cases(list(SCHEMAS), [40], run.ENGINES, run.BACKENDS)
+        run.prepare_data(self.directory, cases, error_rate=0.5)
+        results = {run.get_key(case): run.run_case(case, self.directory, repeat=1) for case in cases}
+        self.assertEqual([], run.check_messages(results))
+        for key, metrics in results.items():
+            self.assertGreater(metrics['messages'], 0, key)
+            self.assertGreater(metrics['nodes_per_s'], 0, key)
+
+        output_stream = StringIO()
+        run.write_table(results, {}, output_stream)
+        self.assertEqual(len(cases) + 1, len(output_stream.getvalue().splitlines()))
+
+
+class TestBaselineComparison(unittest.TestCase):
+    BASELINE = {
+        'joins/rules/lxml/1000': {'compile_s': 0.1, 'latency_median_s': 1.0, 'peak_rss_mb': 100},
+        'lets/rules/lxml/1000': {'compile_s': 0.001, 'latency_median_s': 0.001, 'peak_rss_mb': None},
+    }
+
+    def test_regressions(self):
+        results = {
+            'joins/rules/lxml/1000': {'compile_s': 0.1, 'latency_median_s': 1.5, 'peak_rss_mb': 200},
+            # Small differences are noise
+            'lets/rules/lxml/1000': {'compile_s': 0.002, 'latency_median_s': 0.005, 'peak_rss_mb': 50},
+            # Not in the baseline
+            'messages/rules/lxml/1000': {'compile_s': 1, 'latency_median_s': 10, 'peak_rss_mb': 1000},
+        }
+        self.assertEqual([('joins/rules/lxml/1000', 'latency_median_s', 1.0, 1.5),
+                          ('joins/rules/lxml/1000', 'peak_rss_mb', 100, 200)], run.compare(results, self.BASELINE))
+        self.assertEqual([('joins/rules/lxml/1000', 'peak_rss_mb', 100, 200)],
+                         run.compare(results, self.BASELINE, threshold=0.6))
+
+    def test_no_regressions(self):
+        results = {'joins/rules/lxml/1000': {'compile_s': 0.11, 'latency_median_s': 0.5, 'peak_rss_mb': 110}}
+        self.assertEqual([], run.compare(results, self.BASELINE))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -47,6 +47,11 @@ class TestConvertCommand(unittest.TestCase):
         self.run_command("data/schematron/schematron.sch")
         self.run_command("data/schematron/svrl.sch")
 
+    def test_convert_document_uri(self):
+        # The converted stylesheet is not only meant for libxslt, so it keeps document-uri() for xslt
+        self.run_command("data/schematron/bulk.sch")
+        self.assertIn('select="document-uri(/)"', self.output_stream.getvalue())
+
     def test_convert_to_minimal(self):
         self.run_command("data/schematron/advanced_text.sch", output_format='minimal')
         self.run_command("data/schematron/all_elements.sch", output_format='minimal')
@@ -0,0 +1,100 @@
+import unittest
+
+from lxml import etree
+
+from pyschematron.compiler import CompiledSchema
+from pyschematron.elements import Schema
+from pyschematron.exceptions import SchematronError
+
+from test_util import get_file
+
+
+class TestCompiledSchema(unittest.TestCase):
+    def setUp(self):
+        self.schema = Schema(get_file("schematron", "full.sch"))
+
+    def test_compile(self):
+        compiled = self.schema.compile()
+        self.assertIsInstance(compiled, CompiledSchema)
+        self.assertEqual("builtin_and_included", compiled.phase)
+        self.assertEqual(["builtin", "included"], [p.id for p in compiled.patterns])
+        self.assertEqual(["number_minimum"], [v.name for v in compiled.variables])
+
+        compiled = self.schema.compile("included_only")
+        self.assertEqual(["included"], [p.id for p in compiled.patterns])
+        # The abstract pattern has been instantiated with the parameters of the is-a pattern
+        self.assertEqual("Document/Data", compiled.patterns[0].rules[0].context.expression)
+
+        self.assertRaises(SchematronError, self.schema.compile, "unknown_phase")
+
+    def test_abstract_pattern_instances(self):
+        # Every is-a pattern gets its own copy of the tests of the abstract pattern
+        schema = Schema(xml_element=etree.XML('''<schema xmlns="http://purl.oclc.org/dsdl/schematron">
+            <pattern abstract="true" id="field"><rule context="$context"><assert test="$field">Missing</assert></rule></pattern>
+            <pattern is-a="field" id="name"><param name="context" value="item"/><param name="field" value="name"/></pattern>
+            <pattern is-a="field" id="price"><param name="context" value="item"/><param name="field" value="price"/></pattern>
+        </schema>'''))
+        compiled = schema.compile()
+        self.assertEqual(["name", "price"], [p.rules[0].assertions[0].test.expression for p in compiled.patterns])
+        report = schema.validate_document(etree.XML("<items><item><name/></item></items>").getroottree())
+        self.assertEqual(["price"], [test.test for test, _ in report.get_failed_asserts()])
+
+    def test_immutable(self):
+        compiled = self.schema.compile()
+        self.assertRaises(SchematronError, setattr, compiled, "phase", "#ALL")
+        self.assertRaises(SchematronError, setattr, compiled.patterns[0], "rules", ())
+        self.assertRaises(SchematronError, setattr, compiled.patterns[0].rules[0].assertions[0], "test", None)
+
+    def test_validate(self):
+        compiled = self.schema.compile("builtin_only")
+        for filename, expected in [("basic1_ok.xml", 0), ("basic1_error_1.xml", 1)]:
+            xml_doc = etree.parse(get_file("xml", filename))
+            report = self.schema.validate_document(xml_doc, compiled_schema=compiled)
+            self.assertEqual(expected, len(report.get_failed_asserts()))
+            self.assertEqual(expected, len(compiled.validate_document(xml_doc).get_failed_asserts()))
+
+            svrl = self.schema.validate_document_to_svrl(xml_doc, compiled_schema=compiled)
+            self.assertEqual("builtin_only", svrl.phase)
+            self.assertEqual(expected, len(svrl.active_patterns[0].fired_rules[0].reports))
+
+    def test_no_parsing_after_compile(self):
+        compiled = self.schema.compile()
+        misses = self.schema.query_binding.get_cache_statistics()['misses']
+        for filename in ["basic1_ok.xml", "basic1_error_1.xml", "basic1_error_2.xml"]:
+            compiled.validate_document(etree.parse(get_file("xml", filename)))
+        self.assertEqual(misses, self.schema.query_binding.get_cache_statistics()['misses'])
+
+    def test_other_schema(self):
+        compiled = Schema(get_file("schematron", "basic.sch")).compile()
+        xml_doc = etree.parse(get_file("xml", "basic1_ok.xml"))
+        self.assertRaises(SchematronError, self.schema.validate_document, xml_doc, compiled_schema=compiled)
+
+    def test_duplicate_variable(self):
+        schema = Schema(get_file("schematron", "variables/variables1_xslt2_multiple_error.sch"))
+        self.assertRaises(SchematronError, schema.compile)
+
+
+class TestRuleDispatchIndex(unittest.TestCase):
+    def test_candidates(self):
+        schema = Schema(get_file("schematron", "orderchecks/xslt.sch"))
+        pattern = schema.compile().patterns[0]
+        index = pattern.dispatch_index
+        root = etree.XML('<arb><a/><c/><d/><e/></arb>')
+        a, c, d, e = root
+
+        # r5 has a wildcard context, so it is a candidate for every node
+        self.assertEqual(['r1', 'r5'], [r.id for r in index.get_candidate_rules(a)])
+        self.assertEqual(['r3', 'r4', 'r5'], [r.id for r in index.get_candidate_rules(c)])
+        self.assertEqual(['r4', 'r5'], [r.id for r in index.get_candidate_rules(d)])
+        self.assertEqual(['r5'], [r.id for r in index.get_candidate_rules(e)])
+        self.assertEqual(['r5'], [r.id for r in index.get_candidate_rules(None)])
+
+    def test_namespaces(self):
+        schema = Schema(get_file("schematron", "diagnostics.sch"))
+        pattern = schema.compile().patterns[0]
+        keys = set(pattern.dispatch_index.candidates)
+        self.assertIn(('element', '{http://www.schematron.info/arche}animal'), keys)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,177 @@
+import unittest
+
+from lxml import etree
+
+from pyschematron.elements import Schema
+from pyschematron.engines import DEFAULT_ENGINE, get_engine
+from pyschematron.engines.xslt import get_stylesheet
+from pyschematron.exceptions import SchematronError, SchematronNotImplementedError
+from pyschematron.svrl import SchematronOutput
+
+from test_util import get_file
+
+ENGINES = ['rules', 'document']
+
+
+class TestEngines(unittest.TestCase):
+    def get_results(self, schema, xml_doc, engine, phase="#DEFAULT"):
+        report = schema.validate_document(xml_doc, phase=phase, engine=engine)
+        svrl = schema.validate_document_to_svrl(xml_doc, phase=phase, engine=engine)
+        failed_asserts = [(fa.id, xml_doc.getelementpath(element)) for fa, element in report.get_failed_asserts()]
+        return failed_asserts, etree.tostring(svrl.to_xml())
+
+    def check_same_results(self, schema_file, xml_files, phase="#DEFAULT"):
+        schema = Schema(get_file("schematron", schema_file))
+        for xml_file in xml_files:
+            xml_doc = etree.parse(get_file("xml", xml_file))
+            expected = self.get_results(schema, xml_doc, ENGINES[0], phase)
+            for engine in ENGINES[1:]:
+                self.assertEqual(expected, self.get_results(schema, xml_doc, engine, phase),
+                                 "Engine %s differs for %s/%s" % (engine, schema_file, xml_file))
+
+    def test_same_results(self):
+        xml_files = ["basic1_ok.xml", "basic1_error_1.xml", "basic1_error_2.xml",
+                     "basic1_warning_3.xml", "basic1_warning_4.xml"]
+        self.check_same_results("basic.sch", xml_files)
+        self.check_same_results("full.sch", xml_files)
+        self.check_same_results("full.sch", xml_files, phase="included_only")
+        self.check_same_results("diagnostics.sch", ["diagnostics/more_than_three_animals.xml",
+                                                    "diagnostics/only_one_animal.xml"])
+        self.check_same_results("variables/variables1_xslt2.sch", ["variables/variables1_correct.xml"])
+        self.check_same_results("keys.sch", ["keys.xml"])
+        self.check_same_results("keys_xslt2.sch", ["keys.xml"])
+        self.check_same_results("joins.sch", ["keys.xml"])
+
+    def test_first_match(self):
+        schema = Schema(get_file("schematron", "orderchecks/xslt.sch"))
+        xml_doc = etree.ElementTree(etree.XML('<arb id="a"><a>2</a><b>2</b><c>2</c><d>2</d><e id="1">2</e></arb>'))
+        for engine in ENGINES:
+            report = schema.validate_document(xml_doc, engine=engine)
+            self.assertEqual(['r1', 'r2', 'r3', 'r4'], [fa.parent.id for fa, element in report.get_failed_asserts()])
+
+    def test_unknown_engine(self):
+        self.assertRaises(SchematronError, get_engine, "unknown")
+        schema = Schema(get_file("schematron", "basic.sch"))
+        xml_doc = etree.parse(get_file("xml", "basic1_ok.xml"))
+        self.assertRaises(SchematronError, schema.validate_document, xml_doc, engine="unknown")
+
+    def test_non_element_contexts(self):
+        # Rules can only fire on elements and the document node; other contexts are rejected
+        # instead of silently never firing
+        xml_doc = etree.ElementTree(etree.XML('<items><item id="a">text</item><item/></items>'))
+        for context in ['@id', 'item/@id', 'item/text()', 'item | @id', 'node()', 'attribute::id']:
+            for backend in ['elementpath', 'lxml']:
+                schema = Schema(xml_element=etree.XML(
+                    '<schema xmlns="http://purl.oclc.org/dsdl/schematron" queryBinding="xslt"><pattern>'
+                    '<rule context="%s"><assert test="false()">Fired</assert></rule></pattern></schema>' % context),
+                    backend=backend)
+                for engine in ENGINES + ['xslt']:
+                    self.assertRaises(SchematronNotImplementedError, schema.validate_document, xml_doc, engine=engine)
+
+        # Also for the default engine
+        self.assertEqual('rules', DEFAULT_ENGINE)
+        schema = Schema(xml_element=etree.XML(
+            '<schema xmlns="http://purl.oclc.org/dsdl/schematron" queryBinding="xslt"><pattern>'
+            '<rule context="@id"><assert test="false()">Fired</assert></rule></pattern></schema>'))
+        self.assertRaises(SchematronNotImplementedError, schema.validate_document, xml_doc)
+
+        # Attributes and text in predicates are fine
+        for context in ['item[@id]', '*[text()]']:
+            schema = Schema(xml_element=etree.XML(
+                '<schema xmlns="http://purl.oclc.org/dsdl/schematron" queryBinding="xslt"><pattern>'
+                '<rule context="%s"><assert test="false()" id="fired">Fired</assert></rule></pattern></schema>' % context))
+            for engine in ENGINES + ['xslt']:
+                self.assertEqual([('fired', 'item[1]')], self.get_results(schema, xml_doc, engine)[0])
+
+
+class TestBulkEvaluation(unittest.TestCase):
+    XML = '<order><line id="1" amount="5"/><line id="2" amount="11"/><line id="1" amount="0"/><line amount="3"/></order>'
+
+    def test_bulk_tests(self):
+        schema = Schema(get_file("schematron", "bulk.sch"))
+        xml_doc = etree.ElementTree(etree.XML(self.XML))
+        for engine in ENGINES:
+            report = schema.validate_document(xml_doc, engine=engine)
+            self.assertEqual(['a_bulk', 'r_bulk'], sorted(test.id for test in report.bulk_tests))
+            self.assertEqual([('a_current', '/order/line[1]'),
+                              ('a_bulk', '/order/line[2]'),
+                              ('a_let', '/order/line[3]'),
+                              ('r_bulk', '/order/line[3]'),
+                              ('a_value_of', '/order/line[4]')],
+                             [(test.id, xml_doc.getpath(element)) for test, element in report.get_failed_asserts()])
+
+    def test_compiled_bulk_tests(self):
+        schema = Schema(get_file("schematron", "bulk.sch"))
+        rule = schema.compile().patterns[0].rules[0]
+        self.assertEqual(['a_bulk'], [test.source.id for test in rule.assertions if test.bulk_test is not None])
+        self.assertEqual(['r_bulk'], [test.source.id for test in rule.reports if test.bulk_test is not None])
+
+
+class TestXSLTEngine(unittest.TestCase):
+    get_results = TestEngines.get_results
+
+    def check_same_results(self, schema_file, xml_files, phase="#DEFAULT"):
+        schema = Schema(get_file("schematron", schema_file))
+        for xml_file in xml_files:
+            xml_doc = etree.parse(get_file("xml", xml_file))
+            self.assertEqual(self.get_results(schema, xml_doc, 'document', phase),
+                             self.get_results(schema, xml_doc, 'xslt', phase),
+                             "Engine xslt differs for %s/%s" % (schema_file, xml_file))
+
+    def test_same_results(self):
+        xml_files = ["basic1_ok.xml", "basic1_error_1.xml", "diagnostics/more_than_three_animals.xml",
+                     "diagnostics/only_one_animal.xml"]
+        self.check_same_results("diagnostics.sch", xml_files)
+        self.check_same_results("all_elements.sch", xml_files)
+        self.check_same_results("name_element.sch", xml_files)
+        self.check_same_results("bulk.sch", xml_files)
+        self.check_same_results("keys.sch", ["keys.xml"])
+        self.check_same_results("joins.sch", ["keys.xml"])
+
+    def test_first_match(self):
+        schema = Schema(get_file("schematron", "orderchecks/xslt.sch"))
+        xml_doc = etree.ElementTree(etree.XML('<arb id="a"><a>2</a><b>2</b><c>2</c><d>2</d><e id="1">2</e></arb>'))
+        report = schema.validate_document(xml_doc, engine='xslt')
+        self.assertEqual(['r1', 'r2', 'r3', 'r4'], [fa.parent.id for fa, element in report.get_failed_asserts()])
+
+    def test_pattern_variables(self):
+        # Pattern variables are evaluated for the document node, and every pattern has its own, even
+        # if another pattern or a rule uses the same name
+        schema = Schema(xml_element=etree.XML('''<schema xmlns="http://purl.oclc.org/dsdl/schematron" queryBinding="xslt">
+            <pattern id="count"><let name="limit" value="count(//item)"/>
+                <rule context="item"><assert test="@n &lt; $limit" id="count">Too large</assert></rule></pattern>
+            <pattern id="constant"><let name="limit" value="3"/>
+                <rule context="group"><let name="limit" value="$limit - 1"/>
+                    <assert test="count(item) &lt; $limit" id="group">Too many items</assert></rule>
+                <rule context="item"><assert test="@n &lt; $limit" id="constant">Too large</assert></rule></pattern>
+        </schema>'''))
+        xml_doc = etree.ElementTree(etree.XML('<items><group><item n="1"/><item n="2"/></group><item n="3"/></items>'))
+        results = self.get_results(schema, xml_doc, 'xslt')
+        self.assertEqual(self.get_results(schema, xml_doc, 'document'), results)
+        self.assertEqual([('count', 'item'), ('group', 'group'), ('constant', 'item')], results[0])
+
+    def test_svrl_output(self):
+        schema = Schema(get_file("schematron", "bulk.sch"))
+        compiled_schema = schema.compile()
+        xml_doc = etree.ElementTree(etree.XML(TestBulkEvaluation.XML))
+        svrl, elements = get_engine('xslt').get_svrl(compiled_schema, xml_doc)
+        self.assertIsInstance(svrl, SchematronOutput)
+        reports = [report for fired_rule in svrl.active_patterns[0].fired_rules for report in fired_rule.reports]
+        self.assertEqual(['a_current', 'a_bulk', 'r_bulk', 'a_let', 'a_value_of'], [report.id for report in reports])
+        self.assertEqual("Line 3 must have an id", reports[-1].text.text)
+        self.assertIs(xml_doc.getroot()[3], elements[reports[-1].location])
+
+    def test_stylesheet_cache(self):
+        schema = Schema(get_file("schematron", "bulk.sch"))
+        stylesheet = get_stylesheet(schema, schema.compile().phase)
+        self.assertIs(stylesheet, get_stylesheet(schema, schema.compile().phase))
+        self.assertIsNot(stylesheet, get_stylesheet(Schema(get_file("schematron", "bulk.sch")), schema.compile().phase))
+
+    def test_unsupported_query_binding(self):
+        schema = Schema(get_file("schematron", "basic.sch"))
+        xml_doc = etree.parse(get_file("xml", "basic1_ok.xml"))
+        self.assertRaises(SchematronNotImplementedError, schema.validate_document, xml_doc, engine='xslt')
+
+
+if __name__ == '__main__':
+    unittest.main()
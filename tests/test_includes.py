@@ -0,0 +1,126 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from lxml import etree
+
+from pyschematron.elements import Schema
+from pyschematron.util import INCLUDE_CACHE, resolve_href
+
+from test_util import get_file
+
+SCHEMA = """<schema xmlns="http://purl.oclc.org/dsdl/schematron">
+    <include href="modules/core.sch"/>
+    <pattern id="country">
+        <rule context="Document">
+            <assert test="Country">Country is missing</assert>
+        </rule>
+    </pattern>
+</schema>
+"""
+
+# Includes its rule relative to its own directory
+CORE_MODULE = """<pattern xmlns="http://purl.oclc.org/dsdl/schematron" id="core">
+    <include href="rules/core_rule.sch"/>
+</pattern>
+"""
+
+CORE_RULE = """<rule xmlns="http://purl.oclc.org/dsdl/schematron" context="Document">
+    <assert test="%s">Data is missing</assert>
+</rule>
+"""
+
+
+class TestResolveHref(unittest.TestCase):
+    def test_relative(self):
+        self.assertEqual(os.path.abspath("/data/schemas/modules/core.sch"),
+                         resolve_href("modules/core.sch", "/data/schemas/main.sch"))
+        self.assertEqual(os.path.abspath("/data/core.sch"), resolve_href("../core.sch", "/data/schemas/main.sch"))
+
+    def test_absolute(self):
+        self.assertEqual(os.path.abspath("/other/core.sch"), resolve_href("/other/core.sch", "/data/schemas/main.sch"))
+
+    def test_file_url(self):
+        self.assertEqual(os.path.abspath("/data/schemas/core.sch"), resolve_href("core.sch", "file:///data/schemas/main.sch"))
+
+    def test_url(self):
+        self.assertEqual("http://example.com/schemas/core.sch", resolve_href("core.sch", "http://example.com/schemas/main.sch"))
+
+    def test_no_base(self):
+        self.assertEqual(os.path.abspath("core.sch"), resolve_href("core.sch", None))
+
+
+class TestIncludes(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.directory, "modules", "rules"))
+        self.core_rule = os.path.join(self.directory, "modules", "rules", "core_rule.sch")
+        self.write(os.path.join(self.directory, "modules", "core.sch"), CORE_MODULE)
+        self.write(self.core_rule, CORE_RULE % "Data")
+        self.schema_files = []
+        for country in ("nl", "be", "de"):
+            self.schema_files.append(os.path.join(self.directory, "%s.sch" % country))
+            self.write(self.schema_files[-1], SCHEMA)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, path, content):
+        with open(path, 'w') as output:
+            output.write(content)
+
+    def test_nested_includes(self):
+        # Relative to the directory of the including file, not to the current directory
+        with mock.patch.object(os, 'chdir', side_effect=AssertionError("chdir called")):
+            schema = Schema(self.schema_files[0])
+        self.assertEqual(["core", "country"], sorted(schema.patterns))
+        self.assertEqual("Document", schema.patterns["core"].rules[0].context)
+        self.assertEqual([os.path.join(self.directory, "modules", "core.sch"), self.core_rule], schema.included_files)
+
+    def test_relative_schema_path(self):
+        current_directory = os.getcwd()
+        os.chdir(os.path.dirname(self.directory))
+        try:
+            schema = Schema(os.path.join(os.path.basename(self.directory), "nl.sch"))
+        finally:
+            os.chdir(current_directory)
+        self.assertEqual([os.path.join(self.directory, "modules", "core.sch"), self.core_rule], schema.included_files)
+
+    def test_shared_modules(self):
+        parse_count = INCLUDE_CACHE.parse_count
+        schemas = [Schema(schema_file) for schema_file in self.schema_files]
+        # core.sch and core_rule.sch, once for all schemas
+        self.assertEqual(parse_count + 2, INCLUDE_CACHE.parse_count)
+        self.assertEqual(1, len(set(schema.patterns["core"].rules[0].assertions[0].test for schema in schemas)))
+
+    def test_changed_module(self):
+        self.assertEqual("Data", Schema(self.schema_files[0]).patterns["core"].rules[0].assertions[0].test)
+        # Make sure that the modification time changes
+        time.sleep(0.01)
+        self.write(self.core_rule, CORE_RULE % "Data/Name")
+        self.assertEqual("Data/Name", Schema(self.schema_files[0]).patterns["core"].rules[0].assertions[0].test)
+
+    def test_concurrent_loading(self):
+        INCLUDE_CACHE.clear()
+        parse_count = INCLUDE_CACHE.parse_count
+        schema_files = self.schema_files * 4 + [get_file("schematron", "full.sch")] * 4
+        results = [None] * len(schema_files)
+        barrier = threading.Barrier(len(schema_files))
+
+        def load(position):
+            barrier.wait()
+            results[position] = etree.tostring(Schema(schema_files[position]).to_minimal_xml())
+
+        threads = [threading.Thread(target=load, args=(position,)) for position in range(len(schema_files))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for schema_file, result in zip(schema_files, results):
+            self.assertEqual(etree.tostring(Schema(schema_file).to_minimal_xml()), result)
+        # The two modules of the country schemas and the two includes of full.sch
+        self.assertEqual(parse_count + 4, INCLUDE_CACHE.parse_count)
@@ -0,0 +1,45 @@
+import unittest
+
+from lxml import etree
+
+from pyschematron.elements import Schema
+from pyschematron.parallel import RecordingReport, replay, get_nodes
+from pyschematron.validation import ValidationReport
+
+from test_util import get_file
+
+
+class TestParallelPatterns(unittest.TestCase):
+    def setUp(self):
+        self.schema = Schema(get_file("schematron", "streaming.sch"))
+        self.xml_doc = etree.parse(get_file("xml", "streaming.xml"))
+
+    def get_results(self, report):
+        return [(test.id, self.xml_doc.getelementpath(element)) for test, element in report.get_failed_asserts()]
+
+    def test_same_report(self):
+        expected = self.get_results(self.schema.validate_document(self.xml_doc))
+        for engine in ('rules', 'document'):
+            report = self.schema.validate_document(self.xml_doc, engine=engine, workers=2)
+            self.assertEqual(expected, self.get_results(report))
+
+    def test_same_svrl(self):
+        expected = etree.tostring(self.schema.validate_document_to_svrl(self.xml_doc).to_xml())
+        svrl = self.schema.validate_document_to_svrl(self.xml_doc, workers=3)
+        self.assertEqual(expected, etree.tostring(svrl.to_xml()))
+
+    def test_replay(self):
+        compiled = self.schema.compile()
+        nodes = get_nodes(self.xml_doc)
+        recording = RecordingReport(compiled, {node: position for position, node in enumerate(nodes)})
+        self.schema._run_engine(compiled, self.xml_doc, recording, None, None)
+        # The calls hold positions only, so that they can be passed between processes
+        self.assertEqual(('add_active_pattern', 0), recording.calls[0])
+        self.assertIn(('add_failed_assert', (3, 1), ('assertions', 0), 2), recording.calls)
+        report = ValidationReport()
+        replay(recording.calls, compiled, nodes, report)
+        self.assertEqual(self.get_results(compiled.validate_document(self.xml_doc)), self.get_results(report))
+
+
+if __name__ == '__main__':
+    unittest.main()
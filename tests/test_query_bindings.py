@@ -0,0 +1,429 @@
+import threading
+import unittest
+
+from lxml import etree
+
+from pyschematron.elements import Schema
+from pyschematron.elementpath_extensions.context import DocumentIndex
+from pyschematron.engines import get_engine
+from pyschematron.exceptions import SchematronError
+from pyschematron.query_bindings import ExpressionCache, document_order
+from pyschematron.query_bindings import xslt, xslt2, xpath2, xslt_lxml
+from pyschematron.query_bindings.joins import JoinIndex
+from pyschematron.query_bindings.hoisting import HoistedExpression
+from pyschematron.query_bindings.analysis import to_source
+from pyschematron.validation import ValidationReport
+
+from test_util import get_file
+
+
+class TestExpressionCache(unittest.TestCase):
+    def test_hits_and_misses(self):
+        cache = ExpressionCache(4)
+        self.assertEqual("a", cache.get(1, lambda: "a"))
+        self.assertEqual("a", cache.get(1, lambda: "b"))
+        stats = cache.get_statistics()
+        self.assertEqual(1, stats['hits'])
+        self.assertEqual(1, stats['misses'])
+        self.assertEqual(0, stats['evictions'])
+
+    def test_lru_eviction(self):
+        cache = ExpressionCache(2)
+        cache.get(1, lambda: "1")
+        cache.get(2, lambda: "2")
+        # Touch 1, so that 2 is the least recently used entry
+        cache.get(1, lambda: "x")
+        cache.get(3, lambda: "3")
+        self.assertEqual(2, len(cache))
+        self.assertEqual(1, cache.evictions)
+        self.assertEqual("1", cache.get(1, lambda: "x"))
+        self.assertEqual("new", cache.get(2, lambda: "new"))
+
+    def test_bad_size(self):
+        self.assertRaises(SchematronError, ExpressionCache, 0)
+
+    def test_key(self):
+        key_a = ExpressionCache.make_key(object, "$a", {'x': 'urn:x'}, {'a': 1})
+        key_b = ExpressionCache.make_key(object, "$a", {'x': 'urn:x'}, {'a': 2})
+        key_c = ExpressionCache.make_key(object, "$a", {'x': 'urn:y'}, {'a': 1})
+        self.assertEqual(key_a, key_b)
+        self.assertNotEqual(key_a, key_c)
+
+    def test_threads(self):
+        cache = ExpressionCache(8)
+
+        def worker():
+            for i in range(1000):
+                cache.get(i % 16, lambda: i)
+
+        threads = [threading.Thread(target=worker) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stats = cache.get_statistics()
+        self.assertEqual(4000, stats['hits'] + stats['misses'])
+        self.assertEqual(8, stats['size'])
+
+
+class TestQueryBindingCache(unittest.TestCase):
+    def setUp(self):
+        self.xml_doc = etree.ElementTree(etree.XML("<doc><a>1</a><a>2</a><a>3</a></doc>"))
+
+    def check_binding(self, binding):
+        for element in self.xml_doc.getroot():
+            binding.evaluate_assertion(self.xml_doc, element, {}, {'min': 0}, ". > $min")
+        stats = binding.get_cache_statistics()
+        self.assertEqual(1, stats['misses'])
+        self.assertEqual(2, stats['hits'])
+
+        # The variable values are not part of the cached expression
+        element = self.xml_doc.getroot()[0]
+        self.assertTrue(binding.evaluate_assertion(self.xml_doc, element, {}, {'min': 0}, ". > $min"))
+        self.assertFalse(binding.evaluate_assertion(self.xml_doc, element, {}, {'min': 5}, ". > $min"))
+
+    def test_xslt(self):
+        self.check_binding(xslt.instantiate())
+
+    def test_xpath2(self):
+        self.check_binding(xpath2.instantiate())
+
+    def test_schema_validation(self):
+        schema = Schema(get_file("schematron", "basic.sch"))
+        xml_doc = etree.parse(get_file("xml", "basic1_ok.xml"))
+        schema.validate_document(xml_doc)
+        misses = schema.query_binding.get_cache_statistics()['misses']
+        schema.validate_document(xml_doc)
+        self.assertEqual(misses, schema.query_binding.get_cache_statistics()['misses'])
+
+
+class TestMatchPatterns(unittest.TestCase):
+    XML = '<root xmlns:n="urn:n"><a x="1"><b/><b x="2"/><c><b/></c></a><n:a><b/></n:a><b/><d><a><c/></a></d></root>'
+
+    def setUp(self):
+        self.xml_doc = etree.ElementTree(etree.XML(self.XML))
+        self.binding = xslt.XSLTBinding()
+        self.namespaces = {'n': 'urn:n'}
+
+    def get_paths(self, context, variables=None):
+        if variables is None:
+            variables = {}
+        expression = self.binding.compile_rule_context(context, self.namespaces, variables)
+        self.assertIsNotNone(expression.get_match_pattern(), context)
+        return [self.xml_doc.getpath(el) for el in self.binding.select_context_elements(self.xml_doc, expression, variables)]
+
+    def get_expression_paths(self, context):
+        """The result of evaluating the context relative to every element, as was done before patterns"""
+        expression = self.binding.compile_rule_context(context, self.namespaces, {})
+        result = expression.get_results(self.xml_doc)
+        for el in self.xml_doc.iter():
+            result.extend(expression.get_results(el))
+        return [self.xml_doc.getpath(el) for el in document_order(self.xml_doc, result)]
+
+    def test_same_as_expression(self):
+        for context in ["a", "b", "*", "a/b", "a//b", "//b", "root/a", "n:a/b", "n:*", "a | c", "c/b | n:a/b",
+                        "a[@x]/b", "b[@x='2']", "a/*/b", "child::b"]:
+            self.assertEqual(self.get_expression_paths(context), self.get_paths(context), context)
+
+    def test_match_from_right_to_left(self):
+        self.assertEqual(['/root/a/c/b'], self.get_paths("a//c/b"))
+        self.assertEqual(['/root/a/b[1]', '/root/a/b[2]', '/root/a/c/b'], self.get_paths("a//b"))
+        self.assertEqual(['/root/d/a/c'], self.get_paths("d//c"))
+
+    def test_positional_predicates(self):
+        self.assertEqual(['/root/a/b[1]', '/root/a/c/b', '/root/n:a/b', '/root/b'], self.get_paths("b[1]"))
+        self.assertEqual(['/root/a/b[2]'], self.get_paths("b[2]"))
+        self.assertEqual(['/root/a/b[2]'], self.get_paths("b[position() = last()][@x]"))
+        self.assertEqual([], self.get_paths("b[@x][2]"))
+        self.assertEqual(['/root/a/b[2]'], self.get_paths("b[@x][1]"))
+
+    def test_variables_and_current(self):
+        self.assertEqual(['/root/a/b[2]'], self.get_paths("b[@x = $value]", {'value': '2'}))
+        self.assertEqual(['/root/a'], self.get_paths("a[current()/@x = 1]"))
+
+    def test_absolute_patterns(self):
+        expression = self.binding.compile_rule_context("/root/a", self.namespaces, {})
+        matcher = self.binding.create_context_matcher(self.xml_doc, expression, {})
+        self.assertEqual(['/root/a'], [self.xml_doc.getpath(el) for el in self.xml_doc.iter() if matcher(el)])
+
+    def test_unsupported(self):
+        for context in ["@x", "text()", "a/@x", "a/..", "descendant::a", "(a)"]:
+            expression = self.binding.compile_rule_context(context, self.namespaces, {})
+            self.assertIsNone(expression.get_match_pattern(), context)
+
+
+class TestDocumentIndex(unittest.TestCase):
+    XML = '<root><a><b id="1"/><!-- c --><b id="2"/><c><b id="3"/></c></a><d/><b id="4"/></root>'
+
+    def setUp(self):
+        self.xml_doc = etree.ElementTree(etree.XML(self.XML))
+        self.index = DocumentIndex(self.xml_doc)
+        self.binding = xslt.XSLTBinding()
+
+    def test_structure(self):
+        root = self.xml_doc.getroot()
+        a = root[0]
+        b2 = a[2]
+        self.assertIsNone(self.index.get_parent(root))
+        self.assertIs(a, self.index.get_parent(b2))
+        self.assertEqual(2, self.index.get_position(b2))
+        self.assertEqual([0, 1, 2, 3], [self.index.get_order(el) for el in (root, a, a[0], a[1])])
+        self.assertIsNone(self.index.get_order(etree.Element("other")))
+
+    def test_same_results(self):
+        expressions = ["..", "ancestor::*", "ancestor-or-self::*", "preceding-sibling::*", "following-sibling::*",
+                       "preceding-sibling::*[1]", "following-sibling::*[last()]", "../..", "preceding::b",
+                       "//b | //d", "(//d | //a)[1]", "count(ancestor::*)", "../b[2]/@id"]
+        for expression in expressions:
+            compiled = self.binding.compile_assertion(expression, {}, {})
+            for element in self.xml_doc.iter():
+                self.assertEqual(compiled.get_results(self.xml_doc, element),
+                                 compiled.get_results(self.xml_doc, element, document_index=self.index), expression)
+
+    def test_other_document(self):
+        # An index of another document must not be used
+        other_doc = etree.ElementTree(etree.XML(self.XML))
+        compiled = self.binding.compile_assertion("..", {}, {})
+        element = other_doc.getroot()[0][0]
+        self.assertEqual([other_doc.getroot()[0]], compiled.get_results(other_doc, element, document_index=self.index))
+
+    def test_shared_by_validation(self):
+        schema = Schema(get_file("schematron", "full.sch"))
+        xml_doc = etree.parse(get_file("xml", "basic1_ok.xml"))
+        compiled = schema.compile()
+        index = DocumentIndex(xml_doc)
+        report = ValidationReport()
+        get_engine().validate(compiled, xml_doc, report, index)
+        self.assertEqual(0, len(report.get_failed_asserts()))
+
+
+class TestLxmlBinding(unittest.TestCase):
+    def setUp(self):
+        self.binding = xslt_lxml.XSLTLxmlBinding()
+        self.xml_doc = etree.ElementTree(etree.XML('<root><a x="1"><b x="1"/><b x="2"/></a></root>'))
+
+    def test_current(self):
+        compiled = self.binding.compile_assertion("count(../b[@x = current()/@x])", {}, {})
+        b1, b2 = self.xml_doc.getroot()[0]
+        self.assertEqual(1, compiled.evaluate(self.xml_doc, b1))
+        self.assertEqual(1, compiled.evaluate(self.xml_doc, b2))
+        self.assertRaises(SchematronError, self.binding.compile_assertion("current()", {}, {}).evaluate, self.xml_doc, None)
+
+    def test_variables(self):
+        let = self.binding.compile_let_statement("//b/@x", {}, {})
+        value = let.evaluate(self.xml_doc, None, {})
+        compiled = self.binding.compile_assertion("$v = '2' and count($v) = 2", {}, ['v'])
+        self.assertTrue(compiled.evaluate(self.xml_doc, None, {'v': value}))
+
+    def test_attribute_variables(self):
+        # Lets with attribute or text nodes keep them, for the same results as the other backend and
+        # the xslt engine
+        schema_xml = etree.XML('''<schema xmlns="http://purl.oclc.org/dsdl/schematron" queryBinding="xslt">
+            <pattern><rule context="item"><let name="a" value="@code"/><let name="t" value="text()"/>
+                <let name="n" value="count($a | ../item/@code)"/>
+                <assert test="name($a) = 'code'" id="name">Name</assert>
+                <assert test="$a = 'c' and $t = 'x' and $n = 2" id="value">Value <value-of select="$a"/></assert>
+            </rule></pattern></schema>''')
+        xml_doc = etree.ElementTree(etree.XML('<items><item code="c">x</item><item code="d">y</item></items>'))
+        results = []
+        for backend, engine in [('elementpath', 'rules'), ('lxml', 'rules'), ('lxml', 'document'),
+                                ('elementpath', 'xslt')]:
+            report = Schema(xml_element=schema_xml, backend=backend).validate_document(xml_doc, engine=engine)
+            results.append([(test.id, xml_doc.getpath(element)) for test, element in report.get_failed_asserts()])
+        self.assertEqual([[('value', '/items/item[2]')]] * 4, results)
+
+        let = self.binding.compile_let_statement("//b/@x", {}, {})
+        value = let.evaluate(self.xml_doc, None, {})
+        self.assertIsInstance(value, xslt_lxml.ElementpathValue)
+        self.assertEqual("x", self.binding.compile_assertion("name($v[1])", {}, ['v']).evaluate(self.xml_doc, None, {'v': value}))
+        # Lets with only elements are kept as lxml results
+        self.assertNotIsInstance(self.binding.compile_let_statement("//b", {}, {}).evaluate(self.xml_doc, None, {}),
+                                 xslt_lxml.ElementpathValue)
+
+    def test_context_selection(self):
+        for context in ["b", "a/b", "b[@x = 2] | a", "root//b[1]", "/root/a", "b[current()/@x = 1]"]:
+            compiled = self.binding.compile_rule_context(context, {}, {})
+            expected = xslt.XSLTBinding().get_context_elements(self.xml_doc, context, {}, {})
+            self.assertEqual(expected, self.binding.select_context_elements(self.xml_doc, compiled, {}), context)
+
+        # Only a call to current() needs the node by node match, not an element with that name
+        for context in ["currentAccount", "a/currentAccount[@x]", "b[current()/@x = 1]"]:
+            compiled = self.binding.compile_rule_context(context, {}, {})
+            self.assertEqual("current(" not in context, isinstance(compiled, xslt_lxml.LxmlCompiledContext), context)
+
+    def test_split_union(self):
+        self.assertEqual(["a", "b[@x = '|']", "c[d | e]"], xslt_lxml.split_union("a | b[@x = '|'] |c[d | e]"))
+
+    def test_same_results(self):
+        xml_files = ["diagnostics/more_than_three_animals.xml", "diagnostics/only_one_animal.xml", "basic1_ok.xml"]
+        for schema_file in ["all_elements.sch", "diagnostics.sch", "name_element.sch", "orderchecks/xslt.sch"]:
+            elementpath_schema = Schema(get_file("schematron", schema_file))
+            lxml_schema = Schema(get_file("schematron", schema_file), backend="lxml")
+            self.assertIsInstance(lxml_schema.query_binding, xslt_lxml.XSLTLxmlBinding)
+            for xml_file in xml_files:
+                xml_doc = etree.parse(get_file("xml", xml_file))
+                self.assertEqual(etree.tostring(elementpath_schema.validate_document_to_svrl(xml_doc).to_xml()),
+                                 etree.tostring(lxml_schema.validate_document_to_svrl(xml_doc).to_xml()))
+
+    def test_backends(self):
+        # Query bindings that are not implemented by lxml use elementpath
+        schema = Schema(get_file("schematron", "basic.sch"), backend="lxml")
+        self.assertIsInstance(schema.query_binding, xslt2.XSLT2Binding)
+        self.assertRaises(SchematronError, Schema, get_file("schematron", "basic.sch"), backend="unknown")
+
+
+class TestKeys(unittest.TestCase):
+    def setUp(self):
+        self.xml_doc = etree.parse(get_file("xml", "keys.xml"))
+
+    def get_index(self, backend):
+        schema = Schema(get_file("schematron", "keys.sch"), backend=backend)
+        compiled = schema.compile()
+        return schema.query_binding, DocumentIndex(self.xml_doc, compiled.keys)
+
+    def test_key(self):
+        parties = self.xml_doc.getroot().findall("party")
+        orders = self.xml_doc.getroot().findall("order")
+        for backend in ('elementpath', 'lxml'):
+            binding, index = self.get_index(backend)
+            compiled = binding.compile_assertion("key('party', @party)", {}, [])
+            self.assertEqual([parties[1], parties[2]], compiled.evaluate(self.xml_doc, orders[1], document_index=index))
+            self.assertEqual([], compiled.evaluate(self.xml_doc, orders[2], document_index=index))
+            # A node-set argument looks up every value, the result is in document order
+            compiled = binding.compile_assertion("key('party', //order/@party | //party/@id)", {}, [])
+            self.assertEqual(parties, compiled.evaluate(self.xml_doc, document_index=index))
+
+    def test_key_names(self):
+        # key is only a function when it is called, otherwise it is an element or attribute name
+        xml_doc = etree.ElementTree(etree.XML('<items><item key="a"><key>a</key></item><item key="b"/></items>'))
+        for query_binding in ('xslt', 'xslt2'):
+            schema_xml = etree.XML('''<schema xmlns="http://purl.oclc.org/dsdl/schematron" queryBinding="%s">
+                <pattern><rule context="item[key]">
+                    <assert test="@key = key" id="same">The key attribute and element must be the same</assert>
+                    <assert test="count(key) = 2" id="count">Two keys</assert>
+                </rule><rule context="item/key"><assert test="false()" id="element">Not reached</assert></rule>
+                <rule context="item"><assert test="key" id="missing">No key element</assert></rule></pattern>
+            </schema>''' % query_binding)
+            for backend in ('elementpath', 'lxml'):
+                report = Schema(xml_element=schema_xml, backend=backend).validate_document(xml_doc)
+                self.assertEqual([('count', '/items/item[1]'), ('element', '/items/item[1]/key'),
+                                  ('missing', '/items/item[2]')],
+                                 [(test.id, xml_doc.getpath(element)) for test, element in report.get_failed_asserts()],
+                                 "%s/%s" % (query_binding, backend))
+
+    def test_index_is_lazy(self):
+        binding, index = self.get_index('elementpath')
+        compiled = binding.compile_assertion("key('party', 'p1')", {}, [])
+        compiled.evaluate(self.xml_doc, document_index=index)
+        self.assertEqual(['party'], list(index._key_indexes))
+
+    def test_unknown_key(self):
+        for backend in ('elementpath', 'lxml'):
+            binding, index = self.get_index(backend)
+            compiled = binding.compile_assertion("key('unknown', 'p1')", {}, [])
+            self.assertRaises(SchematronError, compiled.evaluate, self.xml_doc, document_index=index)
+            self.assertRaises(SchematronError, compiled.evaluate, self.xml_doc)
+
+
+class TestJoins(unittest.TestCase):
+    XML = '<r><a n="1.0" m="x"/><a n="1" m="y"/><a n="2"/><b n="1"/></r>'
+
+    def setUp(self):
+        self.binding = xslt.instantiate()
+        self.xml_doc = etree.ElementTree(etree.XML(self.XML))
+        self.VARIABLES = {'number': 1, 'string': '1', 'nodes': [self.xml_doc.getroot()[3]], 'boolean': True}
+
+    def get_joins(self, expression):
+        return [join.describe() for join in self.binding.compile_assertion(expression, {}, []).rewrites
+                if isinstance(join, JoinIndex)]
+
+    def test_rewrites(self):
+        self.assertEqual(["//a[@n = current()/@n]: index //a by @n, look up current()/@n"],
+                         self.get_joins("count(//a[@n = current()/@n]) = 1"))
+        self.assertEqual(["/r/a[$v = @n]: index /r/a by @n, look up $v"], self.get_joins("/r/a[$v = @n]"))
+        # The value is a join itself
+        self.assertEqual(2, len(self.get_joins("//a[@n = /r/b[@n = $v]/@n]")))
+        # Not absolute, not an equality, the value depends on the node that is filtered, or
+        # it is a constant
+        for expression in ["a[@n = $v]", "//a[@n != $v]", "//a[position() = $v]", "//a[@n = @m]",
+                           "//a[@n = ../@n]", "//a[@n][1]", "$v//a[@n = $v]", "//a[current()/@n = $v]",
+                           "//a[@n = 1]"]:
+            self.assertEqual([], self.get_joins(expression), expression)
+
+    def test_same_results(self):
+        document_index = DocumentIndex(self.xml_doc)
+        elements = list(self.xml_doc.getroot())
+        for expression in ["//a[@n = current()/@n]", "//a[@m = current()/@m]", "//*[@n = current()/@n]",
+                           "//a[@n = $number]", "//a[@n = $string]", "//a[@n = $nodes]", "//a[@n = $boolean]"]:
+            compiled = self.binding.compile_assertion(expression, {}, list(self.VARIABLES))
+            self.assertEqual(1, len(compiled.rewrites), expression)
+            for element in elements:
+                self.assertEqual(compiled.evaluate(self.xml_doc, element, self.VARIABLES),
+                                 compiled.evaluate(self.xml_doc, element, self.VARIABLES, document_index),
+                                 expression)
+        # Numeric comparisons are not looked up in the index
+        compiled = self.binding.compile_assertion("//a[@n = $number]", {}, ['number'])
+        self.assertEqual(elements[:2], compiled.evaluate(self.xml_doc, None, self.VARIABLES, document_index))
+
+    def test_shared_index(self):
+        document_index = DocumentIndex(self.xml_doc)
+        for expression in ["//a[@n = current()/@n]", "count(//a[current()/@n = @n])"]:
+            self.binding.compile_assertion(expression, {}, []).evaluate(self.xml_doc, self.xml_doc.getroot()[0],
+                                                                        document_index=document_index)
+        self.assertEqual([('//a', '@n')], list(document_index._join_indexes))
+
+    def test_explain(self):
+        compiled_schema = Schema(get_file("schematron", "joins.sch")).compile()
+        self.assertIn("pattern #0 rule order assert j_ref: //party[@id = current()/@party]: "
+                      "index //party by @id, look up current()/@party", compiled_schema.explain())
+        self.assertEqual(4, len([line for line in compiled_schema.explain() if 'index' in line]))
+
+
+class TestHoisting(unittest.TestCase):
+    XML = '<r><a n="1"/><a n="2"/><a n="3"/><b n="2"/></r>'
+
+    def setUp(self):
+        self.binding = xslt.instantiate()
+        self.xml_doc = etree.ElementTree(etree.XML(self.XML))
+
+    def get_hoisted(self, expression):
+        return [rewrite for rewrite in self.binding.compile_assertion(expression, {}, ['v']).rewrites
+                if isinstance(rewrite, HoistedExpression)]
+
+    def test_hoisted_subexpressions(self):
+        self.assertEqual(["/r/b/@n"], [to_source(h.token) for h in self.get_hoisted("@n = /r/b/@n")])
+        # The largest constant subexpression is hoisted
+        self.assertEqual(["count(/r/a) + count(//b[@n = 2])"],
+                         [to_source(h.token) for h in self.get_hoisted("@n < count(/r/a) + count(//b[@n = 2])")])
+        self.assertEqual(["key('k', 'x')"], [to_source(h.token) for h in self.get_hoisted("key('k', 'x') = .")])
+        for expression in ["current()/@n = //b[. = current()]/@n", "$v/@n", "//a[@n = $v]", "../@n",
+                           "count(a)", "position() = 1", "1 + 2", "name() = 'a'"]:
+            self.assertEqual([], self.get_hoisted(expression), expression)
+
+    def test_evaluated_once_per_document(self):
+        compiled = self.binding.compile_assertion("@n = /r/b/@n", {}, [])
+        hoisted = compiled.rewrites[0]
+        elements = list(self.xml_doc.getroot())
+        document_index = DocumentIndex(self.xml_doc)
+        results = [compiled.evaluate(self.xml_doc, element, document_index=document_index) for element in elements]
+        self.assertEqual([False, True, False, True], results)
+        self.assertEqual({'evaluations': 1, 'hits': 3}, hoisted.get_statistics())
+        # Without a DocumentIndex nothing is memoized
+        self.assertEqual(results, [compiled.evaluate(self.xml_doc, element) for element in elements])
+        self.assertEqual({'evaluations': 1, 'hits': 3}, hoisted.get_statistics())
+        # Every document has its own value
+        other_doc = etree.ElementTree(etree.XML('<r><a n="1"/><b n="1"/></r>'))
+        self.assertTrue(compiled.evaluate(other_doc, other_doc.getroot()[0], document_index=DocumentIndex(other_doc)))
+        self.assertEqual({'evaluations': 2, 'hits': 3}, hoisted.get_statistics())
+
+    def test_explain(self):
+        compiled_schema = Schema(get_file("schematron", "hoisting.sch")).compile()
+        line = "pattern #0 rule line assert h_currency: /invoice/currency: evaluated once per document (%s)"
+        self.assertIn(line % "0 evaluations, 0 hits", compiled_schema.explain())
+        report = compiled_schema.validate_document(etree.parse(get_file("xml", "hoisting.xml")))
+        self.assertEqual(['h_currency', 'h_amount'], [test.id for test, element in report.get_failed_asserts()])
+        self.assertIn(line % "1 evaluations, 2 hits", compiled_schema.explain())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from lxml import etree
+
+from pyschematron import schema_cache
+from pyschematron.elements import Schema
+from pyschematron.schema_cache import get_cache_file, load_schema
+
+from test_util import get_file
+
+
+class TestSchemaCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache_directory = os.path.join(self.directory, "cache")
+        for name in ("full.sch", "full_include.sch", "full_include_abstract.sch"):
+            shutil.copy(get_file("schematron", name), self.directory)
+        self.schema_file = os.path.join(self.directory, "full.sch")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def load(self):
+        """
+        Returns the schema, and whether it was read from the file
+        """
+        with mock.patch.object(Schema, 'read_from_file', autospec=True, side_effect=Schema.read_from_file) as read:
+            schema = load_schema(self.schema_file, cache_directory=self.cache_directory)
+        return schema, read.called
+
+    def test_cached(self):
+        schema, read = self.load()
+        self.assertTrue(read)
+        self.assertEqual([os.path.join(self.directory, "full_include_abstract.sch"),
+                          os.path.join(self.directory, "full_include.sch")], schema.included_files)
+        cached, read = self.load()
+        self.assertFalse(read)
+        self.assertEqual(etree.tostring(schema.to_minimal_xml()), etree.tostring(cached.to_minimal_xml()))
+        self.assertEqual(self.schema_file, cached.file_path)
+
+        xml_doc = etree.parse(get_file("xml", "basic1_error_1.xml"))
+        for phase in ("#DEFAULT", "included_only"):
+            expected = schema.validate_document(xml_doc, phase)
+            report = cached.validate_document(xml_doc, phase)
+            self.assertEqual([test.flag for test, element in expected.get_failed_asserts()],
+                             [test.flag for test, element in report.get_failed_asserts()])
+            self.assertNotEqual([], report.get_failed_asserts())
+
+    def test_changed_include(self):
+        self.load()
+        with open(os.path.join(self.directory, "full_include.sch"), 'a') as include_file:
+            include_file.write("\n")
+        self.assertTrue(self.load()[1])
+        self.assertFalse(self.load()[1])
+
+    def test_other_version(self):
+        self.load()
+        with mock.patch.object(schema_cache, '__version__', 'other'):
+            self.assertTrue(self.load()[1])
+
+    def test_corrupt_cache_file(self):
+        self.load()
+        with open(get_cache_file(self.cache_directory, self.schema_file, 'elementpath'), 'wb') as cache_file:
+            cache_file.write(b"not a pickle")
+        self.assertTrue(self.load()[1])
+        self.assertFalse(self.load()[1])
+
+    def test_no_cache(self):
+        with mock.patch.dict(os.environ, {schema_cache.CACHE_DIRECTORY_VARIABLE: ""}):
+            schema = load_schema(self.schema_file)
+        self.assertFalse(os.path.exists(self.cache_directory))
+        self.assertEqual(2, len(schema.included_files))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+import os
+import shutil
+import tempfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from io import StringIO
+
+from lxml import etree
+
+from pyschematron.client import ValidationClient, ValidationClientError, main as client_main
+from pyschematron.commands import validate
+from pyschematron.server import SchemaCache, ValidationServer
+
+from test_util import get_file
+
+
+class TestValidationServer(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.directory, "server.sock")
+        self.server = ValidationServer(self.socket_path, port=0, verbosity=0)
+        self.server.start()
+        self.schema_file = get_file("schematron", "basic.sch")
+
+    def tearDown(self):
+        self.server.shutdown()
+        shutil.rmtree(self.directory)
+
+    def read(self, xml_file):
+        with open(xml_file, 'rb') as document:
+            return document.read()
+
+    def test_same_output(self):
+        for address in (self.socket_path, "http://127.0.0.1:%d" % self.server.get_port()):
+            for name in ("basic1_ok.xml", "basic1_error_1.xml", "basic1_warning_3.xml"):
+                xml_file = get_file("xml", name)
+                for output_type in ('text', 'svrl'):
+                    output_stream = StringIO()
+                    expected_result = validate.main(self.schema_file, xml_file, output_type=output_type,
+                                                    output_stream=output_stream)
+                    client_stream = StringIO()
+                    result = client_main(address, self.schema_file, [xml_file], output_type=output_type,
+                                         output_stream=client_stream)
+                    self.assertEqual((expected_result, output_stream.getvalue()), (result, client_stream.getvalue()))
+
+    def test_json(self):
+        client = ValidationClient(self.socket_path)
+        result, output = client.validate(self.schema_file, self.read(get_file("xml", "basic1_error_1.xml")),
+                                         output_type='json')
+        self.assertEqual(-1, result)
+        self.assertIn('"location": "Data"', output)
+        client.close()
+
+    def test_concurrent_requests(self):
+        # All clients use the same compiled schema at the same time
+        documents = [self.read(get_file("xml", name)) for name in ("basic1_ok.xml", "basic1_error_1.xml",
+                                                                   "basic1_warning_3.xml")]
+        client = ValidationClient(self.socket_path)
+        expected = [client.validate(self.schema_file, document) for document in documents]
+        client.close()
+
+        def validate(position):
+            client = ValidationClient(self.socket_path)
+            try:
+                return [client.validate(self.schema_file, documents[(position + index) % len(documents)])
+                        for index in range(30)]
+            finally:
+                client.close()
+
+        with ThreadPoolExecutor(8) as executor:
+            for position, results in enumerate(executor.map(validate, range(8))):
+                self.assertEqual([expected[(position + index) % len(documents)] for index in range(30)], results)
+
+    def test_schema_cache(self):
+        schema_file = os.path.join(self.directory, "schema.sch")
+        shutil.copy(self.schema_file, schema_file)
+        client = ValidationClient(self.socket_path)
+        document = self.read(get_file("xml", "basic1_error_1.xml"))
+        for _ in range(3):
+            self.assertEqual(-1, client.validate(schema_file, document)[0])
+        self.assertEqual([2], [entry['hits'] for entry in client.get_status()['schemas']])
+
+        # A changed schema is read again
+        schema = etree.parse(schema_file)
+        for element in schema.iter("{http://purl.oclc.org/dsdl/schematron}assert"):
+            element.set("test", "true()")
+        schema.write(schema_file)
+        self.assertEqual(0, client.validate(schema_file, document)[0])
+        self.assertEqual([0], [entry['hits'] for entry in client.get_status()['schemas']])
+        client.close()
+
+    def test_errors(self):
+        client = ValidationClient(self.socket_path)
+        self.assertRaises(ValidationClientError, client.validate, self.schema_file, b"<not well-formed")
+        self.assertRaises(ValidationClientError, client.validate, get_file("schematron", "missing.sch"), b"<a/>")
+        # The connection can still be used
+        self.assertEqual(0, client.validate(self.schema_file, self.read(get_file("xml", "basic1_ok.xml")))[0])
+        client.close()
+
+
+class TestServerSchemaCache(unittest.TestCase):
+    def test_size(self):
+        cache = SchemaCache(max_size=1)
+        first = cache.get(get_file("schematron", "basic.sch"))
+        self.assertIs(first, cache.get(get_file("schematron", "basic.sch")))
+        cache.get(get_file("schematron", "streaming.sch"))
+        self.assertEqual([get_file("schematron", "streaming.sch")], [entry['schema'] for entry in cache.get_status()])
+
+
+if __name__ == '__main__':
+    unittest.main()
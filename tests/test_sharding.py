@@ -0,0 +1,121 @@
+import os
+import tempfile
+import unittest
+from io import StringIO
+
+from lxml import etree
+
+from pyschematron.commands import validate
+from pyschematron.elements import Schema
+from pyschematron.exceptions import SchematronError
+from pyschematron.sharding import DocumentLayout, ShardedValidator
+from pyschematron.streaming import StreamingValidator
+
+from test_util import get_file
+
+
+class TestDocumentLayout(unittest.TestCase):
+    def test_children(self):
+        document = (b'<?xml version="1.0"?>\n<!DOCTYPE batch [<!ELEMENT batch ANY>]>\n'
+                    b'<batch xmlns:n="urn:n"><!-- <line> --><line a=">"><line/><![CDATA[</line>]]></line>'
+                    b'<?pi <line>?>\n<line/><n:line xmlns:m="urn:m"><m:x/></n:line></batch>')
+        layout = DocumentLayout(document)
+        children = [(document[start:end], layout.get_tag(name, start, tag_end))
+                    for name, start, tag_end, end in layout.iter_children()]
+        self.assertEqual([(b'<line a=">"><line/><![CDATA[</line>]]></line>', 'line'), (b'<line/>', 'line'),
+                          (b'<n:line xmlns:m="urn:m"><m:x/></n:line>', '{urn:n}line')], children)
+        self.assertEqual('batch', layout.root.tag)
+
+    def test_errors(self):
+        self.assertRaises(SchematronError, DocumentLayout, b'<!-- no root -->')
+        self.assertRaises(SchematronError, list, DocumentLayout(b'<batch><line></batch>').iter_children())
+        self.assertEqual([], list(DocumentLayout(b'<batch/>').iter_children()))
+
+
+class TestShardedValidation(unittest.TestCase):
+    def setUp(self):
+        self.compiled_schema = Schema(get_file("schematron", "streaming.sch")).compile()
+        self.xml_file = get_file("xml", "streaming.xml")
+
+    def test_same_results_as_streaming(self):
+        svrl = StreamingValidator(self.compiled_schema).validate_to_svrl(self.xml_file)
+        streaming = [(failed_assert.id, failed_assert.location) for active_pattern in svrl.active_patterns
+                     for fired_rule in active_pattern.fired_rules for failed_assert in fired_rule.reports]
+        for record_path in (None, 'line', '/batch/line'):
+            for workers in (1, 2):
+                validator = ShardedValidator(self.compiled_schema, record_path, workers, shard_size=1)
+                results = [(message.id, message.location, message.line)
+                           for errors, warnings in validator.iter_results(self.xml_file) for message in errors + warnings]
+                # The rule for the root element is run on the skeleton, which has no lines
+                self.assertEqual(sorted(streaming + [('r_lines', '.')]), sorted(result[:2] for result in results))
+                self.assertEqual([('r_lines', '.', 2), ('r_sender', 'header/sender', 3), ('s_amount', 'line[2]', 5),
+                                  ('d_sku', 'line[2]/sku', 5), ('s_sku', 'line[3]', 7)],
+                                 sorted(results, key=lambda result: result[2]))
+
+    def test_skeleton_last(self):
+        validator = ShardedValidator(self.compiled_schema, '/batch/line', 1)
+        results = [[message.id for message in errors] for errors, warnings in validator.iter_results(self.xml_file)]
+        self.assertEqual([['s_amount', 'd_sku', 's_sku'], ['r_lines', 'r_sender']], results)
+
+    def test_same_locations_as_full_validation(self):
+        schema = Schema(xml_element=etree.XML('''<schema xmlns="http://purl.oclc.org/dsdl/schematron" queryBinding="xslt">
+            <pattern><rule context="line"><assert id="amount" test="@amount &lt;= 100">Amount</assert></rule></pattern>
+            <pattern><rule context="sender"><assert id="sender" test="@id = 's2'">Sender</assert></rule>
+                <rule context="trailer"><assert id="trailer" test="*">Trailer</assert></rule></pattern>
+            <pattern><rule context="batch"><assert id="version" test="@version = 2">Version</assert></rule></pattern>
+            <pattern><rule context="header"><assert id="headers" test="count(/batch/header) = 2">Headers</assert></rule></pattern>
+        </schema>'''))
+        compiled_schema = schema.compile()
+        with tempfile.NamedTemporaryFile(suffix=".xml", delete=False) as xml_file:
+            xml_file.write(b'<batch version="1">\n<header><sender id="s1"/></header>\n<line amount="500"/>\n'
+                           b'<line amount="5"/>\n<trailer/>\n</batch>\n')
+        try:
+            xml_doc = etree.parse(xml_file.name)
+            report = schema.validate_document(xml_doc, compiled_schema=compiled_schema)
+            expected = sorted((test.id, xml_doc.getelementpath(element), element.sourceline)
+                              for test, element in report.get_failed_asserts())
+            self.assertEqual(5, len(expected))
+            for record_path in (None, 'line', '/batch/line'):
+                for workers in (1, 2):
+                    validator = ShardedValidator(compiled_schema, record_path, workers, shard_size=1)
+                    results = sorted((message.id, message.location, message.line)
+                                     for errors, warnings in validator.iter_results(xml_file.name)
+                                     for message in errors + warnings)
+                    if record_path is None:
+                        # The header is a record, the rule that needs the full document is not run for it
+                        self.assertEqual([result for result in expected if result[0] != 'headers'], results)
+                    else:
+                        self.assertEqual(expected, results)
+        finally:
+            os.unlink(xml_file.name)
+
+    def test_line_numbers(self):
+        records = "".join('\n<line amount="%d">\n<sku>a</sku>\n</line>' % amount for amount in (1, 200, 300, 2))
+        with tempfile.NamedTemporaryFile(suffix=".xml", delete=False) as xml_file:
+            xml_file.write(('<?xml version="1.0"?>\n\n<batch>%s\n</batch>\n' % records).encode('utf-8'))
+        try:
+            validator = ShardedValidator(self.compiled_schema, 'line', 2, shard_size=20)
+            results = [(message.location, message.line)
+                       for errors, warnings in validator.iter_results(xml_file.name) for message in errors]
+        finally:
+            os.unlink(xml_file.name)
+        # The rule for the root element fails on the skeleton, which has no lines
+        self.assertEqual([('line[2]', 7), ('line[3]', 10), ('.', 3)], results)
+
+    def test_record_paths(self):
+        validator = ShardedValidator(self.compiled_schema, '/other/line')
+        self.assertRaises(SchematronError, list, validator.iter_results(self.xml_file))
+        self.assertRaises(SchematronError, ShardedValidator, self.compiled_schema, 'batch/line')
+        self.assertRaises(SchematronError, ShardedValidator, self.compiled_schema, 'x:line')
+
+    def test_command(self):
+        result = Schema(get_file("schematron", "streaming.sch")).validate_sharded(self.xml_file, 'line', workers=1)
+        self.assertEqual(5, len(result.errors))
+        output_stream = StringIO()
+        result = validate.main(get_file("schematron", "streaming.sch"), self.xml_file, output_stream=output_stream,
+                               verbosity=0, workers=2, record_path='/batch/line')
+        self.assertEqual(-1, result)
+
+
+if __name__ == '__main__':
+    unittest.main()
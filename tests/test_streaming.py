@@ -0,0 +1,94 @@
+import unittest
+from io import BytesIO, StringIO
+
+from lxml import etree
+
+from pyschematron.commands import validate
+from pyschematron.elements import Schema
+from pyschematron.streaming import StreamingValidator
+
+from test_util import get_file
+
+
+class TestStreamingClassification(unittest.TestCase):
+    def test_classification(self):
+        compiled = Schema(get_file("schematron", "streaming.sch")).compile()
+        reasons = [(pattern.id, rule.context_text, rule.full_document_reason)
+                   for pattern in compiled.patterns for rule in pattern.rules]
+        self.assertEqual([
+            ('lines', 'line', None),
+            ('lines', 'header/sender[@id]', None),
+            ('document', 'line', "variable line_count needs the full document"),
+            ('document', 'sku', None),
+            ('positional', 'line[1]', "the context predicate 1 can be positional, or looks outside the subtree of the node"),
+            ('positional', 'sku', "an earlier rule of the pattern cannot be matched within a record"),
+            ('root', 'batch', None),
+            ('root', '/batch/header/sender', None),
+        ], reasons)
+        self.assertIn("pattern document rule line: needs the full document (variable line_count needs the full document)",
+                      compiled.describe_streaming())
+
+    def test_tests_outside_the_subtree(self):
+        compiled = Schema(get_file("schematron", "keys.sch")).compile()
+        self.assertEqual([False, False], [rule.streamable for rule in compiled.patterns[0].rules])
+        compiled = Schema(get_file("schematron", "basic.sch")).compile()
+        self.assertTrue(all(rule.streamable for rule in compiled.patterns[0].rules))
+
+
+class TestStreamingValidation(unittest.TestCase):
+    def setUp(self):
+        self.schema = Schema(get_file("schematron", "streaming.sch"))
+        self.xml_file = get_file("xml", "streaming.xml")
+
+    def test_results(self):
+        for backend in ('elementpath', 'lxml'):
+            validator = StreamingValidator(Schema(get_file("schematron", "streaming.sch"), backend=backend).compile())
+            results = []
+            for record, report in validator.iter_reports(self.xml_file):
+                results.extend((test.id, record.get_location(element)) for test, element in report.get_failed_asserts())
+            self.assertEqual([('r_sender', 'header[1]/sender'), ('s_amount', 'line[2]'), ('d_sku', 'line[2]/sku'),
+                              ('s_sku', 'line[3]')], results)
+            self.assertEqual(['line', 'line[1]', 'sku'], [rule.context_text for rule in validator.skipped_rules])
+            self.assertEqual(['batch'], [rule.context_text for rule in validator.root_rules])
+
+    def test_same_results_as_full_validation(self):
+        compiled = self.schema.compile()
+        xml_doc = etree.parse(self.xml_file)
+        report = compiled.validate_document(xml_doc)
+        expected = sorted((test.id, xml_doc.getelementpath(element))
+                          for rule, results in report.fired_rules.items() if rule.streamable
+                          for test, element in results if element is not xml_doc.getroot())
+        svrl = StreamingValidator(compiled).validate_to_svrl(self.xml_file)
+        results = sorted((failed_assert.id, failed_assert.location)
+                         for active_pattern in svrl.active_patterns for fired_rule in active_pattern.fired_rules
+                         for failed_assert in fired_rule.reports)
+        self.assertEqual(expected, results)
+
+    def test_records_are_freed(self):
+        records = "".join('<line amount="%d"><sku>a</sku></line>' % i for i in range(100))
+        source = BytesIO(("<batch><header/>%s</batch>" % records).encode('utf-8'))
+        validator = StreamingValidator(self.schema.compile())
+        numbers = []
+        for record in validator.iter_records(source):
+            numbers.append(record.number)
+            # The record that was validated before is the only one that is still in the tree,
+            # and it has been cleared
+            previous = record.element.getprevious()
+            if previous is not None:
+                self.assertEqual(0, len(previous))
+                self.assertIsNone(previous.getprevious())
+        self.assertEqual([1] + list(range(1, 101)), numbers)
+
+    def test_command(self):
+        output_stream = StringIO()
+        result = validate.main(get_file("schematron", "streaming.sch"), self.xml_file, output_stream=output_stream,
+                               verbosity=0, stream=True)
+        self.assertEqual(-1, result)
+        output_stream = StringIO()
+        validate.main(get_file("schematron", "streaming.sch"), self.xml_file, output_stream=output_stream,
+                      output_type='svrl', verbosity=0, stream=True)
+        self.assertIn('location="line[2]/sku"', output_stream.getvalue())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+import random
+import sys
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from lxml import etree
+
+from pyschematron.elements import Schema
+
+from test_util import get_file
+
+BASIC_FILES = ["basic1_ok.xml", "basic1_error_1.xml", "basic1_error_2.xml", "basic1_warning_3.xml",
+               "basic1_warning_4.xml"]
+
+# The schemas, their phases and documents
+CASES = [
+    ("basic.sch", "#DEFAULT", BASIC_FILES),
+    ("full.sch", "#DEFAULT", BASIC_FILES),
+    ("full.sch", "included_only", BASIC_FILES),
+    ("diagnostics.sch", "#DEFAULT", ["diagnostics/more_than_three_animals.xml", "diagnostics/only_one_animal.xml"]),
+    ("variables/variables1_xslt2.sch", "#DEFAULT", ["variables/variables1_correct.xml"]),
+    ("keys.sch", "#DEFAULT", ["keys.xml"]),
+    ("joins.sch", "#DEFAULT", ["keys.xml"]),
+    ("hoisting.sch", "#DEFAULT", ["hoisting.xml"]),
+]
+
+THREADS = 8
+JOBS = 400
+
+
+def get_results(schema, compiled_schema, xml_doc, engine, svrl):
+    if svrl:
+        return etree.tostring(schema.validate_document_to_svrl(xml_doc, compiled_schema=compiled_schema,
+                                                               engine=engine).to_xml())
+    report = schema.validate_document(xml_doc, compiled_schema=compiled_schema, engine=engine)
+    return [(test.id, test.test, xml_doc.getelementpath(element) if element is not None else "/")
+            for test, element in report.get_failed_asserts()]
+
+
+class TestSharedSchema(unittest.TestCase):
+    """
+    Validates many documents at once, in a pool of threads, against the same Schema and
+    CompiledSchema objects, and checks that the results are the same as those of a serial
+    validation
+    """
+
+    def setUp(self):
+        # Switch between the threads as often as possible
+        self.switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+
+    def tearDown(self):
+        sys.setswitchinterval(self.switch_interval)
+
+    def create_jobs(self, backend):
+        """
+        Returns a list of the jobs for the stress test, and a dict of their expected results
+        """
+        jobs = []
+        for schema_file, phase, xml_files in CASES:
+            if backend == 'lxml' and schema_file.startswith("variables/"):
+                continue
+            schema = Schema(get_file("schematron", schema_file), backend=backend)
+            compiled_schema = schema.compile(phase)
+            engines = ['rules', 'document']
+            if schema.query_binding_name == 'xslt' and backend == 'elementpath':
+                engines.append('xslt')
+            for xml_file in xml_files:
+                xml_doc = etree.parse(get_file("xml", xml_file))
+                for engine in engines:
+                    for svrl in (False, True):
+                        jobs.append((schema, compiled_schema, xml_doc, engine, svrl))
+        # The results of a serial validation, with a new schema for every document
+        expected = {}
+        for schema, compiled_schema, xml_doc, engine, svrl in jobs:
+            fresh_schema = Schema(schema.file_path, backend=backend)
+            key = (schema, engine, svrl, xml_doc)
+            expected[key] = get_results(fresh_schema, fresh_schema.compile(compiled_schema.phase), xml_doc, engine, svrl)
+        return jobs, expected
+
+    def check_concurrent_validation(self, backend):
+        jobs, expected = self.create_jobs(backend)
+        selected = [random.Random(position).choice(jobs) for position in range(JOBS)]
+
+        def validate(job):
+            schema, compiled_schema, xml_doc, engine, svrl = job
+            return get_results(schema, compiled_schema, xml_doc, engine, svrl)
+
+        with ThreadPoolExecutor(THREADS) as executor:
+            results = list(executor.map(validate, selected))
+        for (schema, compiled_schema, xml_doc, engine, svrl), result in zip(selected, results):
+            self.assertEqual(expected[(schema, engine, svrl, xml_doc)], result,
+                             "Different result for %s with engine %s" % (schema.file_path, engine))
+
+    def test_concurrent_validation(self):
+        self.check_concurrent_validation('elementpath')
+
+    def test_concurrent_validation_lxml(self):
+        self.check_concurrent_validation('lxml')
+
+    def test_concurrent_compilation(self):
+        schema = Schema(get_file("schematron", "full.sch"))
+        xml_doc = etree.parse(get_file("xml", "basic1_error_1.xml"))
+        expected = get_results(schema, None, xml_doc, 'rules', True)
+        barrier = threading.Barrier(THREADS)
+
+        def validate(position):
+            barrier.wait()
+            # Every thread compiles the schema for itself
+            return get_results(schema, None, xml_doc, ['rules', 'document'][position % 2], True)
+
+        with ThreadPoolExecutor(THREADS) as executor:
+            results = list(executor.map(validate, range(THREADS)))
+        self.assertEqual([expected] * THREADS, results)
+
+    def test_constant_variables(self):
+        # The values of the constant variables are kept in the schema, for all threads
+        schema = Schema(get_file("schematron", "lets.sch"))
+        compiled_schema = schema.compile()
+        xml_doc = etree.parse(get_file("xml", "basic1_ok.xml"))
+        expected = get_results(Schema(get_file("schematron", "lets.sch")), None, xml_doc, 'rules', False)
+        barrier = threading.Barrier(THREADS)
+
+        def validate(position):
+            barrier.wait()
+            return get_results(schema, compiled_schema, xml_doc, 'rules', False)
+
+        with ThreadPoolExecutor(THREADS) as executor:
+            results = list(executor.map(validate, range(THREADS)))
+        self.assertEqual([expected] * THREADS, results)
@@ -3,18 +3,20 @@ import unittest
 from lxml import etree
 
 from pyschematron.elements import Schema
+from pyschematron.validation import ValidationReport
 
 from test_util import get_file
 
 
 class TestValidation(unittest.TestCase):
+    backend = 'elementpath'
 
     def check_schema_validation(self, schema_file, xml_file, expected_errors, expected_warnings):
         """
         expected_errors is a list of the id values of the assertions that should fail with either no flag or flag="error"
         expected_warnings is a list of the id values of the assertions that should fail with either flag="warning"
         """
-        schema = Schema(schema_file)
+        schema = Schema(schema_file, backend=self.backend)
         xml_doc = etree.parse(xml_file)
 
         report = schema.validate_document(xml_doc)
@@ -38,14 +40,27 @@ class TestValidation(unittest.TestCase):
         self.check_schema_validation(get_file("schematron", "basic.sch"), get_file("xml", "basic1_warning_4.xml"), [],
                                      ["4"])
 
+    def test_keys(self):
+        self.check_schema_validation(get_file("schematron", "keys.sch"), get_file("xml", "keys.xml"),
+                                     ["k_single", "k_ref", "k_unused"], [])
+
+    def test_keys_xslt2(self):
+        self.check_schema_validation(get_file("schematron", "keys_xslt2.sch"), get_file("xml", "keys.xml"),
+                                     ["k_single", "k_ref", "k_unused"], [])
+
+    def test_joins(self):
+        self.check_schema_validation(get_file("schematron", "joins.sch"), get_file("xml", "keys.xml"),
+                                     ["j_single", "j_ref", "j_unique", "j_unique", "j_unused"], [])
+
 
 class ValidateSchematronFiles(unittest.TestCase):
     """
     Tests the schematron files used in the test cases, validating them against the Schematron schematron from the specification
     """
+    backend = 'elementpath'
 
     def setUp(self):
-        self.schema = Schema(get_file("schematron", "schematron.sch"))
+        self.schema = Schema(get_file("schematron", "schematron.sch"), backend=self.backend)
 
     def get_schematron_minimal_xml(self, filename):
         # These are all schematrons, and schematrons with includes can fail
@@ -61,7 +76,10 @@ class ValidateSchematronFiles(unittest.TestCase):
                          'schematron.sch',
                          # 'unknown_querybinding.sch',
                          'svrl.sch',
-                         'full.sch'
+                         'full.sch',
+                         'keys.sch',
+                         'keys_xslt2.sch',
+                         'joins.sch'
                          ]:
             xml_doc = self.get_schematron_minimal_xml(filename)
             report = self.schema.validate_document(xml_doc)
@@ -78,3 +96,25 @@ class ValidateSchematronFiles(unittest.TestCase):
             xml_doc = self.get_schematron_minimal_xml(filename)
             report = self.schema.validate_document(xml_doc)
             self.assertNotEqual([], report.get_failed_asserts(), [a.to_string() for a, element in report.get_failed_asserts()])
+
+
+class TestValidationLxml(TestValidation):
+    backend = 'lxml'
+
+
+class ValidateSchematronFilesLxml(ValidateSchematronFiles):
+    backend = 'lxml'
+
+
+class TestValidationReport(unittest.TestCase):
+    def test_duplicates(self):
+        schema = Schema(get_file("schematron", "basic.sch"))
+        compiled_schema = schema.compile()
+        rule = compiled_schema.patterns[0].rules[0]
+        assertion = rule.assertions[0]
+        elements = [etree.Element("element") for _ in range(3)]
+        report = ValidationReport()
+        report.add_fired_rule(rule)
+        for element in elements + elements + [None, None]:
+            report.add_failed_assert(rule, assertion, element)
+        self.assertEqual([(assertion.source, element) for element in elements + [None]], report.get_failed_asserts())
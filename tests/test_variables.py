@@ -0,0 +1,162 @@
+import threading
+import unittest
+from collections import Counter
+from unittest import mock
+
+from lxml import etree
+
+from pyschematron.compiler import CompiledVariable
+from pyschematron.elements import Schema
+from pyschematron.exceptions import SchematronError
+from pyschematron.validation import ValidationContext
+from pyschematron.variables import VariableScope
+
+from test_util import get_file
+
+
+class TestVariableScope(unittest.TestCase):
+    def test_lazy_evaluation(self):
+        calls = []
+        scope = VariableScope()
+        scope.add_let("a", lambda: calls.append("a") or 1)
+        scope.add_let("b", lambda: calls.append("b") or scope["a"] + 1)
+        self.assertIn("b", scope)
+        self.assertFalse(scope.is_evaluated("b"))
+        self.assertEqual([], calls)
+        self.assertEqual(2, scope["b"])
+        self.assertEqual(2, scope["b"])
+        self.assertEqual(["b", "a"], calls)
+        self.assertTrue(scope.is_evaluated("a"))
+        self.assertRaises(KeyError, scope.__getitem__, "c")
+
+    def test_nested_scopes(self):
+        scope = VariableScope()
+        scope["a"] = 1
+        inner = scope.copy()
+        inner["a"] = 2
+        inner["b"] = 3
+        self.assertEqual(1, scope["a"])
+        self.assertNotIn("b", scope)
+        self.assertEqual(2, inner["a"])
+        self.assertEqual(["a", "b"], list(inner))
+        self.assertEqual({"a": 2, "b": 3}, dict(inner.items()))
+
+    def test_circular_reference(self):
+        scope = VariableScope()
+        scope.add_let("a", lambda: scope["a"])
+        self.assertRaises(SchematronError, scope.__getitem__, "a")
+
+
+class TestLetEvaluation(unittest.TestCase):
+    def setUp(self):
+        self.xml_doc = etree.ElementTree(etree.XML('<order><line amount="5"/><line amount="25"/></order>'))
+
+    def test_classification(self):
+        compiled = Schema(get_file("schematron", "lets.sch")).compile()
+        variables = dict((variable.name, variable) for variable in compiled.variables)
+        self.assertEqual(('max', '10'), variables['max'].constant_key)
+        self.assertEqual(('double_max', '2 * $max', ('max', '10')), variables['double_max'].constant_key)
+        self.assertIsNone(variables['limit'].constant_key)
+        self.assertEqual(('max',), variables['limit'].dependencies)
+        self.assertIsNone(compiled.patterns[0].variables[0].constant_key)
+        self.assertIn("let double_max: evaluated once per schema", compiled.explain())
+
+    def test_unreferenced_lets(self):
+        for backend in ('elementpath', 'lxml'):
+            schema = Schema(get_file("schematron", "lets.sch"), backend=backend)
+            for engine in ('rules', 'document'):
+                report = schema.validate_document(self.xml_doc, engine=engine)
+                self.assertEqual(['l_total'], [test.id for test, element in report.get_failed_asserts()])
+
+    def test_constants_once_per_schema(self):
+        schema = Schema(get_file("schematron", "lets.sch"))
+        schema.validate_document(self.xml_doc)
+        self.assertEqual({('max', '10'), ('double_max', '2 * $max', ('max', '10'))},
+                         set(schema.constant_variable_values))
+        # The cached values are used for every document
+        schema.constant_variable_values[('max', '10')] = 100
+        report = schema.validate_document(self.xml_doc)
+        self.assertEqual([], report.get_failed_asserts())
+
+
+class TestRuleVariables(unittest.TestCase):
+    def setUp(self):
+        self.schema = Schema(get_file("schematron", "rule_lets.sch"))
+        self.xml_doc = etree.ElementTree(etree.XML('<order><line amount="5"/><line amount="25"/><line amount="12"/></order>'))
+
+    def test_classification(self):
+        rule = self.schema.compile().patterns[0].rules[0]
+        self.assertEqual(['limit', 'half_limit', 'factor'], [variable.name for variable in rule.rule_variables])
+        self.assertEqual(['amount', 'double', 'unused'], [variable.name for variable in rule.node_variables])
+        # Tests that only use rule variables that are the same for every node can be evaluated in bulk
+        self.assertEqual(['r_half_limit', 'r_factor'], [test.source.id for test in rule.assertions if test.bulk_test is not None])
+
+    def test_evaluations(self):
+        for engine in ('rules', 'document'):
+            # A new schema, the constant variables are evaluated once per schema
+            schema = Schema(get_file("schematron", "rule_lets.sch"))
+            with mock.patch.object(CompiledVariable, 'evaluate', autospec=True, side_effect=CompiledVariable.evaluate) as evaluate:
+                report = schema.validate_document(self.xml_doc, engine=engine)
+            self.assertEqual([('r_half_limit', '/order/line[2]'), ('r_double', '/order/line[2]')],
+                             [(test.id, self.xml_doc.getpath(element)) for test, element in report.get_failed_asserts()])
+            evaluations = Counter(call[0][0].name for call in evaluate.call_args_list)
+            # Once per rule, once per node that fired the rule (but only when referenced), and
+            # the pattern and rule variables called 'factor'
+            self.assertEqual({'limit': 1, 'half_limit': 1, 'amount': 3, 'double': 3, 'factor': 2}, evaluations)
+
+
+class TestVariableFrames(unittest.TestCase):
+    def setUp(self):
+        self.compiled = Schema(get_file("schematron", "rule_lets.sch")).compile()
+        self.xml_doc = etree.ElementTree(etree.XML('<order><line amount="5"/><line amount="25"/></order>'))
+
+    def test_frame_chain(self):
+        context = ValidationContext(self.compiled, self.xml_doc)
+        pattern = self.compiled.patterns[0]
+        context.set_pattern(pattern)
+        pattern_frame = context.variables
+        self.assertIs(context.global_variables, pattern_frame.parent)
+        context.set_rule(pattern.rules[0])
+        self.assertEqual(20, context.rule_variables["limit"])
+        context.add_rule_variables(pattern.rules[0], self.xml_doc.getroot()[0])
+        self.assertEqual(10, context.node_variables["double"])
+        # The variables of a rule are not visible to the pattern or to the next rule
+        self.assertNotIn("limit", context.variables)
+        context.set_rule(pattern.rules[1])
+        self.assertNotIn("limit", context.node_variables)
+        self.assertNotIn("amount", context.node_variables)
+        self.assertEqual(2, context.node_variables["factor"])
+
+    def test_frames_are_kept(self):
+        context = ValidationContext(self.compiled, self.xml_doc)
+        pattern = self.compiled.patterns[0]
+        context.set_pattern(pattern)
+        context.set_rule(pattern.rules[0])
+        frame = context.rule_variables
+        self.assertEqual(20, frame["limit"])
+        context.set_pattern(pattern)
+        context.set_rule(pattern.rules[0])
+        self.assertIs(frame, context.rule_variables)
+        self.assertTrue(context.rule_variables.is_evaluated("limit"))
+
+    def test_separate_documents(self):
+        schema = Schema(get_file("schematron", "rule_lets.sch"))
+        other_doc = etree.ElementTree(etree.XML('<order><line amount="50"/></order>'))
+        results = {}
+
+        def validate(name, xml_doc):
+            report = schema.validate_document(xml_doc)
+            results[name] = [(test.id, xml_doc.getpath(element)) for test, element in report.get_failed_asserts()]
+
+        threads = [threading.Thread(target=validate, args=(name, xml_doc))
+                   for name, xml_doc in (('first', self.xml_doc), ('second', other_doc))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([('r_half_limit', '/order/line[2]'), ('r_double', '/order/line[2]')], results['first'])
+        self.assertEqual([('r_half_limit', '/order/line'), ('r_double', '/order/line')], results['second'])
+
+
+if __name__ == '__main__':
+    unittest.main()